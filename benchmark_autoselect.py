@@ -0,0 +1,60 @@
+import copy
+import re
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path as p
+
+from pydupe.dupetable import check_and_autoselect
+from pydupe.lutable import LuTable
+
+# time and peak RSS of check_and_autoselect: python benchmark_autoselect.py [number of dupes]
+# every variant runs in its own process, ru_maxrss is the peak RSS of that process
+
+
+def check_and_autoselect_deepcopy(*, deltable: LuTable[bytes, p], keeptable: LuTable[bytes, p], autoselect_pattern: str = ".") -> tuple[LuTable[bytes, p], LuTable[bytes, p]]:
+    # check_and_autoselect before it worked in place
+    autoselect_pattern_compiled = re.compile(autoselect_pattern)
+    old_deltable: LuTable[bytes, p] = copy.deepcopy(deltable)
+
+    for hsh in sorted(old_deltable.keys()):
+        if hsh not in keeptable.keys():
+            keeptable.lextend(deltable, hsh)
+            deltable.ldel([hsh])
+            values = sorted(old_deltable[hsh])
+            for f in values:
+                fname = f.name
+                if autoselect_pattern_compiled.search(fname):
+                    keeptable.discard((hsh, f))
+                    assert len(keeptable[hsh]) > 0
+                    deltable.add((hsh, f))
+                    break
+
+    return deltable, keeptable
+
+
+def run(variant: str, n: int) -> None:
+    # a third of the hashes is kept somewhere else, the others are autoselected
+    deltable: LuTable[bytes, p] = LuTable.from_sorted_rows(((i // 3).to_bytes(8, 'big'), p(f"/home/user/Pictures/{i % 97:02}/IMG_{i:08}.JPG")) for i in range(n))
+    keeptable: LuTable[bytes, p] = LuTable.from_sorted_rows((i.to_bytes(8, 'big'), p(f"/backup/IMG_{i:08}.JPG")) for i in range(0, n // 3, 3))
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    autoselect = check_and_autoselect_deepcopy if variant == 'deepcopy' else check_and_autoselect
+    start_time = time.time()
+    autoselect(deltable=deltable, keeptable=keeptable, autoselect_pattern=".")
+    elapsed = time.time() - start_time
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{variant:>9}: {n} dupes {elapsed:6.2f} sec, peak RSS {peak / 1024:7.1f} MiB (+{(peak - before) / 1024:.1f} MiB for autoselect)")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        run(sys.argv[1], int(sys.argv[2]))
+    else:
+        n = sys.argv[1] if len(sys.argv) > 1 else "300000"
+        for variant in ('deepcopy', 'in place'):
+            subprocess.run([sys.executable, __file__, variant, n], check=True)
+
+# 300000 dupes:
+#  deepcopy: 300000 dupes   5.26 sec, peak RSS   346.4 MiB (+167.4 MiB for autoselect)
+#  in place: 300000 dupes   0.86 sec, peak RSS   200.8 MiB (+22.0 MiB for autoselect)
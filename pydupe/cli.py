@@ -1,17 +1,22 @@
+import re
 from re import I
 import typing
 from os import environ
 from pathlib import Path as p
 
 import rich_click as click
-from rich import print
+from rich import filesize, print
 from rich.console import Console
 from rich.panel import Panel
 
 import pydupe.dupetable as dupetable
-from pydupe.cmd import cmd_clean, cmd_hash, cmd_purge
+from pydupe.cmd import cmd_clean, cmd_hash, cmd_purge, cmd_rebuild
+from pydupe.config import cnf
 from pydupe.console import console
 from pydupe.db import PydupeDB
+from pydupe.hasher import HASHALGORITHMS
+from pydupe.policy import RULES, KeepPolicy
+from pydupe.rules import load_rules
 
 environ["PAGER"] = "less -r"
 
@@ -35,11 +40,24 @@ def lst(ctx: click.Context, depth: int) -> None:
     dbname = ctx.obj['dbname']
     Dp = dupetable.Dupes(dbname)
     Dp.print_most_common(depth)
+    with PydupeDB(dbname) as db:
+        stats = db.get_dupe_stats()
+    console.print(f"[green] {stats['groups']} groups of dupes waste {filesize.decimal(int(stats['wasted']))}")
+
+
+def _keep_policy(ctx: click.Context, param: click.Parameter, value: typing.Tuple[str, ...]) -> typing.Optional[KeepPolicy]:
+    if not value:
+        return None
+    try:
+        return KeepPolicy.parse(','.join(value))
+    except (ValueError, re.error) as e:
+        raise click.BadParameter(str(e))
 
 
 @cli.command()
 @click.option('--match_deletions/--match_keeps', default=True, show_default=True, help='chooose [PATTERN] matches to select dupes to delete or dupes to keep.')
 @click.option('--autoselect', is_flag=True, default=False, show_default = True, help='autoselect dupes if all are matched')
+@click.option('--keep-policy', 'keep_policy', multiple=True, callback=_keep_policy, help=f'rules separated by comma or given repeatedly to choose the file kept if all dupes are matched, implies autoselect. The first rule decides, the next one on a tie: {"; ".join(f"{rule}: {text}" for rule, text in RULES.items())}')
 @click.option('--dupes_global/--dupes_local', default=True, show_default=True, help='consider dupes outside chosen directory')
 @click.option('--do_move', is_flag=True, default=False, show_default=True, help='dupes are moved only if this flag is set')
 @click.option('--delete/--trash', default=False, show_default=True, help='delete dupes or use trash')
@@ -48,7 +66,7 @@ def lst(ctx: click.Context, depth: int) -> None:
 @click.argument('deldir', required=True, type=click.Path(exists=True, path_type=p)) # type: ignore
 @click.argument('pattern', required=False, default=".")
 @click.pass_context
-def dd(ctx: click.Context, match_deletions: bool, autoselect: bool, dupes_global: bool, do_move: bool, delete: bool, trash: p, outfile: p, deldir: p, pattern: str) -> None:
+def dd(ctx: click.Context, match_deletions: bool, autoselect: bool, keep_policy: typing.Optional[KeepPolicy], dupes_global: bool, do_move: bool, delete: bool, trash: p, outfile: p, deldir: p, pattern: str) -> None:
     """
     Dedupe Directory. Type dd --help for details.
 
@@ -61,6 +79,8 @@ def dd(ctx: click.Context, match_deletions: bool, autoselect: bool, dupes_global
         - if match_keeps, they are marked for deletion.
     - if autoselect ist True and all dupes of a files are marked for deletion, one of them is deselected;
        if autoselect is False (the default), no deletion is performed if for a hash dupes are not contained in keeptable.
+    - with --keep-policy, e.g. --keep-policy root:/photos,exif,oldest, the file kept of such dupes is ranked by its rules
+       and all others are deleted.
     if do_move is False, a dry run is done and a pretty printed table is shown and saved as html for further inspection.
     
     """
@@ -72,19 +92,57 @@ def dd(ctx: click.Context, match_deletions: bool, autoselect: bool, dupes_global
     option['dupes_global'] = dupes_global
     option['autoselect'] = autoselect
     option['dedupe'] = True
+    option['sql'] = True
+    option['keep_policy'] = keep_policy
     Dt: dupetable.Dupetable = dupetable.Dupetable(**option)
+    _show_or_move(Dt, do_move=do_move, delete=delete, trash=trash, outfile=outfile)
+
 
+@cli.command()
+@click.option('--do_move', is_flag=True, default=False, show_default=True, help='dupes are moved only if this flag is set')
+@click.option('--delete/--trash', default=False, show_default=True, help='delete dupes or use trash')
+@click.option('-tr', '--trash', required=False, default=p.home() / '.pydupeTrash', show_default=True, help='path to Trash. If set to "DELETE", no trash is used.', type=click.Path(path_type=p))
+@click.option('-of', '--outfile', required=False, default=None, show_default=True, help='if given, html output is written to this file', type=click.Path(path_type=p))
+@click.argument('rulesfile', required=True, type=click.Path(exists=True, dir_okay=False, path_type=p))
+@click.pass_context
+def ddrules(ctx: click.Context, do_move: bool, delete: bool, trash: p, outfile: p, rulesfile: p) -> None:
+    """
+    Dedupe several directories by the rules in RULESFILE.
+
+    \b
+    - RULESFILE is a TOML file with one [[rule]] table for each directory, in their order of priority:
+        [[rule]]
+        deldir = "/nas/export1"
+        pattern = "."
+        match_deletions = true
+        dupes_global = true
+        autoselect = false
+        keep_policy = "oldest"
+      Only deldir is required, the other keys default like the options of dd.
+    - The dupes are read once and a file deleted or kept within its deldir by a rule is not changed by later rules.
+    - No rule deletes the last dupe of a hash. All deletions are validated and done at once.
+    """
+    try:
+        rules = load_rules(rulesfile)
+        Dt = dupetable.RulesDupetable(rules, dbname=ctx.obj['dbname'], dedupe=True)
+    except (ValueError, re.error) as e:
+        raise click.BadParameter(str(e), param_hint='RULESFILE')
+    _show_or_move(Dt, do_move=do_move, delete=delete, trash=trash, outfile=outfile)
+
+
+def _show_or_move(Dt: dupetable.Dupetable, *, do_move: bool, delete: bool, trash: p, outfile: p) -> None:
     dupestree, dels, keeps = Dt.get_tree()
+    reclaimable = filesize.decimal(Dt.get_reclaimable())
 
 
     if not do_move and not outfile:
         with console.pager(styles=True):
-            console.print(f"[red]deletions: {dels} [green]keeps: {keeps}")
+            console.print(f"[red]deletions: {dels} [green]keeps: {keeps} [blue]reclaimable: {reclaimable}")
             console.print(dupestree)
 
     if not do_move and outfile:
         console.record = True
-        console.print(f"[red]deletions: {dels} [green]keeps: {keeps}")
+        console.print(f"[red]deletions: {dels} [green]keeps: {keeps} [blue]reclaimable: {reclaimable}")
         console.print(dupestree)
         console.save_html(str(outfile))
         console.record = False
@@ -93,13 +151,15 @@ def dd(ctx: click.Context, match_deletions: bool, autoselect: bool, dupes_global
         Dt.delete(trash, delete)
 
 @cli.command()
+@click.option('-a', '--algorithm', default=None, type=click.Choice(sorted(HASHALGORITHMS)), help=f"hash algorithm [default: {cnf['HASHALGORITHM']}]. Files hashed with another algorithm are hashed again if needed.")
+@click.option('--incremental/--full', default=False, show_default=True, help='only rescan directories changed since the last scan. Files changed in place are not noticed.')
 @click.argument('path', required=True, type=click.Path(exists=True, path_type=p)) # type: ignore
 @click.pass_context
-def hash(ctx: click.Context, path: p) -> None:
+def hash(ctx: click.Context, algorithm: typing.Optional[str], incremental: bool, path: p) -> None:
     """
     recursive hash files in PATH and store hash in database.
     """
-    cmd_hash(dbname=ctx.obj['dbname'], path=path.resolve())
+    cmd_hash(dbname=ctx.obj['dbname'], path=path.resolve(), algo=algorithm, incremental=incremental)
 
 
 @cli.command()
@@ -120,6 +180,15 @@ def clean(ctx: click.Context) -> None:
     dbname = ctx.obj['dbname']
     cmd_clean(dbname)
 
+@cli.command()
+@click.pass_context
+def rebuild(ctx: click.Context) -> None:
+    """
+    rebuild the table of dupe groups from all hashed files
+    """
+    dbname = ctx.obj['dbname']
+    cmd_rebuild(dbname)
+
 @cli.command()
 def help() -> None:
     """
@@ -1,45 +1,47 @@
 from  pathlib import Path as p
 import typing as tp
 
+from rich import filesize
+
 import pydupe.hasher
 from pydupe.console import console, spinner
 from pydupe.db import PydupeDB
 from pydupe.utils import mytimer
 
 
-def cmd_hash(dbname: p, path: p) -> None:
+def cmd_hash(dbname: p, path: p, algo: tp.Optional[str] = None, incremental: bool = False) -> None:
     assert isinstance(path, p), 'must be of type Pathlib.Path'
 
     t = mytimer() 
     pydupe.hasher.clean(dbname)
+    counts: tp.Dict[str, int] = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    number_scanned = pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path, incremental, counts)
     with PydupeDB(dbname) as db:
-        db.delete_dir(path)
-        db.commit()
-    number_scanned = pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path)
-    with PydupeDB(dbname) as db:
-        db.copy_hash_to_table_lookup()
-        db.commit()
-    number_hashed = pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname)
-    with PydupeDB(dbname) as db:
-        db.copy_dir_to_table_permanent(path)
+        db.copy_hash_of_moved_files()
         db.commit()
+    avoided = pydupe.hasher.prefilter_partial_hashes(dbname, algo)
+    number_hashed = pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname, algo)
 
     console.print(
         f"[green] scanned {number_scanned} and hashed thereof {number_hashed} files in {t.get} sec")
+    console.print(
+        f"[green] {counts['inserted']} files inserted, {counts['updated']} updated, {counts['unchanged']} unchanged in database")
+    console.print(
+        f"[green] partial hashes avoided reading {filesize.decimal(avoided['head'])} (head) and {filesize.decimal(avoided['tail'])} (tail)")
 
 
 @spinner(console, "purging database")
 def cmd_purge(dbname: p) -> None:
-    delfiles: list[p]= []
     with PydupeDB(dbname) as db:
         db.clean_lookup()
-        file_gen = db.get_files_in_permanent()
-        for item in file_gen:
-            f = p(item['filename'])
-            if not f.is_file():
-                delfiles.append(f)
-        for f in delfiles:
-            db.delete_file_permanent(f)
+        pydupe.hasher.purge_missing(db, 'permanent')
+        db.delete_unused_dirs()
+        db.commit()
+
+@spinner(console, "rebuilding dupe groups")
+def cmd_rebuild(dbname: p) -> None:
+    with PydupeDB(dbname) as db:
+        db.rebuild_dupe_groups()
         db.commit()
 
 def cmd_clean(dbname: p) -> None:
@@ -16,6 +16,46 @@ else:
 cnf : tp.Dict[str, tp.Any]= {}
 cnf['HASHEXECUTE_1'] = HASHEXECUTE_1
 
+# 'hashlib' hashes in-process, 'subprocess' forks HASHEXECUTE_1 for every file
+cnf['HASHBACKEND'] = 'hashlib'
+cnf['HASHBUFSIZE'] = 1024 * 1024
+# one of pydupe.data.HASH_HEXLEN. sha256 is the fastest hashlib digest on CPUs with
+# SHA extensions, blake2b-256 on CPUs without. xxh128 is much faster than any
+# cryptographic digest but needs the optional xxhash package (pip install pydupe[xxhash])
+# and is opt-in: changing the algorithm rehashes every file on the next hash run.
+cnf['HASHALGORITHM'] = 'sha256'
+# hasher pipeline: number of hasher threads (None: ThreadPoolExecutor default),
+# maximum number of files in flight and number of hashes per commit
+cnf['HASHWORKERS'] = None
+cnf['HASHQUEUESIZE'] = 4096
+cnf['HASHBATCHSIZE'] = 1000
+# files are hashed device by device in parallel, each with its own limit of concurrent
+# reads. DEVICEWORKERS maps any path on a device to its limit, e.g. {'/mnt/backup': 1}.
+# Other devices are auto-tuned: one reader for spinning disks, NETWORKWORKERS for
+# network filesystems and HASHWORKERS (None: ThreadPoolExecutor default) otherwise
+cnf['DEVICEWORKERS'] = {}
+cnf['NETWORKWORKERS'] = 4
+# files larger than PARTIALHASHMINSIZE with equal size are compared by hashes of
+# their first and last PARTIALHASHBLOCK bytes before they are fully hashed
+cnf['PARTIALHASHBLOCK'] = 64 * 1024
+cnf['PARTIALHASHMINSIZE'] = 1024 * 1024
+# directory walker: number of scanner threads (None: ThreadPoolExecutor default)
+cnf['SCANWORKERS'] = None
+# purge and clean check whether files still exist on PURGEWORKERS threads, which
+# hides the latency of network filesystems
+cnf['PURGEWORKERS'] = 32
+# sqlite: seconds to wait for a lock held by another pydupe, page cache and
+# memory map in bytes
+cnf['DBBUSYTIMEOUT'] = 60
+cnf['DBCACHESIZE'] = 64 * 1024 * 1024
+cnf['DBMMAPSIZE'] = 256 * 1024 * 1024
+# writes of scanner, hasher and deleter go through one writer thread. It commits after
+# DBCOMMITSIZE mutations or DBCOMMITSECONDS seconds, whatever comes first. The latter
+# bounds the work lost in a crash. At most DBWRITERQUEUESIZE mutations wait in its queue
+cnf['DBCOMMITSIZE'] = 100
+cnf['DBCOMMITSECONDS'] = 1.0
+cnf['DBWRITERQUEUESIZE'] = 1000
+
 cnf['SYSTEM'] = SYSTEM_
 
 CONFIGFLAGFILE = pathlib.Path.home() / ".pydupe.log"
@@ -1,11 +1,22 @@
 from typing import Optional, NamedTuple
 from pathlib import Path as p
 from dataclasses import dataclass
+import os
 import sqlite3
 import re
 
 valid_sha256 = re.compile(r"^[a-f0-9]{64}(:.+)?$", re.IGNORECASE)
 
+# hex digest length of every hash algorithm pydupe knows about
+HASH_HEXLEN: dict[str, int] = {
+    'sha256': 64,
+    'blake2b-256': 64,
+    'md5': 32,
+    'xxh128': 32,
+}
+valid_hash: dict[str, re.Pattern[str]] = {
+    algo: re.compile(r"^[a-f0-9]{%d}(:.+)?$" % hexlen, re.IGNORECASE) for algo, hexlen in HASH_HEXLEN.items()}
+
 @dataclass(order=True, frozen=True, slots=True)
 class fparms:
     filename: Optional[str] = None
@@ -14,14 +25,22 @@ class fparms:
     inode: Optional[int] = None
     mtime: Optional[float] = None
     ctime: Optional[float] = None
+    dev: Optional[int] = None
+    mtime_ns: Optional[int] = None
 
-def checkHash(fp: fparms) -> None:
-    if fp.hash and not valid_sha256.match(fp.hash):
-        raise ValueError("not a valid sha256 hash")
+def checkHash(fp: fparms, algo: str = 'sha256') -> None:
+    if algo not in valid_hash:
+        raise ValueError("unknown hash algorithm " + algo)
+    if fp.hash and not valid_hash[algo].match(fp.hash):
+        raise ValueError("not a valid " + algo + " hash")
 
 def from_path(pth: p, hash: Optional[str] = None) -> fparms:
-    stat = pth.stat()
-    return fparms(filename=str(pth.resolve()), hash=hash, size=stat.st_size, inode=stat.st_ino, mtime=stat.st_mtime, ctime=stat.st_ctime)
+    return from_stat(str(pth.resolve()), pth.stat(), hash)
+
+def from_stat(filename: str, stat: os.stat_result, hash: Optional[str] = None) -> fparms:
+    return fparms(filename=filename, hash=hash, size=stat.st_size, inode=stat.st_ino, mtime=stat.st_mtime, ctime=stat.st_ctime, dev=stat.st_dev, mtime_ns=stat.st_mtime_ns)
 
 def from_row(row: sqlite3.Row) -> fparms:
-    return fparms(filename=row['filename'], hash=row['hash'], size=row['size'], inode=row['inode'], mtime=row['mtime'], ctime=row['ctime'])
\ No newline at end of file
+    keys = row.keys()
+    return fparms(filename=row['filename'], hash=row['hash'], size=row['size'], inode=row['inode'], mtime=row['mtime'], ctime=row['ctime'],
+                  dev=row['dev'] if 'dev' in keys else None, mtime_ns=row['mtime_ns'] if 'mtime_ns' in keys else None)
\ No newline at end of file
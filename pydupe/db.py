@@ -1,9 +1,218 @@
+import atexit
+import concurrent.futures
+import os
 from pathlib import Path as p
+import queue
+import re
 import sqlite3
+import threading
+import time
 import typing as tp
 import types as ty
+from pydupe.config import cnf
 from pydupe.data import fparms
 
+_SCHEMA_VERSION = 1
+
+# files are stored as dir_id and basename in table files. The full filename of a file l is
+# built from the path of its directory d, the path of the root directory '/' is ''
+_FILENAME = "d.path || '/' || l.basename"
+
+# files seen by the current scan have the current epoch, together they are the lookup view.
+# clean_lookup just starts a new epoch. Files with a hash are kept as permanent cache until purged
+_EPOCH = "(SELECT value FROM meta WHERE name = 'epoch')"
+_SEEN = f"epoch = {_EPOCH}"
+_HASHED = "(hash is not NULL OR head is not NULL)"
+
+# the file in directory path ? with basename ?
+_FILE_WHERE = "dir_id = (SELECT id FROM dirs WHERE path = ?) AND basename = ?"
+
+_EQUAL_SIZED_WHERE_HASH_IS_NULL_SQL = f"SELECT {_FILENAME} filename FROM files l JOIN (SELECT size, count(*) c FROM files WHERE {_SEEN} GROUP BY size HAVING c > 1) s on l.size = s.size JOIN dirs d ON d.id = l.dir_id where l.{_SEEN} and l.hash is NULL"
+
+# the file in directory path ?3 with basename ?4 and all its seen hardlinks, they share one hash
+_HARDLINKS_OF_FILE_WHERE = f"(dir_id = (SELECT id FROM dirs WHERE path = ?3) AND basename = ?4) OR ({_SEEN} AND (dev, inode) = (SELECT dev, inode FROM files WHERE dir_id = (SELECT id FROM dirs WHERE path = ?3) AND basename = ?4))"
+
+_INDEXES_SQL = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS dirs_path ON dirs (path)",
+    # grouping by size and by hash, finding files of equal size still to be hashed
+    "CREATE INDEX IF NOT EXISTS files_size ON files (size, hash IS NULL)",
+    "CREATE INDEX IF NOT EXISTS files_hash ON files (hash, algo)",
+    # hardlinks and the content identity of renamed files
+    "CREATE INDEX IF NOT EXISTS files_identity ON files (dev, inode, size, mtime_ns)",
+    "CREATE INDEX IF NOT EXISTS files_epoch ON files (epoch)",
+)
+
+_COLUMNS = "dir_id, basename, hash, size, inode, mtime, ctime, head, tail, algo, dev, mtime_ns, epoch"
+
+# a file seen again keeps its hashes, unless it comes with a new hash or its size, inode or mtime changed.
+# Rows that would not change at all are not written
+_KEEP_HASH = "excluded.hash is NULL AND (size, inode, mtime) IS (excluded.size, excluded.inode, excluded.mtime)"
+_CHANGED = """(size, inode, mtime, ctime, dev, mtime_ns, epoch) IS NOT
+    (excluded.size, excluded.inode, excluded.mtime, excluded.ctime, excluded.dev, excluded.mtime_ns, excluded.epoch)
+    OR (excluded.hash is not NULL AND hash IS NOT excluded.hash)"""
+_UPSERT_SQL = f"""
+    ON CONFLICT (dir_id, basename) DO UPDATE SET
+    hash = iif({_KEEP_HASH}, hash, excluded.hash),
+    head = iif({_KEEP_HASH}, head, excluded.head),
+    tail = iif({_KEEP_HASH}, tail, excluded.tail),
+    algo = iif({_KEEP_HASH}, algo, excluded.algo),
+    size = excluded.size, inode = excluded.inode, mtime = excluded.mtime, ctime = excluded.ctime,
+    dev = excluded.dev, mtime_ns = excluded.mtime_ns, epoch = excluded.epoch
+    WHERE {_CHANGED}"""
+
+# dupe_groups holds every hash of the current scan with more than one physical copy. Triggers note
+# the hashes whose files change in dupe_groups_stale, refresh_dupe_groups aggregates just these again
+_STALE_SQL = "INSERT INTO dupe_groups_stale SELECT {0}.hash, {0}.algo WHERE {0}.hash is not NULL AND NOT EXISTS (SELECT 1 FROM dupe_groups_stale WHERE hash = {0}.hash AND algo IS {0}.algo)"
+# no OR IGNORE: the conflict resolution of the statement firing a trigger overrides the one in the trigger
+_GROUP_TRIGGERS_SQL = (
+    f"""CREATE TRIGGER IF NOT EXISTS files_insert_group AFTER INSERT ON files WHEN NEW.hash is not NULL
+    BEGIN {_STALE_SQL.format('NEW')}; END""",
+    f"""CREATE TRIGGER IF NOT EXISTS files_update_group AFTER UPDATE OF hash, algo, size, dev, inode, epoch ON files
+    WHEN OLD.hash is not NULL OR NEW.hash is not NULL
+    BEGIN {_STALE_SQL.format('OLD')}; {_STALE_SQL.format('NEW')}; END""",
+    f"""CREATE TRIGGER IF NOT EXISTS files_delete_group AFTER DELETE ON files WHEN OLD.hash is not NULL
+    BEGIN {_STALE_SQL.format('OLD')}; END""",
+)
+
+
+def _dupe_groups_sql(where: str) -> str:
+    # the groups of the hashes selected by where, wasted are the bytes of all copies but one
+    copies = f"count(DISTINCT {_physical()})"
+    return f"INSERT INTO dupe_groups (hash, algo, count, size, wasted) SELECT hash, algo, {copies}, max(size), ({copies} - 1) * max(size) FROM files WHERE hash is not NULL AND {_SEEN} AND {where} GROUP BY hash, algo HAVING {copies} > 1"
+
+
+# keys that must collide before the next, more expensive hash stage is run
+_STAGE_KEYS: tp.Dict[str, tp.Tuple[str, ...]] = {
+    'head': ('size',),
+    'tail': ('size', 'head'),
+    'hash': ('size', 'head', 'tail'),
+}
+
+
+def _prefix_range(dirname: str) -> tp.Tuple[str, str]:
+    # every path below dirname is >= lower and < upper, '0' follows '/'
+    lower = dirname.rstrip('/') + '/'
+    return lower, lower[:-1] + '0'
+
+
+def _regexp(pattern: str, string: tp.Optional[str]) -> bool:
+    # X REGEXP Y calls regexp(Y, X), re caches the compiled patterns
+    return string is not None and re.search(pattern, string) is not None
+
+
+def _digest(hsh: tp.Union[bytes, str, None]) -> tp.Union[bytes, str, None]:
+    # digests are stored as raw bytes, hex strings that do not convert are kept as they are
+    if isinstance(hsh, str):
+        try:
+            return bytes.fromhex(hsh)
+        except ValueError:
+            return hsh
+    return hsh
+
+
+def _hex(column: str) -> str:
+    # hex of a digest column, for the views
+    return f"iif(typeof({column}) = 'blob', lower(hex({column})), {column})"
+
+
+def _split(filename: str) -> tp.Tuple[str, str]:
+    # directory path and basename of filename
+    dirname, _, basename = str(filename).rpartition('/')
+    return dirname, basename
+
+
+# directories with path ?1 and below, parameters from _subtree_parms
+_SUBTREE_WHERE = "(path = ?1 OR (path >= ?2 AND path < ?3))"
+
+
+def _subtree_parms(dirname: str) -> tp.Tuple[str, str, str]:
+    return (dirname.rstrip('/'),) + _prefix_range(dirname)
+
+
+def _physical(alias: str = "") -> str:
+    # hardlinks share one physical copy, files without known device count on their own
+    a = alias + "." if alias else ""
+    return f"iif({a}dev is NULL, {a}rowid, {a}dev || ':' || {a}inode)"
+
+
+def _colliding_sql(select: str, keys: tp.Tuple[str, ...], where: str) -> str:
+    # rows in groups of equal keys with more than one physical copy and at least one file without full hash
+    group = ", ".join(keys)
+    join = " and ".join("l.size = s.size" if k == 'size' else f"l.{k} is s.{k}" for k in keys)
+    return f"SELECT {select} FROM files l JOIN (SELECT {group} FROM files WHERE {_SEEN} GROUP BY {group} HAVING count(DISTINCT {_physical()}) > 1 AND count(hash) < count(*)) s on {join} JOIN dirs d ON d.id = l.dir_id where l.{_SEEN} and {where}"
+
+
+# one connection per database and thread, reused by every PydupeDB of a run
+_connections = threading.local()
+
+
+def _identity(dbname: str) -> tp.Optional[tuple[int, int]]:
+    # a database file that was deleted or replaced needs a new connection
+    try:
+        stat = os.stat(dbname)
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+def _users(connection: sqlite3.Connection, delta: int = 0) -> int:
+    """ number of PydupeDB contexts of this thread that use connection, changed by delta """
+    users: dict[sqlite3.Connection, int] = _connections.__dict__.setdefault('users', {})
+    count = users.get(connection, 0) + delta
+    if count > 0:
+        users[connection] = count
+    else:
+        users.pop(connection, None)
+    return count
+
+
+def _connect(dbname: str) -> tuple[sqlite3.Connection, bool]:
+    """ returns the connection to dbname of this thread and whether it was newly opened """
+    connections: dict[str, tuple[sqlite3.Connection, tp.Optional[tuple[int, int]]]] = _connections.__dict__.setdefault('connections', {})
+    if dbname in connections:
+        connection, identity = connections[dbname]
+        if identity is not None and identity == _identity(dbname):
+            return connection, False
+        del connections[dbname]
+        if not _users(connection):  # otherwise it is closed when the last one leaves
+            connection.close()
+    connection = sqlite3.connect(dbname, timeout=cnf['DBBUSYTIMEOUT'])
+    connection.row_factory = sqlite3.Row
+    connection.create_function('regexp', 2, _regexp, deterministic=True)
+    # WAL lets readers like lst run while hash writes, NORMAL is still safe with WAL
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.execute(f"PRAGMA cache_size = {-int(cnf['DBCACHESIZE']) // 1024}")
+    connection.execute(f"PRAGMA mmap_size = {int(cnf['DBMMAPSIZE'])}")
+    connections[dbname] = (connection, _identity(dbname))
+    return connection, True
+
+
+def _is_shared(dbname: str, connection: sqlite3.Connection) -> bool:
+    # whether connection is still the one _connect hands out for dbname
+    connections: dict[str, tuple[sqlite3.Connection, tp.Any]] = _connections.__dict__.setdefault('connections', {})
+    return dbname in connections and connections[dbname][0] is connection
+
+
+def _disconnect(dbname: str, connection: sqlite3.Connection) -> None:
+    if _is_shared(dbname, connection):
+        del _connections.connections[dbname]
+        try:
+            connection.execute("PRAGMA optimize")  # keep planner statistics of the indexes up to date
+        except sqlite3.OperationalError:
+            pass  # read-only database
+    connection.close()
+
+
+@atexit.register
+def close_connections() -> None:
+    """ close all connections of this thread, the next PydupeDB opens a new one """
+    connections: dict[str, tuple[sqlite3.Connection, tp.Any]] = _connections.__dict__.setdefault('connections', {})
+    for dbname, (connection, _) in list(connections.items()):
+        _disconnect(dbname, connection)
+    _connections.__dict__.setdefault('users', {}).clear()
+
+
 class PydupeDB(object):
     """
     sqlite3 database class for pydupe. 
@@ -14,102 +223,453 @@ class PydupeDB(object):
 
     PydupeDB context manager opens an implicit transaction and does a default rollback.
     Every change needs to be explicitely comitted!
+
+    All instances for the same database share one connection per thread, which stays open
+    until close_connections(). The schema is set up once, when the connection is opened.
+    Nested contexts share one transaction: only the outermost one rolls back when it is left.
     """
 
     def __init__(self, dbname: p = p.home() / ".pydupe.sqlite"):
         self._dbname = str(dbname)
-        self.connection = sqlite3.connect(self._dbname)
-        self.connection.row_factory = sqlite3.Row
+        self.connection, opened = _connect(self._dbname)
         self.cur = self.connection.cursor()
+        self._dir_ids: tp.Dict[str, int] = {}
+        self._contexts = 0
+        if opened:
+            self.create_tables()
+            self.migrate()
+            self.commit()
+
+    def create_tables(self) -> None:
+        # directories of all files, the root directory '/' has name '' and no parent. scanned marks
+        # the directories below a scanned path, mtime_ns and nentries are their stats at the last scan
         create_table_if_not_exist_sql = """
-                            CREATE TABLE IF NOT EXISTS lookup (
-                            filename TEXT PRIMARY KEY,
-                            hash TEXT,
-                            size INTEGER,
-                            inode INTEGER,
-                            mtime INTEGER,
-                            ctime INTEGER)"""
+                            CREATE TABLE IF NOT EXISTS dirs (
+                            id INTEGER PRIMARY KEY,
+                            parent_id INTEGER REFERENCES dirs(id),
+                            name TEXT NOT NULL,
+                            mtime_ns INTEGER,
+                            nentries INTEGER,
+                            path TEXT,
+                            scanned INTEGER,
+                            UNIQUE (parent_id, name))"""
         self.execute(create_table_if_not_exist_sql)
         create_table_if_not_exist_sql = """
-        CREATE TABLE IF NOT EXISTS permanent (
-                            filename TEXT PRIMARY KEY,
-                            hash TEXT,
+                            CREATE TABLE IF NOT EXISTS files (
+                            dir_id INTEGER NOT NULL REFERENCES dirs(id),
+                            basename TEXT NOT NULL,
+                            hash BLOB,
                             size INTEGER,
                             inode INTEGER,
                             mtime INTEGER,
-                            ctime INTEGER)"""
+                            ctime INTEGER,
+                            head BLOB,
+                            tail BLOB,
+                            algo TEXT,
+                            dev INTEGER,
+                            mtime_ns INTEGER,
+                            epoch INTEGER,
+                            PRIMARY KEY (dir_id, basename))"""
         self.execute(create_table_if_not_exist_sql)
-        self.commit()
+        self.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)")
+        self.execute("CREATE TABLE IF NOT EXISTS dupe_groups (hash BLOB, algo TEXT, count INTEGER, size INTEGER, wasted INTEGER, PRIMARY KEY (hash, algo))")
+        self.execute("CREATE TABLE IF NOT EXISTS dupe_groups_stale (hash BLOB, algo TEXT, PRIMARY KEY (hash, algo))")
+        for trigger_sql in _GROUP_TRIGGERS_SQL:
+            self.execute(trigger_sql)
+        if self.execute("SELECT value FROM meta WHERE name = 'epoch'").fetchone() is None:
+            self.execute("INSERT INTO meta VALUES ('epoch', 1)")
+
+    def create_views(self) -> None:
+        # files of the current scan and files with a hash, with full filenames and hex digests, for reading only
+        for view, where in (('lookup', f"l.{_SEEN}"), ('permanent', "(l.hash is not NULL OR l.head is not NULL)")):
+            create_view_if_not_exist_sql = f"""
+                            CREATE VIEW IF NOT EXISTS {view} AS
+                            SELECT {_FILENAME} AS filename, {_hex('l.hash')} AS hash, l.size, l.inode, l.mtime, l.ctime,
+                                {_hex('l.head')} AS head, {_hex('l.tail')} AS tail, l.algo, l.dev, l.mtime_ns
+                            FROM files l CROSS JOIN dirs d ON d.id = l.dir_id WHERE {where}"""
+            self.execute(create_view_if_not_exist_sql)
+
+    def migrate(self) -> None:
+        """ bring a database written by an older pydupe version up to _SCHEMA_VERSION """
+        version: int = self.execute("PRAGMA user_version").fetchone()[0]
+        tables = {row['name'] for row in self.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        # older versions kept lookup and permanent as tables with the full filename and the sha256 hex digest
+        # in every row. Rows of permanent are merged into files first, then the rows of lookup as seen files
+        if 'lookup' in tables:
+            self.connection.create_function('pydupe_digest', 1, _digest, deterministic=True)
+            dirname_sql = "rtrim(rtrim(t.filename, replace(t.filename, '/', '')), '/')"
+            for table, epoch in (('permanent', 'NULL'), ('lookup', _EPOCH)):
+                for row in self.execute(f"SELECT DISTINCT {dirname_sql} dirname FROM {table} t").fetchall():
+                    self.get_dir_id(row['dirname'], create=True)
+                copy_sql = f"""
+                INSERT INTO files ({_COLUMNS})
+                SELECT d.id, substr(t.filename, length(d.path) + 2), pydupe_digest(t.hash), t.size, t.inode, t.mtime, t.ctime,
+                    NULL, NULL, iif(t.hash is NULL, NULL, 'sha256'), NULL, NULL, {epoch}
+                FROM {table} t JOIN dirs d ON d.path = {dirname_sql} WHERE true {_UPSERT_SQL}"""
+                self.execute(copy_sql)
+                self.execute(f"DROP TABLE {table}")
+        self.create_views()
+        for index_sql in _INDEXES_SQL:
+            self.execute(index_sql)
+        if version < _SCHEMA_VERSION:
+            # dupe groups of the files already hashed
+            self.rebuild_dupe_groups()
+            self.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
 
     def __enter__(self) -> 'PydupeDB' :
+        _users(self.connection, +1)
+        self._contexts += 1
         return self
 
     def __exit__(self, ext_type: tp.Optional[tp.Type[BaseException]], exc_value: tp.Optional[BaseException], traceback: tp.Optional[ty.TracebackType]) -> tp.Optional[bool]:
+        if not self._contexts:
+            return ext_type is None  # closed within the context
         self.cur.close()
-        self.connection.rollback()  # rollback by default!
-        self.connection.close()
+        self._contexts -= 1
+        if not _users(self.connection, -1):
+            self.connection.rollback()  # rollback by default!
+            if not _is_shared(self._dbname, self.connection):
+                self.connection.close()  # the database file was replaced meanwhile
         return ext_type is None
 
-    def parms_insert(self,item: list[fparms]) -> sqlite3.Cursor:
-        list_of_tupls=[(fparm.filename, fparm.hash, fparm.size, fparm.inode, fparm.mtime, fparm.ctime) for fparm in item]
-        insert_sql = "INSERT INTO lookup (filename, hash, size, inode, mtime, ctime) VALUES (?,?,?,?,?,?)"
-        return self.cur.executemany(insert_sql, list_of_tupls) 
+    def parms_insert(self,item: list[fparms], algo: tp.Optional[str] = None) -> tp.Dict[str, int]:
+        """ upsert the stats of files, returns the number of rows inserted, updated and left unchanged """
+        algo = algo or cnf['HASHALGORITHM']
+        list_of_tupls = []
+        for fparm in item:
+            dirname, basename = _split(tp.cast(str, fparm.filename))
+            dir_id = self.get_dir_id(dirname, create=True)
+            list_of_tupls.append((dir_id, basename, _digest(fparm.hash), fparm.size, fparm.inode, fparm.mtime, fparm.ctime, None, None, algo if fparm.hash else None, fparm.dev, fparm.mtime_ns))
+        # a file still known from an earlier scan is marked as seen again. New rows get a rowid above
+        # the largest one, which tells them from the updated ones
+        max_rowid = self.cur.execute("SELECT ifnull(max(rowid), 0) FROM files").fetchone()[0]
+        insert_sql = f"INSERT INTO files ({_COLUMNS}) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,{_EPOCH}) {_UPSERT_SQL}"
+        changed = self.cur.executemany(insert_sql, list_of_tupls).rowcount
+        inserted = self.cur.execute("SELECT count(*) FROM files WHERE rowid > ?", (max_rowid,)).fetchone()[0]
+        return {'inserted': inserted, 'updated': changed - inserted, 'unchanged': len(list_of_tupls) - changed}
+
+    def update_hash(self, list_of_tupl: list[tuple[tp.Optional[bytes],str]], algo: tp.Optional[str] = None)-> sqlite3.Cursor:
+        algo = algo or cnf['HASHALGORITHM']
+        update_sql = "UPDATE files SET hash = ?1, algo = iif(?1 is NULL, algo, ?2) where " + _HARDLINKS_OF_FILE_WHERE
+        return self.cur.executemany(update_sql, ((_digest(hsh), algo) + _split(filename) for hsh, filename in list_of_tupl))
 
-    def update_hash(self, list_of_tupl: list[tuple[tp.Optional[str],str]])-> sqlite3.Cursor:
-        update_sql = "UPDATE lookup SET hash = ? where filename = ?"
-        return self.cur.executemany(update_sql, list_of_tupl)
+    def update_partial_hash(self, stage: str, list_of_tupl: list[tuple[tp.Optional[bytes],str]], algo: tp.Optional[str] = None)-> sqlite3.Cursor:
+        assert stage in ('head', 'tail'), 'stage must be head or tail'
+        algo = algo or cnf['HASHALGORITHM']
+        update_sql = f"UPDATE files SET {stage} = ?1, algo = iif(?1 is NULL, algo, ?2) where " + _HARDLINKS_OF_FILE_WHERE
+        return self.cur.executemany(update_sql, ((_digest(hsh), algo) + _split(filename) for hsh, filename in list_of_tupl))
+
+    def reset_hash_of_other_algorithms(self, algo: str) -> sqlite3.Cursor:
+        # hash, head and tail of a row are always of the same algorithm
+        update_sql = f"UPDATE files SET hash = NULL, head = NULL, tail = NULL, algo = NULL WHERE {_SEEN} and algo is not NULL and algo != ?"
+        return self.cur.execute(update_sql, (algo,))
 
     def get_list_of_equal_sized_files_where_hash_is_NULL(self) -> tp.List[str]:
         # select files with same size with no hash yet
-        get_sql = "SELECT l.filename FROM lookup l JOIN (SELECT size, count(*) c FROM lookup GROUP BY size HAVING c > 1) s on l.size = s.size where l.hash is NULL"
+        get_sql = _EQUAL_SIZED_WHERE_HASH_IS_NULL_SQL
         return [row['filename'] for row in self.cur.execute(get_sql)]
 
-    def get_dupes(self) -> sqlite3.Cursor:
-        get_sql = "SELECT l.filename, l.hash FROM lookup l JOIN (SELECT hash, count(*) c FROM lookup GROUP BY hash HAVING c > 1) h on l.hash = h.hash order by l.hash"
-        return self.cur.execute(get_sql)
+    def create_hash_todo(self, stage: str = 'hash', minsize: int = 0) -> int:
+        """
+        snapshot of files to hash in a temp table, so they can be streamed while lookup is updated.
+        stage 'head' selects files larger than minsize with equal size, 'tail' files with equal size and head,
+        'hash' files with equal size, head and tail that have no full hash yet.
+        Of a set of hardlinks only one filename is selected, update_hash shares its hash with the others.
+        """
+        where = {
+            'head': "l.head is NULL and l.size > ?",
+            'tail': "l.tail is NULL and l.head is not NULL",
+            'hash': "l.hash is NULL",
+        }[stage]
+        self.execute("DROP TABLE IF EXISTS temp.hash_todo")
+        self.execute("CREATE TEMP TABLE hash_todo (id INTEGER PRIMARY KEY, filename TEXT, dev INTEGER, size INTEGER)")
+        colliding_sql = _colliding_sql(f"{_FILENAME} filename, l.dev, l.inode, l.size, {_physical('l')} physical", _STAGE_KEYS[stage], where)
+        # ordered by inode within a device, which roughly follows the on-disk layout and cuts seeks
+        insert_sql = f"INSERT INTO temp.hash_todo (filename, dev, size) SELECT min(filename), dev, size FROM ({colliding_sql}) GROUP BY physical ORDER BY dev, inode"
+        parms = (minsize,) if stage == 'head' else ()
+        count = self.cur.execute(insert_sql, parms).rowcount
+        self.execute("CREATE INDEX temp.hash_todo_dev ON hash_todo (dev, id)")
+        return count
+
+    def get_hash_todo_devices(self, blocksize: tp.Optional[int] = None) -> tp.List[sqlite3.Row]:
+        # files and bytes to read per device in temp.hash_todo, only blocksize bytes per file if given
+        get_sql = "SELECT dev, count(*) files, total(iif(?1 is NULL, size, min(size, ?1))) bytes FROM temp.hash_todo GROUP BY dev"
+        return self.cur.execute(get_sql, (blocksize,)).fetchall()
+
+    def get_pending_bytes(self, stage: str = 'hash') -> int:
+        # bytes that still have to be read for a full hash when the keys of stage collide, hardlinks are read once
+        colliding_sql = _colliding_sql(f"DISTINCT l.size, {_physical('l')}", _STAGE_KEYS[stage], "l.hash is NULL")
+        get_sql = f"SELECT total(size) FROM ({colliding_sql})"
+        return int(self.cur.execute(get_sql).fetchone()[0])
+
+    def iter_hash_todo(self, dev: tp.Optional[int], pagesize: int = 1000) -> tp.Iterator[str]:
+        # page through the files in temp.hash_todo on device dev with an own cursor, self.cur stays free for updates
+        get_sql = "SELECT id, filename FROM temp.hash_todo WHERE dev IS ? AND id > ? ORDER BY id LIMIT ?"
+        last_id = 0
+        while rows := self.connection.execute(get_sql, (dev, last_id, pagesize)).fetchall():
+            for row in rows:
+                yield row['filename']
+            last_id = rows[-1]['id']
+
+    def create_purge_todo(self, which: str) -> int:
+        """
+        snapshot of files to check for existence in a temp table. which 'permanent' selects all files
+        with a hash, 'lookup' the files of the current scan with equal size and no hash yet
+        """
+        where = {
+            'permanent': "l.hash is not NULL OR l.head is not NULL",
+            'lookup': f"l.{_SEEN} and l.hash is NULL and l.size IN (SELECT size FROM files WHERE {_SEEN} GROUP BY size HAVING count(*) > 1)",
+        }[which]
+        self.execute("DROP TABLE IF EXISTS temp.purge_todo")
+        self.execute("CREATE TEMP TABLE purge_todo (id INTEGER PRIMARY KEY, dir_id INTEGER, basename TEXT, filename TEXT, missing INTEGER)")
+        insert_sql = f"INSERT INTO temp.purge_todo (dir_id, basename, filename) SELECT l.dir_id, l.basename, {_FILENAME} FROM files l JOIN dirs d ON d.id = l.dir_id WHERE {where} ORDER BY l.dir_id"
+        count = self.cur.execute(insert_sql).rowcount
+        self.execute("CREATE INDEX temp.purge_todo_dir ON purge_todo (dir_id)")
+        return count
+
+    def get_purge_todo_dirs(self) -> tp.List[str]:
+        get_sql = "SELECT DISTINCT d.path FROM temp.purge_todo t JOIN dirs d ON d.id = t.dir_id ORDER BY d.path"
+        return [row['path'] for row in self.cur.execute(get_sql)]
+
+    def iter_purge_todo(self, pagesize: int = 1000) -> tp.Iterator[tp.List[sqlite3.Row]]:
+        # pages of files in temp.purge_todo with an own cursor, self.cur stays free for updates
+        get_sql = "SELECT id, filename FROM temp.purge_todo WHERE id > ? ORDER BY id LIMIT ?"
+        last_id = 0
+        while rows := self.connection.execute(get_sql, (last_id, pagesize)).fetchall():
+            yield rows
+            last_id = rows[-1]['id']
+
+    def mark_purge_missing(self, ids: tp.Iterable[int]) -> sqlite3.Cursor:
+        update_sql = "UPDATE temp.purge_todo SET missing = 1 WHERE id = ?"
+        return self.cur.executemany(update_sql, ((i,) for i in ids))
+
+    def purge_dir(self, dirname: p, which: str) -> int:
+        """ dirname is gone: removes all its files with one statement, returns the number of files of temp.purge_todo therein """
+        if which == 'lookup':
+            self.delete_dir(dirname)
+        else:
+            delete_sql = f"DELETE FROM files WHERE dir_id IN (SELECT id FROM dirs WHERE {_SUBTREE_WHERE})"
+            self.cur.execute(delete_sql, _subtree_parms(str(dirname)))
+        delete_sql = f"DELETE FROM temp.purge_todo WHERE dir_id IN (SELECT id FROM dirs WHERE {_SUBTREE_WHERE})"
+        return self.cur.execute(delete_sql, _subtree_parms(str(dirname))).rowcount
+
+    def purge_missing_files(self, which: str) -> int:
+        """ removes the files marked missing in temp.purge_todo, returns their number """
+        where = "(dir_id, basename) IN (SELECT dir_id, basename FROM temp.purge_todo WHERE missing)"
+        if which == 'lookup':
+            self._unsee(where, [()])
+        else:
+            self.cur.execute("DELETE FROM files WHERE " + where)
+        return int(self.cur.execute("SELECT count(*) FROM temp.purge_todo WHERE missing").fetchone()[0])
+
+    def refresh_dupe_groups(self) -> int:
+        """ aggregate the groups of the stale hashes again, returns their number """
+        if self.cur.execute("SELECT 1 FROM dupe_groups_stale LIMIT 1").fetchone() is None:
+            return 0  # no write lock needed
+        stale = "(hash, algo) IN (SELECT hash, algo FROM dupe_groups_stale)"
+        self.cur.execute("DELETE FROM dupe_groups WHERE " + stale)
+        self.cur.execute(_dupe_groups_sql(stale))
+        return self.cur.execute("DELETE FROM dupe_groups_stale").rowcount
+
+    def refresh_dupe_groups_if_writable(self) -> bool:
+        """
+        refresh_dupe_groups for readers, in a savepoint that is committed unless an outer transaction is open.
+        A read-only database is left as it is, returns False if its groups may be stale
+        """
+        self.cur.execute("SAVEPOINT refresh_dupe_groups")
+        try:
+            self.refresh_dupe_groups()
+        except sqlite3.OperationalError as e:
+            self.cur.execute("ROLLBACK TO refresh_dupe_groups")
+            self.cur.execute("RELEASE refresh_dupe_groups")
+            if 'readonly' not in str(e):
+                raise
+            return False
+        self.cur.execute("RELEASE refresh_dupe_groups")
+        return True
+
+    def rebuild_dupe_groups(self) -> sqlite3.Cursor:
+        self.cur.execute("DELETE FROM dupe_groups")
+        self.cur.execute("DELETE FROM dupe_groups_stale")
+        return self.cur.execute(_dupe_groups_sql("true"))
+
+    def get_dupe_stats(self) -> sqlite3.Row:
+        # number of groups, their physical copies and the bytes wasted by all copies but one
+        get_sql = "SELECT count(*) groups, total(count) copies, total(wasted) wasted FROM dupe_groups"
+        row: sqlite3.Row = self.cur.execute(get_sql).fetchone()
+        return row
+
+    def get_dupes(self, dirname: tp.Union[None, p, tp.Sequence[p]] = None) -> sqlite3.Cursor:
+        """ the files of all dupe groups ordered by hash, with dirname only the groups with a file below dirname or one of dirnames """
+        # a hash is only a dupe if there is more than one physical copy, not just hardlinks
+        get_sql = f"SELECT {_FILENAME} filename, l.hash, l.size, l.dev, l.inode, l.mtime FROM dupe_groups g JOIN files l on l.hash = g.hash and l.algo = g.algo JOIN dirs d ON d.id = l.dir_id where l.{_SEEN}"
+        if dirname is None:
+            return self.cur.execute(get_sql + " order by g.hash")
+        dirnames = [dirname] if isinstance(dirname, p) else dirname
+        # the parameters of the n-th subtree are numbered from 3 * n + 1
+        subtrees = " OR ".join(re.sub(r"\?(\d)", lambda m: f"?{3 * n + int(m[1])}", _SUBTREE_WHERE.replace('path', 's.path')) for n in range(len(dirnames))) or "false"
+        below = f"SELECT t.hash, t.algo FROM dirs s JOIN files t ON t.dir_id = s.id WHERE ({subtrees}) AND t.hash is not NULL AND t.{_SEEN}"
+        parms = [parm for d in dirnames for parm in _subtree_parms(str(d))]
+        return self.cur.execute(f"{get_sql} and (g.hash, g.algo) IN ({below}) order by g.hash", parms)
+
+    def get_dd3(self, deldir: p, pattern: str, match_deletions: bool = True, dupes_global: bool = False, autoselect: bool = False, keep_order: tp.Optional[tp.Tuple[str, tp.Sequence[tp.Any]]] = None) -> sqlite3.Cursor:
+        """
+        the selection of pydupe.dupetable.dd3 in one statement: filename, hash, size, dev, inode, mtime and whether the
+        file is deleted of every dupe of the groups below deldir. Files below deldir are split by a regex search of pattern
+        in their basename, files outside belong to the groups below deldir only if dupes_global, else deleted is NULL.
+        keep_order are ORDER BY terms over filename, basename and mtime with their parameters numbered from 5:
+        of a group without any file kept, just the first file is kept then.
+        """
+        inside = _SUBTREE_WHERE.replace('path', 'd.path')
+        # the files below deldir matching pattern are deleted (match_deletions) or kept
+        delete = "matched" if match_deletions else "NOT matched"
+        outside = ("0" if match_deletions else "1") if dupes_global else "NULL"
+        # dupes_local: a single match without any file kept is no dupe in the scope of deldir
+        single = "ndel = 1" if match_deletions and not dupes_global else "false"
+        # no group is deleted completely: all are kept, with autoselect all but the first one
+        autoselected = "rank > 1 OR ndel = 1" if autoselect else "true"
+        # the path order
+        keep_order_parms: tp.Tuple[str, tp.Sequence[tp.Any]] = ("replace(filename, '/', char(1))", ())
+        if keep_order is not None:
+            # keep_order selects the file kept, all others are deleted
+            keep_order_parms, autoselected = keep_order, "rank = 1"
+        order, order_parms = keep_order_parms
+        below = f"SELECT t.hash, t.algo FROM dirs s JOIN files t ON t.dir_id = s.id WHERE {_SUBTREE_WHERE.replace('path', 's.path')} AND t.hash is not NULL AND t.{_SEEN}"
+        get_sql = f"""
+            WITH f AS (
+                SELECT {_FILENAME} filename, l.hash, l.size, l.dev, l.inode, l.basename, l.mtime, {inside} inside
+                FROM dupe_groups g JOIN files l on l.hash = g.hash and l.algo = g.algo JOIN dirs d ON d.id = l.dir_id
+                WHERE l.{_SEEN} and (g.hash, g.algo) IN ({below})),
+            r AS (
+                SELECT filename, hash, size, dev, inode, basename, mtime, CASE WHEN inside THEN {delete} ELSE {outside} END deleted
+                FROM (SELECT *, CASE WHEN inside THEN basename REGEXP ?4 END matched FROM f)),
+            s AS (
+                SELECT filename, hash, size, dev, inode, mtime, deleted, sum(deleted) OVER w ndel, sum(NOT deleted) OVER w nkeep,
+                    row_number() OVER (PARTITION BY hash ORDER BY deleted is NULL, {order}) rank
+                FROM r WINDOW w AS (PARTITION BY hash))
+            SELECT filename, hash, size, dev, inode, mtime, CASE WHEN deleted is NULL THEN NULL WHEN nkeep > 0 THEN deleted ELSE NOT ({autoselected}) END deleted
+            FROM s WHERE NOT (nkeep = 0 AND {single}) ORDER BY hash"""
+        return self.cur.execute(get_sql, _subtree_parms(str(deldir)) + (pattern,) + tuple(order_parms))
 
     def delete_dir(self, dirname: p) -> sqlite3.Cursor:
-        dirname_str: str = str(dirname)
-        delete_sql = "DELETE FROM lookup WHERE filename LIKE ?"
-        return self.cur.execute(delete_sql, (dirname_str + '%',))
+        # forget all files below dirname and that its directories were scanned
+        update_sql = f"UPDATE dirs SET mtime_ns = NULL, nentries = NULL, scanned = NULL WHERE {_SUBTREE_WHERE}"
+        self.cur.execute(update_sql, _subtree_parms(str(dirname)))
+        return self._unsee(f"dir_id IN (SELECT id FROM dirs WHERE {_SUBTREE_WHERE})", [_subtree_parms(str(dirname))])
+
+    def _unsee(self, where: str, parms: tp.List[tp.Sequence[tp.Any]]) -> sqlite3.Cursor:
+        # files leave the current scan: the hashed ones are kept as permanent cache, the others deleted
+        self.cur.executemany(f"UPDATE files SET epoch = NULL WHERE {_HASHED} AND {where}", parms)
+        return self.cur.executemany(f"DELETE FROM files WHERE hash is NULL AND head is NULL AND {where}", parms)
+
+    def get_dir_id(self, dirname: str, create: bool = False) -> tp.Optional[int]:
+        path = dirname.rstrip('/')
+        if path in self._dir_ids:
+            return self._dir_ids[path]
+        dir_id: tp.Optional[int]
+        row = self.cur.execute("SELECT id FROM dirs WHERE path = ?", (path,)).fetchone()
+        if row is not None:
+            dir_id = row['id']
+        elif create:
+            parent, _, name = path.rpartition('/')
+            parent_id = self.get_dir_id(parent, create=True) if path else None
+            dir_id = self.cur.execute("INSERT INTO dirs (parent_id, name, path) VALUES (?, ?, ?)", (parent_id, name, path)).lastrowid
+        else:
+            return None
+        assert dir_id is not None
+        self._dir_ids[path] = dir_id
+        return dir_id
+
+    def forget_dir_stats(self, dirname: p) -> sqlite3.Cursor:
+        # directories below dirname are listed again by the next scan, their files stay
+        update_sql = f"UPDATE dirs SET mtime_ns = NULL, nentries = NULL WHERE {_SUBTREE_WHERE}"
+        return self.cur.execute(update_sql, _subtree_parms(str(dirname)))
+
+    def delete_dirs_not_listed(self, dirname: p) -> sqlite3.Cursor:
+        # after a full scan of dirname, the directories below it still without stats were not found: forget their files
+        where = f"{_SUBTREE_WHERE} AND mtime_ns is NULL"
+        self.cur.execute(f"UPDATE dirs SET nentries = NULL, scanned = NULL WHERE {where}", _subtree_parms(str(dirname)))
+        return self._unsee(f"dir_id IN (SELECT id FROM dirs WHERE {where})", [_subtree_parms(str(dirname))])
+
+    def get_dir_mtime_ns(self, dir_id: int) -> tp.Optional[int]:
+        row = self.cur.execute("SELECT mtime_ns FROM dirs WHERE id = ?", (dir_id,)).fetchone()
+        return row['mtime_ns'] if row else None
+
+    def set_dir_stat(self, dir_id: int, mtime_ns: int, nentries: int) -> sqlite3.Cursor:
+        update_sql = "UPDATE dirs SET mtime_ns = ?, nentries = ?, scanned = 1 WHERE id = ?"
+        return self.cur.execute(update_sql, (mtime_ns, nentries, dir_id))
+
+    def get_subdirs(self, dir_id: int) -> tp.List[sqlite3.Row]:
+        # scanned subdirectories only, the others just hold files of permanent
+        get_sql = "SELECT id, name, mtime_ns, nentries FROM dirs WHERE parent_id = ? AND scanned"
+        return self.cur.execute(get_sql, (dir_id,)).fetchall()
+
+    def add_subdir(self, dirname: str) -> int:
+        subdir_id = tp.cast(int, self.get_dir_id(dirname, create=True))
+        self.cur.execute("UPDATE dirs SET scanned = 1 WHERE id = ?", (subdir_id,))
+        return subdir_id
+
+    def delete_unused_dirs(self) -> sqlite3.Cursor:
+        # directories that are not scanned and hold no files, neither directly nor below
+        delete_sql = """
+        WITH RECURSIVE used(id) AS (
+            SELECT dir_id FROM files
+            UNION SELECT id FROM dirs WHERE scanned
+            UNION SELECT dirs.parent_id FROM dirs JOIN used ON dirs.id = used.id WHERE dirs.parent_id is not NULL)
+        DELETE FROM dirs WHERE id NOT IN used"""
+        self._dir_ids.clear()
+        return self.cur.execute(delete_sql)
+
+    def get_files_in_dir(self, dirname: str) -> tp.List[sqlite3.Row]:
+        # files directly in dirname, not in subdirectories
+        get_sql = f"SELECT {_FILENAME} filename, l.size, l.inode, l.mtime, l.ctime, l.dev, l.mtime_ns FROM dirs d JOIN files l ON l.dir_id = d.id WHERE d.path = ? AND l.{_SEEN}"
+        return self.cur.execute(get_sql, (dirname.rstrip('/'),)).fetchall()
+
+    def delete_files_lookup(self, filenames: tp.Iterable[str]) -> sqlite3.Cursor:
+        return self._unsee(_FILE_WHERE, [_split(f) for f in filenames])
 
     def delete_file_lookup(self, filename: p) -> sqlite3.Cursor:
-        delete_sql = "DELETE from lookup where filename is ?"
-        return self.cur.execute(delete_sql, (str(filename),))
+        return self._unsee(_FILE_WHERE, [_split(str(filename))])
 
     def delete_file_permanent(self, filename: p) -> sqlite3.Cursor:
-        delete_sql = "DELETE from permanent where filename is ?"
-        return self.cur.execute(delete_sql, (str(filename),))
+        delete_sql = "DELETE from files where " + _FILE_WHERE
+        return self.cur.execute(delete_sql, _split(str(filename)))
 
     def get_files_in_permanent(self) -> sqlite3.Cursor: 
         get_sql = "SELECT filename FROM permanent"
         return self.cur.execute(get_sql)
 
     def clean_lookup(self) -> sqlite3.Cursor: 
-        get_sql = "DELETE FROM lookup"
-        return self.cur.execute(get_sql)
-
-    def copy_dir_to_table_permanent(self, dirname: p) -> sqlite3.Cursor:
-        assert dirname.is_absolute()
+        # a new epoch empties lookup, without files in lookup no directory can be skipped as unchanged
+        self.execute("UPDATE dirs SET mtime_ns = NULL, nentries = NULL, scanned = NULL")
+        self.execute("UPDATE meta SET value = value + 1 WHERE name = 'epoch'")
+        self.execute("DELETE FROM dupe_groups")
+        self.execute("DELETE FROM dupe_groups_stale")
+        delete_sql = f"DELETE FROM files WHERE epoch < {_EPOCH} AND hash is NULL AND head is NULL"
+        return self.cur.execute(delete_sql)
 
-        dirname_str: str = str(dirname)
-        copy_sql = "REPLACE INTO permanent select * FROM lookup WHERE filename LIKE ? AND hash is not NULL"
-        # permanent is just a cache for already hashed files
-        return self.cur.execute(copy_sql, (dirname_str + '%',))
-
-    def copy_hash_to_table_lookup(self) -> sqlite3.Cursor:
-        updateLookup_sql = """
-        UPDATE lookup
-        SET hash = permanent.hash
-        FROM permanent
+    def copy_hash_of_moved_files(self) -> sqlite3.Cursor:
+        # renamed or moved files: same content identity under another name. Any write changes
+        # mtime_ns, while a rename only moves ctime forward. Anything else is hashed again.
+        update_sql = f"""
+        UPDATE files
+        SET hash = cache.hash,
+            head = cache.head,
+            tail = cache.tail,
+            algo = cache.algo
+        FROM files cache
         WHERE
-            permanent.size = lookup.size AND
-            permanent.inode = lookup.inode AND
-            permanent.ctime = lookup.ctime AND
-            permanent.mtime = lookup.mtime AND
-            permanent.filename = lookup.filename
+            files.{_SEEN} AND
+            files.hash is NULL AND
+            files.head is NULL AND
+            cache.dev = files.dev AND
+            cache.inode = files.inode AND
+            cache.size = files.size AND
+            cache.mtime_ns = files.mtime_ns AND
+            cache.ctime <= files.ctime AND
+            (cache.hash is not NULL OR cache.head is not NULL)
         """
-        return self.cur.execute(updateLookup_sql)
+        return self.cur.execute(update_sql)
 
     def execute(self, sql: str) -> sqlite3.Cursor:
         return self.cur.execute(sql)
@@ -118,17 +678,22 @@ class PydupeDB(object):
         self.connection.commit()
 
     def close(self) -> None:
-        self.connection.close()
+        """ close the connection of this instance unless another context of this thread still uses it """
+        self.cur.close()
+        _users(self.connection, -self._contexts)
+        self._contexts = 0
+        if not _users(self.connection):
+            _disconnect(self._dbname, self.connection)
 
     # for testing only
     def get(self) -> sqlite3.Cursor:
-        get_sql = "SELECT * FROM lookup"
+        get_sql = "SELECT filename, hash, size, inode, mtime, ctime FROM lookup"
         return self.cur.execute(get_sql)
 
     # for testing only
     def get_list_of_files_in_dir(self, dirname: str) -> tp.List[str]:
-        get_sql = "SELECT filename FROM lookup WHERE filename LIKE ?"
-        data_get = self.cur.execute(get_sql, (dirname + '%',))
+        get_sql = f"SELECT {_FILENAME} filename FROM dirs d JOIN files l ON l.dir_id = d.id WHERE {_SUBTREE_WHERE} AND l.{_SEEN} ORDER BY filename"
+        data_get = self.cur.execute(get_sql, _subtree_parms(dirname))
         return [row['filename'] for row in data_get]
 
     # for testing only
@@ -136,11 +701,87 @@ class PydupeDB(object):
         get_sql = "SELECT filename, hash FROM lookup"
         return self.cur.execute(get_sql)
 
-    # for testing only
-    def copy_lookup_to_permanent(self) -> sqlite3.Cursor:
-        get_sql = "REPLACE INTO permanent SELECT * FROM lookup"
-        return self.cur.execute(get_sql)
 
+# a mutation gets the PydupeDB of the writer thread
+Mutation = tp.Callable[[PydupeDB], tp.Any]
+
+
+class DBWriter(object):
+    """
+    the one thread writing to a database. Producers in any thread submit mutations, which run in
+    the order they were submitted and are committed together in transactions of cnf['DBCOMMITSIZE']
+    mutations or after cnf['DBCOMMITSECONDS'] seconds, whatever comes first.
+    use as a context manager, leaving it commits everything submitted and stops the thread:
+        with DBWriter(dbname) as writer:
+            writer.submit(functools.partial(PydupeDB.delete_file_lookup, filename=filename))
+
+    submit returns a future of the result of the mutation, it is done as soon as the mutation ran,
+    flush() waits until it is committed. A failing mutation rolls back the open transaction and
+    stops the writer, its error is raised by every later submit and when leaving the context.
+    """
+
+    def __init__(self, dbname: p = p.home() / ".pydupe.sqlite", commitsize: tp.Optional[int] = None, commitseconds: tp.Optional[float] = None):
+        self._dbname = dbname
+        self._commitsize: int = commitsize or cnf['DBCOMMITSIZE']
+        self._commitseconds: float = cnf['DBCOMMITSECONDS'] if commitseconds is None else commitseconds
+        self._queue: queue.Queue[tp.Optional[tuple[Mutation, concurrent.futures.Future[tp.Any]]]] = queue.Queue(maxsize=cnf['DBWRITERQUEUESIZE'])
+        self._error: tp.Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="pydupe-dbwriter", daemon=True)
+
+    def __enter__(self) -> 'DBWriter':
+        self._thread.start()
+        return self
+
+    def __exit__(self, ext_type: tp.Optional[tp.Type[BaseException]], exc_value: tp.Optional[BaseException], traceback: tp.Optional[ty.TracebackType]) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None and ext_type is None:
+            raise self._error
 
+    def submit(self, mutation: Mutation) -> concurrent.futures.Future[tp.Any]:
+        if self._error is not None:
+            raise self._error
+        future: concurrent.futures.Future[tp.Any] = concurrent.futures.Future()
+        self._queue.put((mutation, future))
+        return future
 
+    def flush(self) -> None:
+        """ wait until everything submitted so far is committed """
+        self.submit(PydupeDB.commit).result()
 
+    def _run(self) -> None:
+        with PydupeDB(self._dbname) as db:
+            uncommitted = 0
+            deadline = 0.0
+            while True:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()) if uncommitted else None)
+                except queue.Empty:
+                    db.commit()
+                    uncommitted = 0
+                    continue
+                if item is None:
+                    break
+                mutation, future = item
+                if self._error is not None:
+                    future.set_exception(self._error)
+                    continue
+                try:
+                    future.set_result(mutation(db))
+                except BaseException as e:
+                    db.connection.rollback()
+                    self._error = e
+                    future.set_exception(e)
+                    continue
+                if not db.connection.in_transaction:
+                    uncommitted = 0
+                    continue
+                uncommitted += 1
+                if uncommitted == 1:
+                    deadline = time.monotonic() + self._commitseconds
+                if uncommitted >= self._commitsize or time.monotonic() >= deadline:
+                    db.commit()
+                    uncommitted = 0
+            if self._error is None:
+                db.commit()
+        close_connections()
@@ -1,4 +1,4 @@
-import copy
+import functools
 import itertools
 import logging
 import re
@@ -15,8 +15,10 @@ from rich.tree import Tree
 
 from pydupe.config import cnf
 from pydupe.console import console
-from pydupe.db import PydupeDB
-from pydupe.lutable import LuTable
+from pydupe.db import DBWriter, PydupeDB
+from pydupe.lutable import CompactLuTable, LuTable, key_str
+from pydupe.policy import KeepPolicy
+from pydupe.rules import DedupeRule
 from pydupe.utils import mytimer
 
 FORMAT = "%(message)s"
@@ -107,66 +109,101 @@ def is_relative_to(parent: p, testfile: p) -> bool:
         return any(cmp)
 
 
-def check_and_autoselect(*, deltable: LuTable[str, p], keeptable: LuTable[str, p], autoselect_pattern: str = ".") -> tuple[LuTable[str, p], LuTable[str, p]]:
+def check_and_autoselect(*, deltable: LuTable[bytes, p], keeptable: LuTable[bytes, p], autoselect_pattern: str = ".", keep: tp.Optional[tp.Callable[[tp.List[p]], p]] = None) -> tuple[LuTable[bytes, p], LuTable[bytes, p]]:
     """
     autoselect filters items that are contained in deltable (marked for deletion) and
     at the same time are not contained in keeptable. This is to avoid a deletion of all
     dupes belonging to one hash. If all items are marked for deletion, pattern matches the first
-    file that should be deleted.
+    file that should be deleted. If keep is given, it chooses the one file to keep instead.
     """
 
     autoselect_pattern_compiled = re.compile(autoselect_pattern)
-    old_deltable: LuTable[str, p] = copy.deepcopy(deltable)
-
-    for hsh in sorted(old_deltable.keys()):
-        if hsh not in keeptable.keys():
-            # all files will be deleted -> move everything to keeptable
-            keeptable.lextend(deltable, hsh)
-            deltable.ldel([hsh])
-            # now check, if one of these files should be deleted nevertheless
-            values = sorted(old_deltable[hsh])
-            for f in values:
-                fname = f.name
-                if autoselect_pattern_compiled.search(fname):
-                    keeptable.discard((hsh, f))
-                    assert len(keeptable[hsh]) > 0
-                    deltable.add((hsh, f))
-                    break
+
+    # only the hashes missing in keeptable are touched, both tables are changed in place
+    for hsh in sorted(deltable.keys() - keeptable.keys()):
+        values = sorted(deltable[hsh])
+        if keep is not None:
+            kept = keep(values)
+            deltable.discard((hsh, kept))
+            keeptable.add((hsh, kept))
+            continue
+        # all files will be deleted -> move everything to keeptable
+        del deltable[hsh]
+        # now check, if one of these files should be deleted nevertheless
+        selected = next((f for f in values if autoselect_pattern_compiled.search(f.name)), None)
+        keeptable.update_many((hsh, f) for f in values if f != selected)
+        if selected is not None:
+            assert len(values) > 1
+            deltable.add((hsh, selected))
 
     return deltable, keeptable
 
 
-def get_dupes(dbname: p = p.home() / ".pydupe.sqlite") -> LuTable[str, p]:
-    hashlu: LuTable[str, p] = LuTable()
+def _refresh_dupe_groups(db: PydupeDB) -> None:
+    # the writers keep dupe_groups fresh, this only catches up on changes of others and never fails a read
+    if not db.refresh_dupe_groups_if_writable():
+        log.warning("database is read-only, the dupes of files changed since the last hash run may be missing")
+
+
+def _copy(row: tp.Any) -> tp.Tuple[tp.Hashable, int, tp.Optional[float]]:
+    # the physical copy shared by hardlinks, the size and the mtime of a dupe
+    copy = (row['dev'], row['inode']) if row['dev'] is not None else row['filename']
+    return copy, row['size'], row['mtime']
+
+
+def iter_dupe_groups(dbname: p = p.home() / ".pydupe.sqlite", deldir: tp.Union[None, p, tp.Sequence[p]] = None, copies: tp.Optional[tp.Dict[str, tp.Tuple[tp.Hashable, int, tp.Optional[float]]]] = None) -> tp.Iterator[tp.Tuple[bytes, tp.List[p]]]:
+    """
+    yields the dupes group by group from the cursor ordered by hash. With deldir only the groups
+    with a file below deldir, or below one of several deldirs, are read. If copies is given, it is filled with the physical copy
+    (shared by hardlinks), the size and the mtime of every dupe by filename.
+    """
     with PydupeDB(dbname) as db:
-        for row in db.get_dupes():
-            file_as_path = p(row['filename'])
-            hsh: str = row['hash']
-            hashlu.add((hsh, file_as_path))
-    return hashlu
+        _refresh_dupe_groups(db)
+        for hsh, rows in itertools.groupby(db.get_dupes(deldir), key=lambda row: row['hash']):
+            files = []
+            for row in rows:
+                file_as_path = p(row['filename'])
+                files.append(file_as_path)
+                if copies is not None:
+                    copies[row['filename']] = _copy(row)
+            yield hsh, files
+
+
+def get_dupes(dbname: p = p.home() / ".pydupe.sqlite", copies: tp.Optional[tp.Dict[str, tp.Tuple[tp.Hashable, int, tp.Optional[float]]]] = None, deldir: tp.Union[None, p, tp.Sequence[p]] = None, compact: bool = False) -> LuTable[bytes, p]:
+    """
+    if copies is given, it is filled with the physical copy (shared by hardlinks), the size and the mtime of every dupe.
+    compact returns a CompactLuTable, that needs a fraction of the memory for large sets of dupes.
+    """
+    table: tp.Type[LuTable[bytes, p]] = CompactLuTable if compact else LuTable
+    return table.from_groups(iter_dupe_groups(dbname, deldir, copies))
 
 
-def dd3(dupes: LuTable[str, p], *, deldir: p, pattern: str, match_deletions: bool = True, dupes_global: bool = False, autoselect: bool = False) -> tp.Tuple[LuTable[str, p], LuTable[str, p]]:
+def dd3(dupes: LuTable[bytes, p], *, deldir: p, pattern: str, match_deletions: bool = True, dupes_global: bool = False, autoselect: bool = False, keep: tp.Optional[tp.Callable[[tp.List[p]], p]] = None) -> tp.Tuple[LuTable[bytes, p], LuTable[bytes, p]]:
     """
     identify dupes within <deldir> to delete based on <pattern> matching.
     match_deletions: if True (default), matches will be marked for deletion otherwise non-matches will be marked.
     dupes_global: if False(default), at least one dupe will be preserved within deldir,
                         if True, all dupes within deldir will be deleted if at least on dupe exists outside deldir.
     autoselect: if dupes_global is True and no dupe exists outside deldir, autoselect dupes within deldir.
+    keep: chooses the single file kept of the dupes all marked for deletion, like KeepPolicy.choose. Implies autoselect.
     """
     # deldir ist the Directory to investigate
 
     # in_deldir_hashlu and outside_deldir_hashlu separate dupes in deldir from dupes outside deldir
-    in_deldir_hashlu: LuTable[str, p] = LuTable()
-    outside_deldir_hashlu: LuTable[str, p] = LuTable()
+    in_deldir_hashlu: LuTable[bytes, p] = LuTable()
+    outside_deldir_hashlu: LuTable[bytes, p] = LuTable()
     t: mytimer = mytimer()
 
+    in_deldir: tp.List[tp.Tuple[bytes, p]] = []
+    outside_deldir: tp.List[tp.Tuple[bytes, p]] = []
     for hsh, f in dupes:
         if p(f).is_relative_to(deldir):
             #if is_relative_to(parent=p(deldir), testfile=f):
-            in_deldir_hashlu.add((hsh, f))
+            in_deldir.append((hsh, f))
         else:
-            outside_deldir_hashlu.add((hsh, f))
+            outside_deldir.append((hsh, f))
+    in_deldir_hashlu.update_many(in_deldir)
+    outside_deldir_hashlu.update_many(outside_deldir)
     log.debug("done: partition according to "+str(deldir)+" "+t.get)
 
     # delete from outside_deldir_hashlu dupes that are not also in in_deldir_hashlu
@@ -174,21 +211,25 @@ def dd3(dupes: LuTable[str, p], *, deldir: p, pattern: str, match_deletions: boo
     outside_deldir_hashlu.ldel(delitems)
 
     # match_pattern_hashlu and no_match_pattern_hashlu contain matches/no-matches to pattern for files within deldir
-    match_pattern_hashlu: LuTable[str, p] = LuTable()
-    no_match_pattern_hashlu: LuTable[str, p] = LuTable()
+    match_pattern_hashlu: LuTable[bytes, p] = LuTable()
+    no_match_pattern_hashlu: LuTable[bytes, p] = LuTable()
 
     pattern_compiled = re.compile(pattern)
 
+    matches: tp.List[tp.Tuple[bytes, p]] = []
+    no_matches: tp.List[tp.Tuple[bytes, p]] = []
     for hash, f in in_deldir_hashlu:
         if pattern_compiled.search(f.name):
-            match_pattern_hashlu.add((hash, f))
+            matches.append((hash, f))
         else:
-            no_match_pattern_hashlu.add((hash, f))
+            no_matches.append((hash, f))
+    match_pattern_hashlu.update_many(matches)
+    no_match_pattern_hashlu.update_many(no_matches)
     log.debug("done: partition matches "+t.get)
 
     # keeptable and deltable are hash-lookups for files to keep and delete respectively
-    keeptable: LuTable[str, p] = LuTable()
-    deltable: LuTable[str, p] = LuTable()
+    keeptable: LuTable[bytes, p] = LuTable()
+    deltable: LuTable[bytes, p] = LuTable()
 
     # now sort the matches in deltable or keeptable and trat also global dupes
     if match_deletions:
@@ -223,22 +264,58 @@ def dd3(dupes: LuTable[str, p], *, deldir: p, pattern: str, match_deletions: boo
         autoselect_pattern = "a^"  # matches nothing
 
     deltable, keeptable = check_and_autoselect(
-        deltable=deltable, keeptable=keeptable, autoselect_pattern=autoselect_pattern)
+        deltable=deltable, keeptable=keeptable, autoselect_pattern=autoselect_pattern, keep=keep)
 
     log.debug("done: separated into deltable and keeptable "+t.get)
     return deltable, keeptable
 
 
+def dd3_sql(dbname: p = p.home() / ".pydupe.sqlite", *, deldir: p, pattern: str, match_deletions: bool = True, dupes_global: bool = False, autoselect: bool = False, keep_policy: tp.Optional[KeepPolicy] = None, copies: tp.Optional[tp.Dict[str, tp.Tuple[tp.Hashable, int, tp.Optional[float]]]] = None) -> tp.Tuple[LuTable[bytes, p], LuTable[bytes, p]]:
+    """
+    dd3 computed by SQLite from the dupes in dbname, returns (deltable, keeptable).
+    Unlike dd3, autoselect never deletes the single file of a group. keep_policy ranks the files like keep of dd3.
+    If copies is given, it is filled like by iter_dupe_groups for every file of the groups below deldir.
+    """
+    # like dd3, an invalid pattern raises re.error, inside SQLite it would only fail as OperationalError
+    re.compile(pattern)
+    keep: tp.List[tp.Tuple[bytes, p]] = []
+    delete: tp.List[tp.Tuple[bytes, p]] = []
+    t: mytimer = mytimer()
+    with PydupeDB(dbname) as db:
+        _refresh_dupe_groups(db)
+        keep_order = None if keep_policy is None else keep_policy.order_by(5)
+        for row in db.get_dd3(deldir, pattern, match_deletions=match_deletions, dupes_global=dupes_global, autoselect=autoselect, keep_order=keep_order):
+            if copies is not None:
+                copies[row['filename']] = _copy(row)
+            if row['deleted'] is not None:
+                (delete if row['deleted'] else keep).append((row['hash'], p(row['filename'])))
+    # the rows are ordered by hash
+    deltable: LuTable[bytes, p] = LuTable.from_sorted_rows(delete)
+    keeptable: LuTable[bytes, p] = LuTable.from_sorted_rows(keep)
+    log.debug("done: separated into deltable and keeptable by sqlite "+t.get)
+    return deltable, keeptable
+
+
 class Dupes:
 
-    def __init__(self, dbname: p = p.home() / ".pydupe.sqlite") -> None:
-        self.dupes: LuTable[str, p] = get_dupes(dbname)
+    def __init__(self, dbname: p = p.home() / ".pydupe.sqlite", deldir: tp.Optional[p] = None, compact: bool = False) -> None:
+        self._dbname: p = dbname
+        self._compact: bool = compact
+        self._load(deldir)
+
+    def _load(self, deldir: tp.Optional[p]) -> None:
+        # with deldir only the dupe groups touching deldir are read
+        self._loaded_deldir: tp.Optional[p] = deldir
+        self.copies: tp.Dict[str, tp.Tuple[tp.Hashable, int, tp.Optional[float]]] = {}
+        self.dupes: LuTable[bytes, p] = get_dupes(self._dbname, self.copies, deldir, compact=self._compact)
 
     def get_dir_counter(self) -> tp.Counter[str]:
+        # hardlinks within a directory count as one dupe
         alldupes = self.dupes.chain_values()
+        dir_copies = {(str(x.parent), self.copies[str(x)][0] if str(x) in self.copies else x) for x in alldupes}
         dir_counter: tp.Counter[str] = tp.Counter()
-        for x in alldupes:
-            dir_counter.update({str(x.parent): 1})
+        for dirname, _ in dir_copies:
+            dir_counter.update({dirname: 1})
         return dir_counter
 
     def print_most_common(self, depth: int) -> None:
@@ -259,34 +336,56 @@ class Dupetable(Dupes):
     """an instance of this class represents a processed set of dupes separated in files to keep (keeptable)
     and files to delete (deltable). To handle just dupes without separating into keeptable and deltable, this separation is
     postprocessed by method dedupe. if _deduped is True, the postprocessing was done and keeptable and deltable are available.
-    These tables can be extracted by method get_deltable and get_keeptable. Automatic postprocessing can be enabled by the flag dedupe."""
-
-    def __init__(self, *, deldir: p, pattern: str, match_deletions: bool = True, dupes_global: bool = False, autoselect: bool = False, dbname: p = p.home() / ".pydupe.sqlite", dedupe: bool = False) -> None:
-        super().__init__(dbname=dbname)
+    These tables can be extracted by method get_deltable and get_keeptable. Automatic postprocessing can be enabled by the flag dedupe.
+    With sql, the separation is computed by SQLite (dd3_sql) instead of dd3 and the dupes are not loaded, dupes stays empty
+    and copies only holds the files of the groups below deldir. compact keeps the dupes in a CompactLuTable.
+    keep_policy chooses the file kept of dupes all marked for deletion and implies autoselect."""
+
+    def __init__(self, *, deldir: p, pattern: str, match_deletions: bool = True, dupes_global: bool = False, autoselect: bool = False, dbname: p = p.home() / ".pydupe.sqlite", dedupe: bool = False, sql: bool = False, compact: bool = False, keep_policy: tp.Optional[KeepPolicy] = None) -> None:
+        self._sql: bool = sql
+        super().__init__(dbname=dbname, deldir=deldir, compact=compact)
         self._deduped: bool = False
-        self._dbname: p = dbname
         self._deldir: p = deldir
         self._pattern: str = pattern
         self._match_deletions: bool = match_deletions
         self._dupes_global: bool = dupes_global
         self._autoselect: bool = autoselect
-        self._keeptable: LuTable[str, p] = LuTable()
-        self._deltable: LuTable[str, p] = LuTable()
+        self._keep_policy: tp.Optional[KeepPolicy] = keep_policy
+        self._keeptable: LuTable[bytes, p] = LuTable()
+        self._deltable: LuTable[bytes, p] = LuTable()
 
         if dedupe:
             log.debug("start deduping")
             self.dedupe()
 
-    def dedupe(self) -> None:
+    def _load(self, deldir: tp.Optional[p]) -> None:
+        if not self._sql:
+            super()._load(deldir)
+            return
+        # dd3_sql reads the dupes itself
+        self._loaded_deldir = None
+        self.copies = {}
+        self.dupes = CompactLuTable() if self._compact else LuTable()
 
-        self._deltable, self._keeptable = dd3(
-            self.dupes, deldir=self._deldir, pattern=self._pattern, match_deletions=self._match_deletions, dupes_global=self._dupes_global, autoselect=self._autoselect)
+    def dedupe(self) -> None:
+        if self._loaded_deldir is not None and not self._deldir.is_relative_to(self._loaded_deldir):
+            self._load(self._deldir)
+
+        if self._sql:
+            self.copies = {}
+            dedupe = functools.partial(dd3_sql, self._dbname, keep_policy=self._keep_policy, copies=self.copies)
+        elif self._keep_policy is not None:
+            keep = functools.partial(self._keep_policy.choose, mtime=lambda f: self.copies[f][2])
+            dedupe = functools.partial(dd3, self.dupes, keep=keep)
+        else:
+            dedupe = functools.partial(dd3, self.dupes)
+        self._deltable, self._keeptable = dedupe(deldir=self._deldir, pattern=self._pattern, match_deletions=self._match_deletions, dupes_global=self._dupes_global, autoselect=self._autoselect)
         self._deduped = True
 
-    def get_deltable(self) -> LuTable[str, p]:
+    def get_deltable(self) -> LuTable[bytes, p]:
         return self._deltable
 
-    def get_keeptable(self) -> LuTable[str, p]:
+    def get_keeptable(self) -> LuTable[bytes, p]:
         return self._keeptable
 
     def get_tree(self) -> tuple[Tree, int, int]:
@@ -296,7 +395,7 @@ class Dupetable(Dupes):
             "[bold]Dupes Tree [not bold red] red: dupes to be deleted [green] green: dupes to keep")
 
         for hash in self._deltable.keys() | self._keeptable.keys():
-            branch = dupestree.add(hash[:10] + "...")
+            branch = dupestree.add(key_str(hash)[:10] + "...")
 
             if hash in self._deltable.keys():
                 for delfile in self._deltable[hash]:
@@ -307,6 +406,15 @@ class Dupetable(Dupes):
 
         return(dupestree, len(self._deltable), len(self._keeptable))
 
+    def get_reclaimable(self) -> int:
+        """ bytes freed by deleting deltable. A hardlinked file only frees space if all of its links are deleted. """
+        links: tp.Dict[tp.Hashable, tp.Set[str]] = {}
+        for f, (copy, _, _) in self.copies.items():
+            links.setdefault(copy, set()).add(f)
+        deleted = {str(f) for f in self._deltable.chain_values()}
+        freed = {self.copies[f][:2] for f in deleted if f in self.copies and links[self.copies[f][0]] <= deleted}
+        return sum(size for _, size in freed)
+
     def validate(self) -> None:
 
         common = self._keeptable.keys() & self._deltable.keys()
@@ -352,15 +460,61 @@ class Dupetable(Dupes):
             task_move_file_to_trash = progress.add_task(
                 displaytext_plan, total=len(filelist_chunked))
 
-            for chunk in filelist_chunked:
-                with PydupeDB(self._dbname) as db:
+            with DBWriter(self._dbname) as writer:
+                for chunk in filelist_chunked:
                     for delfile in chunk:
                         console.print(move_file_to_trash(
                             file=delfile, trash=trash, delete=delete))
-                        db.delete_file_lookup(filename=delfile)
-                    db.commit()
+                        writer.submit(functools.partial(PydupeDB.delete_file_lookup, filename=delfile))
 
-                progress.update(task_move_file_to_trash, advance=1)
+                    progress.update(task_move_file_to_trash, advance=1)
+                writer.submit(PydupeDB.refresh_dupe_groups)
 
             console.print(displaytext_done +
                           str(len(self._deltable)) + " files\n")
+
+
+class RulesDupetable(Dupetable):
+    """
+    applies several rules, each the arguments of one Dupetable, to one index of dupes read once for all their deldirs.
+    The rules are applied in their order of priority: a file a rule deletes, or keeps below its deldir, is not changed
+    by the later rules. Deletions that would leave no file of a hash are not applied. The result is one deltable and
+    keeptable, they are validated and deleted like those of a Dupetable.
+    """
+
+    def __init__(self, rules: tp.Sequence[DedupeRule], *, dbname: p = p.home() / ".pydupe.sqlite", dedupe: bool = False, compact: bool = False) -> None:
+        self._rules: tp.List[DedupeRule] = list(rules)
+        self._keep_policies: tp.List[tp.Optional[KeepPolicy]] = [None if rule.keep_policy is None else KeepPolicy.parse(rule.keep_policy) for rule in self._rules]
+        super().__init__(deldir=self._rules[0].deldir, pattern=self._rules[0].pattern, dbname=dbname, compact=compact)
+
+        if dedupe:
+            log.debug("start deduping by rules")
+            self.dedupe()
+
+    def _load(self, deldir: tp.Optional[p]) -> None:
+        # the dupe groups touching any deldir, once for all rules
+        self._loaded_deldir = None
+        self.copies = {}
+        self.dupes = get_dupes(self._dbname, self.copies, [rule.deldir for rule in self._rules], compact=self._compact)
+
+    def dedupe(self) -> None:
+        decided: tp.Set[p] = set()
+        deleted: tp.Dict[bytes, tp.Set[p]] = {}
+        t: mytimer = mytimer()
+        for rule, keep_policy in zip(self._rules, self._keep_policies):
+            keep = None if keep_policy is None else functools.partial(keep_policy.choose, mtime=lambda f: self.copies[f][2])
+            deltable, keeptable = dd3(self.dupes, deldir=rule.deldir, pattern=rule.pattern, match_deletions=rule.match_deletions,
+                                      dupes_global=rule.dupes_global, autoselect=rule.autoselect, keep=keep)
+            for hsh in deltable.keys() | keeptable.keys():
+                deletions = {f for f in deltable[hsh] if f not in decided} if hsh in deltable.keys() else set()
+                if deletions and not self.dupes[hsh] - deleted.get(hsh, set()) - deletions:
+                    log.debug(f"rule for {rule.deldir} would delete all dupes of {key_str(hsh)}")
+                    deletions = set()
+                deleted.setdefault(hsh, set()).update(deletions)
+                decided.update(deletions)
+                if hsh in keeptable.keys():
+                    decided.update(f for f in keeptable[hsh] if f.is_relative_to(rule.deldir))
+            log.debug(f"done: rule for {rule.deldir} {t.get}")
+        self._deltable = LuTable.from_groups((hsh, files) for hsh, files in deleted.items() if files)
+        self._keeptable = LuTable.from_groups((hsh, self.dupes[hsh] - files) for hsh, files in deleted.items())
+        self._deduped = True
@@ -1,19 +1,30 @@
+import collections.abc
 import concurrent.futures
+import functools
+import hashlib
+import importlib
 import logging
+import os
 from pathlib import Path as p
 from re import I
+import sqlite3
+from stat import S_ISDIR, S_ISREG
 import subprocess
+import threading
+import time
+import types
 import typing as tp
 
 from more_itertools import chunked
+from rich import filesize
 from rich.logging import RichHandler
 from rich.progress import Progress
 
 from pydupe.config import cnf
 from pydupe.console import console, spinner
-from pydupe.db import PydupeDB
+from pydupe.db import DBWriter, PydupeDB
 from pydupe.utils import mytimer
-from pydupe.data import fparms, from_path
+from pydupe.data import fparms, from_stat
 
 FORMAT = "%(message)s"
 logging.basicConfig(level=cnf['LOGLEVEL'], format=FORMAT, datefmt="[%X]", handlers=[
@@ -21,7 +32,84 @@ logging.basicConfig(level=cnf['LOGLEVEL'], format=FORMAT, datefmt="[%X]", handle
 log = logging.getLogger(__name__)
 
 
-def hash_file(file: str) -> str:
+_buffer = threading.local()
+
+try:
+    _xxhash: tp.Optional[types.ModuleType] = importlib.import_module('xxhash')
+except ImportError:  # optional dependency, pip install xxhash
+    _xxhash = None
+
+
+class HashObject(tp.Protocol):
+    def update(self, data: bytes | memoryview, /) -> None: ...
+    def digest(self) -> bytes: ...
+
+
+HASHALGORITHMS: dict[str, tp.Callable[[], HashObject]] = {
+    'sha256': hashlib.sha256,
+    'blake2b-256': lambda: hashlib.blake2b(digest_size=32),
+    'md5': hashlib.md5,
+}
+if _xxhash is not None:
+    HASHALGORITHMS['xxh128'] = _xxhash.xxh3_128
+
+
+def new_hash(algo: tp.Optional[str] = None) -> HashObject:
+    algo = algo or cnf['HASHALGORITHM']
+    if algo not in HASHALGORITHMS:
+        raise ValueError("hash algorithm not available: " + str(algo))
+    return HASHALGORITHMS[algo]()
+
+
+def _get_buffer() -> memoryview:
+    # one read buffer per hasher thread, reused for every file
+    buf: tp.Optional[memoryview] = getattr(_buffer, 'buf', None)
+    if buf is None or len(buf) != cnf['HASHBUFSIZE']:
+        buf = memoryview(bytearray(cnf['HASHBUFSIZE']))
+        _buffer.buf = buf
+    return buf
+
+
+def hash_file_hashlib(file: str, algo: tp.Optional[str] = None) -> tp.Optional[bytes]:
+    """ hash file in-process. hashlib releases the GIL while hashing, so this scales with threads. None if file cannot be read """
+    hsh = new_hash(algo)
+    buf = _get_buffer()
+    try:
+        with open(file, 'rb', buffering=0) as f:
+            while n := f.readinto(buf):
+                hsh.update(buf[:n])
+    except OSError as e:
+        log.error("Errorcode: "+str(e)+" while hashing "+file)
+        return None
+    return hsh.digest()
+
+
+def _hash_block(file: str, from_end: bool, algo: tp.Optional[str] = None) -> tp.Optional[bytes]:
+    hsh = new_hash(algo)
+    buf = _get_buffer()[:cnf['PARTIALHASHBLOCK']]
+    try:
+        with open(file, 'rb', buffering=0) as f:
+            if from_end:
+                f.seek(max(0, os.fstat(f.fileno()).st_size - len(buf)))
+            n = f.readinto(buf)
+            hsh.update(buf[:n])
+    except OSError as e:
+        log.error("Errorcode: "+str(e)+" while hashing "+file)
+        return None
+    return hsh.digest()
+
+
+def hash_file_head(file: str, algo: tp.Optional[str] = None) -> tp.Optional[bytes]:
+    """ hash of the first cnf['PARTIALHASHBLOCK'] bytes, only comparable between files of equal size """
+    return _hash_block(file, from_end=False, algo=algo)
+
+
+def hash_file_tail(file: str, algo: tp.Optional[str] = None) -> tp.Optional[bytes]:
+    """ hash of the last cnf['PARTIALHASHBLOCK'] bytes, only comparable between files of equal size """
+    return _hash_block(file, from_end=True, algo=algo)
+
+
+def hash_file_subprocess(file: str) -> tp.Optional[bytes]:
     cmd: list[str] = cnf['HASHEXECUTE_1'] + [file]
 
     sub = subprocess.Popen(
@@ -35,75 +123,381 @@ def hash_file(file: str) -> str:
     else:
         hsh = stdout[0:64]
 
-    return hsh
+    return bytes.fromhex(hsh) if hsh else None
+
+
+def hash_file(file: str, algo: tp.Optional[str] = None) -> tp.Optional[bytes]:
+    """ raw digest of file, hex is for display only. None if file cannot be read, the error is logged """
+    algo = algo or cnf['HASHALGORITHM']
+    if cnf['HASHBACKEND'] == 'hashlib':
+        return hash_file_hashlib(file, algo)
+    elif cnf['HASHBACKEND'] == 'subprocess':
+        if algo != 'sha256':
+            raise ValueError("hash backend subprocess supports sha256 only, not " + str(algo))
+        return hash_file_subprocess(file)
+    raise ValueError("unknown hash backend " + str(cnf['HASHBACKEND']))
+
+
+_NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', '9p', 'afs', 'ceph', 'glusterfs', 'fuse.sshfs')
+
+
+@functools.lru_cache(maxsize=None)
+def _mounts() -> dict[int, tuple[str, str]]:
+    """ Linux only: mount point and filesystem type of every device, empty elsewhere """
+    mounts: dict[int, tuple[str, str]] = {}
+    try:
+        with open('/proc/self/mountinfo') as f:
+            for line in f:
+                fields, _, fs = line.partition(' - ')
+                major, minor = fields.split()[2].split(':')
+                mounts.setdefault(os.makedev(int(major), int(minor)), (fields.split()[4], fs.split()[0]))
+    except (OSError, ValueError, IndexError):
+        pass
+    return mounts
+
+
+@functools.lru_cache(maxsize=None)
+def _is_rotational(dev: int) -> bool:
+    """ Linux only: True if dev is on a spinning disk """
+    sysfs = os.path.realpath(f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}")
+    for blockdev in (sysfs, os.path.dirname(sysfs)):  # a partition has no queue of its own
+        try:
+            with open(os.path.join(blockdev, 'queue', 'rotational')) as f:
+                return f.read().strip() == '1'
+        except OSError:
+            continue
+    return False
+
+
+def device_workers(dev: tp.Optional[int]) -> int:
+    """ number of concurrent reads on device dev, see cnf['DEVICEWORKERS'] """
+    default = cnf['HASHWORKERS'] or min(32, (os.cpu_count() or 1) + 4)
+    if dev is None:
+        return default
+    for path, workers in cnf['DEVICEWORKERS'].items():
+        try:
+            if os.stat(path).st_dev == dev:
+                return int(workers)
+        except OSError:
+            continue
+    if _mounts().get(dev, ('', ''))[1] in _NETWORK_FILESYSTEMS:
+        return int(cnf['NETWORKWORKERS'])
+    if _is_rotational(dev):
+        return 1
+    return int(default)
+
+
+def device_name(dev: tp.Optional[int]) -> str:
+    if dev is None:
+        return "unknown device"
+    return _mounts().get(dev, (f"device {os.major(dev)}:{os.minor(dev)}", ''))[0]
+
+def _scan_dir(dirpath: str) -> tuple[list[fparms], list[str]]:
+    """ one directory level: stats of regular files and the subdirectories to descend into """
+    files: list[fparms] = []
+    subdirs: list[str] = []
+    try:
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue                                # do not recurse hidden dirs and hidden files
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):  # only files and no symlink make it into database
+                        files.append(from_stat(entry.path, entry.stat(follow_symlinks=False)))
+                except FileNotFoundError:
+                    pass                                    # vanished while scanning
+    except OSError as e:
+        log.error("Errorcode: "+str(e)+" while scanning "+dirpath)
+    return files, subdirs
+
+
+class DirScan(tp.NamedTuple):
+    path: str
+    mtime_ns: int
+    changed: bool
+    files: list[fparms]
+    subdirs: list[str]
+
+
+def _scan_dir_if_changed(dirpath: str, mtime_ns: tp.Optional[int]) -> tp.Optional[DirScan]:
+    """ stat dirpath and only list it if its mtime differs from mtime_ns. None if dirpath is gone """
+    try:
+        # stat before listing: a change during the listing shows up in the next scan
+        stat = os.stat(dirpath)
+    except OSError as e:
+        log.error("Errorcode: "+str(e)+" while scanning "+dirpath)
+        return None
+    if stat.st_mtime_ns == mtime_ns:
+        return DirScan(dirpath, stat.st_mtime_ns, False, [], [])
+    files, subdirs = _scan_dir(dirpath)
+    return DirScan(dirpath, stat.st_mtime_ns, True, files, subdirs)
+
+
+def _sync_dir(db: PydupeDB, dir_id: int, scan: DirScan) -> tp.Dict[str, int]:
+    """
+    upsert or delete only the rows of files and subdirectories in scan that differ from the database.
+    Returns the number of files inserted, updated and unchanged
+    """
+    stored = {row['filename']: row for row in db.get_files_in_dir(scan.path)}
+    upserts: list[fparms] = []
+    for fp in scan.files:
+        row = stored.pop(tp.cast(str, fp.filename), None)
+        if row is None or (row['size'], row['inode'], row['mtime'], row['ctime'], row['dev'], row['mtime_ns']) != (fp.size, fp.inode, fp.mtime, fp.ctime, fp.dev, fp.mtime_ns):
+            upserts.append(fp)
+    counts = db.parms_insert(upserts)
+    counts['unchanged'] += len(scan.files) - len(upserts)
+    db.delete_files_lookup(stored.keys())
+
+    names = {os.path.basename(subdir) for subdir in scan.subdirs}
+    for row in db.get_subdirs(dir_id):
+        if row['name'] in names:
+            names.remove(row['name'])
+        else:
+            db.delete_dir(p(scan.path) / row['name'])
+    for name in names:
+        db.add_subdir(os.path.join(scan.path, name))
+    db.set_dir_stat(dir_id, scan.mtime_ns, len(scan.files) + len(scan.subdirs))
+    return counts
+
+
+def _start_scan(db: PydupeDB, path: p, incremental: bool) -> tuple[int, tp.Optional[int]]:
+    """ id of the directory path and its mtime of the last scan, None if all directories are listed again """
+    root_id = db.get_dir_id(str(path))
+    if incremental and root_id is not None and db.get_dir_mtime_ns(root_id) is not None:
+        return root_id, db.get_dir_mtime_ns(root_id)
+    # full scan: list every directory again, unchanged rows are not rewritten
+    db.forget_dir_stats(path)
+    return tp.cast(int, db.get_dir_id(str(path), create=True)), None
+
+
+def _write_scan(db: PydupeDB, dir_id: int, dirpath: str, scan: tp.Optional[DirScan]) -> tuple[tp.Dict[str, int], list[sqlite3.Row]]:
+    """ store the scan of dirpath, returns the counts of _sync_dir and the subdirectories to scan next """
+    if scan is None:
+        db.delete_dir(p(dirpath))
+        return {}, []
+    synced = _sync_dir(db, dir_id, scan) if scan.changed else {}
+    return synced, db.get_subdirs(dir_id)
+
 
 @spinner(console, "scan files on disk")
-def scan_files_on_disk_and_insert_stats_in_db(dbname: p, path: p) -> int:
+def scan_files_on_disk_and_insert_stats_in_db(dbname: p, path: p, incremental: bool = False, counts: tp.Optional[tp.Dict[str, int]] = None) -> int:
+    """
+    sync the stats of all files below path into table lookup. Returns the number of files seen.
+    If incremental, only directories whose mtime has changed since the last scan are listed. Note that
+    changing a file in place does not change the mtime of its directory, so such a change goes unnoticed.
+    If counts is given, it is filled with the number of files inserted, updated and unchanged.
+    """
     assert isinstance(path, p), 'must be of type Pathlib.Path'
-    assert path.is_absolute, 'path must be absolute'
+    assert path.is_absolute(), 'path must be absolute'
 
-    with PydupeDB(dbname) as db:
-        filelist = list(path.rglob("*"))
-        list_of_fparms: list[fparms] = []
-        for item in filelist:
-            if item.is_file() and not item.is_symlink():    # only files and no symlink make it into database
-                if "/." in str(item):
-                    pass                                    # do not recurse hidden dirs and hidden files
-                else:
-                    list_of_fparms.append(from_path(item))
-        db.parms_insert(list_of_fparms)
-        db.commit()
+    number_scanned = 0
+    with DBWriter(dbname) as writer, concurrent.futures.ThreadPoolExecutor(max_workers=cnf['SCANWORKERS']) as executor:
+        root_id, root_mtime_ns = writer.submit(functools.partial(_start_scan, path=path, incremental=incremental)).result()
+        # directories are listed by the executor and written by the writer, each goes on with the next one meanwhile
+        pending: dict[concurrent.futures.Future[tp.Any], tuple[str, int, str]] = {
+            executor.submit(_scan_dir_if_changed, str(path), root_mtime_ns): ('list', root_id, str(path))}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                step, dir_id, dirpath = pending.pop(future)
+                if step == 'list':
+                    scan = future.result()
+                    if scan is not None and scan.changed:
+                        number_scanned += len(scan.files)
+                    pending[writer.submit(functools.partial(_write_scan, dir_id=dir_id, dirpath=dirpath, scan=scan))] = ('write', dir_id, dirpath)
+                    continue
+                synced, subdirs = future.result()
+                if counts is not None:
+                    for key, count in synced.items():
+                        counts[key] = counts.get(key, 0) + count
+                for row in subdirs:
+                    subdir = os.path.join(dirpath, row['name'])
+                    pending[executor.submit(_scan_dir_if_changed, subdir, row['mtime_ns'])] = ('list', row['id'], subdir)
+        if root_mtime_ns is None:
+            # full scan: also the directories not reached from path, like those of an older database, are gone
+            writer.submit(functools.partial(PydupeDB.delete_dirs_not_listed, dirname=path))
 
-    return len(list_of_fparms)
+    return number_scanned
 
 
-def rehash_dupes_where_hash_is_NULL(dbname: p) -> int:
+def hash_pipeline(files: tp.Union[tp.Iterable[str], tp.Mapping[tp.Optional[int], tp.Iterable[str]]], write: tp.Callable[[list[tuple[tp.Optional[bytes], str]]], None], *,
+                  hashfunc: tp.Callable[[str], tp.Optional[bytes]] = hash_file, advance: tp.Optional[tp.Callable[[int], None]] = None,
+                  workers: tp.Optional[tp.Mapping[tp.Optional[int], int]] = None, elapsed: tp.Optional[dict[tp.Optional[int], float]] = None) -> int:
+    """
+    stream files through a long-lived pool of hasher threads into a single writer.
+    files is consumed lazily: at most cnf['HASHQUEUESIZE'] files are in flight at any time, so memory stays flat.
+    Results are handed to write in batches of cnf['HASHBATCHSIZE'] (digest, filename) tuples as soon as they are done,
+    there is no barrier waiting for a whole chunk of files. write is only called from the calling thread.
+    files may also map devices to the files on them. Then every device is read in parallel with at most
+    workers[device] files in flight, so a spinning disk is not thrashed while the pool keeps the others busy.
+    A file that hashfunc cannot hash, returning None or raising OSError, is left out and keeps a NULL hash.
+    If given, elapsed is filled with the seconds each device was busy.
+    """
+    number_hashed = 0
+    batch: list[tuple[tp.Optional[bytes], str]] = []
+    if isinstance(files, collections.abc.Mapping):
+        queues = {device: iter(device_files) for device, device_files in files.items()}
+        limits = {device: max(1, (workers or {}).get(device, cnf['HASHQUEUESIZE'])) for device in queues}
+        max_workers = sum(limits.values()) if workers else cnf['HASHWORKERS']
+    else:
+        queues = {None: iter(files)}
+        limits = {None: cnf['HASHQUEUESIZE']}
+        max_workers = cnf['HASHWORKERS']
+    running: tp.Counter[tp.Optional[int]] = tp.Counter()
+    started: dict[tp.Optional[int], float] = {}
 
-    list_of_files_to_update = PydupeDB(
-        dbname).get_list_of_equal_sized_files_where_hash_is_NULL()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight: dict[concurrent.futures.Future[tp.Optional[bytes]], tuple[tp.Optional[int], str]] = {}
+        while True:
+            # producer: top up the bounded queue of every device
+            for device in list(queues):
+                while running[device] < limits[device] and len(in_flight) < cnf['HASHQUEUESIZE']:
+                    try:
+                        file = next(queues[device])
+                    except StopIteration:
+                        del queues[device]
+                        break
+                    in_flight[executor.submit(hashfunc, file)] = (device, file)
+                    running[device] += 1
+                    started.setdefault(device, time.monotonic())
+            if not in_flight:
+                break
 
-    filelist_chunked = list(chunked(list_of_files_to_update, 1000))
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                device, file = in_flight.pop(future)
+                running[device] -= 1
+                if elapsed is not None:
+                    elapsed[device] = time.monotonic() - started[device]
+                try:
+                    hsh = future.result()
+                except OSError as e:
+                    # vanished or unreadable since the scan, its hash stays NULL
+                    log.error("Errorcode: "+str(e)+" while hashing "+file)
+                    continue
+                if hsh is not None:
+                    batch.append((hsh, file))
 
-    with Progress(console=console, auto_refresh=False) as progress:
-        if count := len(filelist_chunked):
-            task_commit = progress.add_task(
-                "[green] hashing and committing to sqlite ...", total=count)
+            # writer: commit in batches while the pool keeps working
+            while len(batch) >= cnf['HASHBATCHSIZE']:
+                chunk, batch = batch[:cnf['HASHBATCHSIZE']], batch[cnf['HASHBATCHSIZE']:]
+                write(chunk)
+                number_hashed += len(chunk)
+                if advance:
+                    advance(len(chunk))
 
-        for chunk in filelist_chunked:
+        if batch:
+            write(batch)
+            number_hashed += len(batch)
+            if advance:
+                advance(len(batch))
 
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                to_do_map = {}
-                for file in chunk:
-                    future = executor.submit(hash_file, file)
-                    to_do_map[future] = file
-                done_iter = concurrent.futures.as_completed(to_do_map)
+    return number_hashed
 
-            with PydupeDB(dbname) as db:
-                hashlist: list[tuple[tp.Optional[str], str]] = []
-                for future in done_iter:
-                    file = to_do_map[future]
-                    try:
-                        hash = future.result()
-                    except Exception as exc:
-                        raise OSError("exception processing file {file}")
 
-                    hashlist.append((hash, file))
-                db.update_hash(hashlist)
-                db.commit()
+def _hash_stage(db: PydupeDB, writer: DBWriter, progress: Progress, stage: str, algo: str) -> int:
+    """ hash the files of stage, db reads the files to hash and writer stores their hashes """
+    hashfunc = {'head': hash_file_head, 'tail': hash_file_tail, 'hash': hash_file}[stage]
+    # digests of another algorithm cannot be compared, these files are hashed again
+    db.reset_hash_of_other_algorithms(algo)
+    count = db.create_hash_todo(stage, minsize=cnf['PARTIALHASHMINSIZE'])
+    db.commit()  # the writer waits for the lock otherwise
+    description = "[green] hashing and committing to sqlite ..." if stage == 'hash' else f"[green] {stage} hashing ..."
+    task_commit = progress.add_task(description, total=count)
 
-                progress.update(task_commit, advance=1)
-                progress.refresh()
+    def write(hashlist: list[tuple[tp.Optional[bytes], str]]) -> None:
+        if stage == 'hash':
+            writer.submit(functools.partial(PydupeDB.update_hash, list_of_tupl=hashlist, algo=algo))
+        else:
+            writer.submit(functools.partial(PydupeDB.update_partial_hash, stage=stage, list_of_tupl=hashlist, algo=algo))
 
-    return len(list_of_files_to_update)
+    def advance(n: int) -> None:
+        progress.update(task_commit, advance=n)
+        progress.refresh()
 
+    devices = db.get_hash_todo_devices(None if stage == 'hash' else cnf['PARTIALHASHBLOCK'])
+    files = {row['dev']: db.iter_hash_todo(row['dev']) for row in devices}
+    workers = {row['dev']: device_workers(row['dev']) for row in devices}
+    elapsed: dict[tp.Optional[int], float] = {}
+    number_hashed = hash_pipeline(files, write, hashfunc=functools.partial(hashfunc, algo=algo), advance=advance, workers=workers, elapsed=elapsed)
+    if stage == 'hash':
+        writer.submit(PydupeDB.refresh_dupe_groups)
+    writer.flush()
 
-def clean(dbname: p) -> None:
-    """ this deletes files in table lookup that are not on disk anymore but would be tried to get rehashed """
+    for row in devices:
+        seconds = elapsed.get(row['dev'], 0.0)
+        rate = filesize.decimal(int(row['bytes'] / seconds)) if seconds else "-"
+        progress.console.print(f"[green] {stage} {device_name(row['dev'])}: {row['files']} files, {filesize.decimal(int(row['bytes']))} in {seconds:.1f} sec, {rate}/s, readers: {workers[row['dev']]}")
+    return number_hashed
+
+
+def prefilter_partial_hashes(dbname: p, algo: tp.Optional[str] = None) -> dict[str, int]:
+    """
+    hash first and last block of large files with equal size. Only files that still collide
+    go on to the next stage, and finally to the full hash. Returns the bytes each stage avoided reading.
+    """
+    algo = algo or cnf['HASHALGORITHM']
+    avoided: dict[str, int] = {}
+    with PydupeDB(dbname) as db, DBWriter(dbname) as writer, Progress(console=console, auto_refresh=False) as progress:
+        pending = db.get_pending_bytes('head')
+        for stage, next_stage in (('head', 'tail'), ('tail', 'hash')):
+            _hash_stage(db, writer, progress, stage, algo)
+            pending_after = db.get_pending_bytes(next_stage)
+            avoided[stage] = pending - pending_after
+            pending = pending_after
+    return avoided
+
+
+def rehash_dupes_where_hash_is_NULL(dbname: p, algo: tp.Optional[str] = None) -> int:
 
-    list_of_files_to_update = PydupeDB(
-        dbname).get_list_of_equal_sized_files_where_hash_is_NULL()
+    algo = algo or cnf['HASHALGORITHM']
+    with PydupeDB(dbname) as db, DBWriter(dbname) as writer, Progress(console=console, auto_refresh=False) as progress:
+        number_hashed = _hash_stage(db, writer, progress, 'hash', algo)
 
+    return number_hashed
+
+
+def _is_missing(path: str, isdir: bool) -> bool:
+    """ whether path is gone or not a directory (isdir) or regular file anymore. Other errors like a missing permission keep it """
+    try:
+        mode = os.stat(path).st_mode
+    except (FileNotFoundError, NotADirectoryError):
+        return True
+    except OSError as e:
+        log.error("Errorcode: "+str(e)+" while checking "+path)
+        return False
+    return not (S_ISDIR(mode) if isdir else S_ISREG(mode))
+
+
+def purge_missing(db: PydupeDB, which: str) -> int:
+    """
+    remove the files that are not on disk anymore, which selects them as in PydupeDB.create_purge_todo.
+    Directories are checked first and a missing one drops its whole subtree with one statement. The files
+    of the others are checked on cnf['PURGEWORKERS'] threads, marked in a temp table and removed at once.
+    Returns the number of files removed.
+    """
+    db.create_purge_todo(which)
+    purged = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=cnf['PURGEWORKERS']) as executor:
+        gone: tp.Optional[str] = None
+        for dirs in chunked(db.get_purge_todo_dirs(), 1000):
+            for dirname, missing in zip(dirs, executor.map(functools.partial(_is_missing, isdir=True), dirs)):
+                # directories are sorted, the subdirectories of a dropped one follow it
+                if missing and not (gone is not None and dirname.startswith(gone + '/')):
+                    purged += db.purge_dir(p(dirname), which)
+                    gone = dirname
+        for page in db.iter_purge_todo():
+            missing_files = executor.map(functools.partial(_is_missing, isdir=False), [row['filename'] for row in page])
+            db.mark_purge_missing(row['id'] for row, missing in zip(page, missing_files) if missing)
+    purged += db.purge_missing_files(which)
+    db.refresh_dupe_groups()
+    return purged
+
+
+def clean(dbname: p) -> None:
+    """ this removes files from lookup that are not on disk anymore but would be tried to get rehashed """
     with PydupeDB(dbname) as db:
-        for file in (p(x) for x in list_of_files_to_update if not p(x).is_file()):
-            db.delete_file_lookup(file)
+        purge_missing(db, 'lookup')
         db.commit()
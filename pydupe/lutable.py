@@ -1,9 +1,15 @@
+import os
+import sys
 import typing as tp
+from array import array
 from collections.abc import Hashable, Iterable
-from itertools import chain
+from itertools import chain, groupby
+from operator import itemgetter
+from pathlib import Path
 
 K = tp.TypeVar('K', bound=tp.Hashable)
 V = tp.TypeVar('V', bound=tp.Hashable)
+T = tp.TypeVar('T', bound='LuTable[tp.Any, tp.Any]')
 
 
 def check_for_hashable_2tuple(x) -> None:  # type: ignore
@@ -26,6 +32,11 @@ def check_argument(x) -> None:  # type: ignore
         raise AssertionError("no Tuple (k,v) of Hashables or Iterable of such Tuples")
 
 
+def key_str(key: tp.Hashable) -> str:
+    # digests are stored as bytes and shown as hex
+    return key.hex() if isinstance(key, bytes) else str(key)
+
+
 class LuTable(tp.Generic[K, V]):
     """
     class used to represent an Lookup Table for File Hashes. This is basically a Dictionary with hashvalue as key and a list of files as values.
@@ -37,12 +48,14 @@ class LuTable(tp.Generic[K, V]):
     https://code.activestate.com/recipes/576694/
 
     A mapping to the hashes is supplied together with set operations for the values. 
+    The number of values is counted on every change, the sets returned by [] must not be changed.
     """
 
     _hashlu: tp.Dict[K, set[V]]
 
     def __init__(self, x: tp.Union[None, tuple[K, V], list[tuple[K, V]]] = None) -> None:
         self._hashlu = {}
+        self._len = 0
         self._ktype = None
         self._vtype = None
         if x:
@@ -68,10 +81,13 @@ class LuTable(tp.Generic[K, V]):
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, LuTable):
             raise NotImplementedError
-        if self._hashlu == other._hashlu:
+        if self._as_dict() == other._as_dict():
             return True
         return False
 
+    def _as_dict(self) -> tp.Dict[K, set[V]]:
+        return self._hashlu
+
     def __contains__(self, item: tuple[K, V]) -> bool:
         check_for_hashable_2tuple(item)
         key = item[0]
@@ -87,7 +103,50 @@ class LuTable(tp.Generic[K, V]):
                 yield hash, file
 
     def __len__(self) -> int:
-        return sum([len(x) for x in self._hashlu.values()])
+        return self._len
+
+    @classmethod
+    def from_groups(cls: type[T], groups: tp.Iterable[tuple[K, tp.Iterable[V]]]) -> T:
+        """ table of (key, values) groups with distinct keys, the types are checked once """
+        lu = cls()
+        for key, values in groups:
+            values = list(values)
+            if values and not lu._ktype:
+                lu._check_types((key, values[0]))
+            lu._extend(key, values)
+        return lu
+
+    @classmethod
+    def from_sorted_rows(cls: type[T], rows: tp.Iterable[tuple[K, V]]) -> T:
+        """ table of (key, value) rows ordered by key, like the rows of a cursor ordered by hash """
+        return cls.from_groups((key, map(itemgetter(1), group)) for key, group in groupby(rows, key=itemgetter(0)))
+
+    def update_many(self, items: tp.Iterable[tuple[K, V]]) -> None:
+        """ add the items, their types are checked for the first one only """
+        checked = False
+        for key, group in groupby(items, key=itemgetter(0)):
+            values = [v for _, v in group]
+            if not checked:
+                self._check_types((key, values[0]))
+                checked = True
+            self._extend(key, values)
+
+    def _check_types(self, item: tuple[K, V]) -> None:
+        check_for_hashable_2tuple(item)
+        if not self._ktype:
+            self._ktype = type(item[0])
+            self._vtype = type(item[1])
+        if self._ktype:
+            assert isinstance(item[0], self._ktype), "adding inconsistent type"
+        if self._vtype:
+            assert isinstance(item[1], self._vtype), "adding inconsistent type"
+
+    def _extend(self, key: K, values: tp.Iterable[V]) -> None:
+        # adds values to key without any checks
+        group = self._hashlu.setdefault(key, set())
+        size = len(group)
+        group.update(values)
+        self._len += len(group) - size
 
     def add(self, item: tuple[K, V]) -> None:
         check_for_hashable_2tuple(item)
@@ -99,7 +158,9 @@ class LuTable(tp.Generic[K, V]):
             assert isinstance(value, self._vtype), "adding inconsistent type"
         if key not in self._hashlu:
             self._hashlu[key] = set()
-        self._hashlu[key].add(value)
+        if value not in self._hashlu[key]:
+            self._hashlu[key].add(value)
+            self._len += 1
 
     def discard(self, x: tuple[K, V]) -> None:
         check_for_hashable_2tuple(x)
@@ -110,6 +171,7 @@ class LuTable(tp.Generic[K, V]):
         if value not in self._hashlu[key]:
             raise ValueError("invalid tuple: value wrong")
         self._hashlu[key].remove(value)
+        self._len -= 1
         if self._hashlu[key] == set():
             self._hashlu.pop(key)
 
@@ -126,6 +188,7 @@ class LuTable(tp.Generic[K, V]):
             if k in self._hashlu.keys():
                 if v not in self._hashlu[k]:
                     self._hashlu[k].add(v)
+                    self._len += 1
 
     def ldel(self, iterable: tp.Optional[tp.Iterable[K]] = None) -> None:
         if iterable is not None:
@@ -142,10 +205,7 @@ class LuTable(tp.Generic[K, V]):
         return chain.from_iterable(self.values())
 
     def lextend(self, other: 'LuTable[K,V]', key: K) -> None:
-        if key not in self._hashlu:
-            self._hashlu[key] = set()
-        for v in other[key]:
-            self._hashlu[key].add(v)
+        self._extend(key, other[key])
 
     def __getitem__(self, key: K) -> set[V]:
         return self._hashlu[key]
@@ -154,19 +214,209 @@ class LuTable(tp.Generic[K, V]):
         assert type(key) == self._ktype, "setting inconsistent key type"
         for v in value:
             assert type(v) == self._vtype, "setting inconsistent value type"
-        self._hashlu[key] = set(value)
+        if key in self._hashlu:
+            del self[key]
+        self._extend(key, value)
 
     def __delitem__(self, key: K) -> None:
-        del self._hashlu[key]
+        self._len -= len(self._hashlu.pop(key))
 
     def as_dict_of_sets(self) -> tp.Dict[str, set[tp.Any]]:
         dict_of_sets: tp.Dict[str, set[tp.Any]] = {}
         for hash in self._hashlu.keys():
-            dict_of_sets[str(hash)] = {item for item in self._hashlu[hash]}
+            dict_of_sets[key_str(hash)] = {item for item in self._hashlu[hash]}
         return dict_of_sets
 
     def as_dict_of_strsets(self) -> tp.Dict[str, set[str]]:
         dict_of_sets: tp.Dict[str, set[tp.Any]] = {}
         for hash in self._hashlu.keys():
-            dict_of_sets[str(hash)] = {str(item) for item in self._hashlu[hash]}
+            dict_of_sets[key_str(hash)] = {str(item) for item in self._hashlu[hash]}
         return dict_of_sets
+
+
+class CompactLuTable(LuTable[K, Path]):
+    """
+    LuTable with the same API for large sets of dupes. The files are kept as basenames in one flat list,
+    with the ids of their interned directories in a parallel array. Every key refers to its group by an
+    offset and a count in two more arrays. Path objects are only created when files are read.
+    Groups are small, so membership is tested by a scan of the group. A group growing while it is not at
+    the end of the list is moved there. When more than half of the files or of the groups are unused,
+    files, groups and directories are compacted, so a table with many deletes stays as small as a new one.
+    """
+
+    def __init__(self, x: tp.Union[None, tuple[K, Path], list[tuple[K, Path]]] = None) -> None:
+        self._index: tp.Dict[K, int] = {}
+        self._start = array('Q')
+        self._count = array('L')
+        self._names: tp.List[str] = []
+        self._parents = array('L')
+        self._dirs: tp.List[str] = []
+        self._dir_ids: tp.Dict[str, int] = {}
+        self._garbage = 0
+        super().__init__(x)
+
+    def _file(self, i: int) -> str:
+        return os.path.join(self._dirs[self._parents[i]], self._names[i])
+
+    def _group(self, key: K) -> tp.List[str]:
+        g = self._index[key]
+        start = self._start[g]
+        return [self._file(i) for i in range(start, start + self._count[g])]
+
+    def _find(self, g: int, file: str) -> int:
+        # position of file in group g or -1
+        dirname, name = os.path.split(file)
+        parent = self._dir_ids.get(dirname)
+        start = self._start[g]
+        for i in range(start, start + self._count[g]):
+            if self._names[i] == name and self._parents[i] == parent:
+                return i
+        return -1
+
+    def _append(self, names: tp.List[str], parents: tp.Sequence[int]) -> None:
+        self._names.extend(names)
+        self._parents.extend(parents)
+
+    def _append_file(self, file: str) -> None:
+        dirname, name = os.path.split(file)
+        self._names.append(name)
+        self._parents.append(self._dir_ids.setdefault(dirname, len(self._dirs)))
+        if len(self._dir_ids) > len(self._dirs):
+            self._dirs.append(dirname)
+
+    def _compact(self) -> None:
+        # copy the groups in use to new lists, unused directories are dropped as well
+        names, parents, dirs, starts, counts = self._names, self._parents, self._dirs, self._start, self._count
+        self._names, self._parents, self._dirs, self._dir_ids = [], array('L'), [], {}
+        self._start, self._count = array('Q'), array('L')
+        for key, g in self._index.items():
+            self._index[key] = len(self._start)
+            self._start.append(len(self._names))
+            self._count.append(counts[g])
+            for i in range(starts[g], starts[g] + counts[g]):
+                self._append_file(os.path.join(dirs[parents[i]], names[i]))
+        self._garbage = 0
+
+    def _compact_if_unused(self) -> None:
+        if self._garbage > len(self._names) // 2 or len(self._start) - len(self._index) > len(self._start) // 2:
+            self._compact()
+
+    def _as_dict(self) -> tp.Dict[K, set[Path]]:
+        return {key: self[key] for key in self._index}
+
+    def __contains__(self, item: tuple[K, Path]) -> bool:
+        check_for_hashable_2tuple(item)
+        return item[0] in self._index and self._find(self._index[item[0]], os.fspath(item[1])) >= 0
+
+    def __iter__(self) -> tp.Iterator[tuple[K, Path]]:
+        for key in self._index:
+            for file in self._group(key):
+                yield key, Path(file)
+
+    def add(self, item: tuple[K, Path]) -> None:
+        check_for_hashable_2tuple(item)
+        key = item[0]
+        value = item[1]
+        if self._ktype:
+            assert isinstance(key, self._ktype), "adding inconsistent type"
+        if self._vtype:
+            assert isinstance(value, self._vtype), "adding inconsistent type"
+        if key not in self._index:
+            if isinstance(key, str):
+                key = tp.cast(K, sys.intern(key))
+            self._index[key] = len(self._start)
+            self._start.append(len(self._names))
+            self._count.append(0)
+        g = self._index[key]
+        file = os.fspath(value)
+        if self._find(g, file) >= 0:
+            return
+        start, count = self._start[g], self._count[g]
+        if start + count != len(self._names):
+            # only the last group can grow in place
+            self._start[g] = len(self._names)
+            self._append(self._names[start:start + count], self._parents[start:start + count])
+            self._garbage += count
+        self._append_file(file)
+        self._count[g] += 1
+        self._len += 1
+        self._compact_if_unused()
+
+    def _extend(self, key: K, values: tp.Iterable[Path]) -> None:
+        if key in self._index:
+            for v in values:
+                self.add((key, v))
+            return
+        # a new group is appended at once
+        files = dict.fromkeys(map(os.fspath, values))
+        self._index[key] = len(self._start)
+        self._start.append(len(self._names))
+        self._count.append(len(files))
+        for file in files:
+            self._append_file(file)
+        self._len += len(files)
+
+    def discard(self, x: tuple[K, Path]) -> None:
+        check_for_hashable_2tuple(x)
+        key = x[0]
+        if key not in self._index:
+            raise ValueError("invalid tuple: key wrong")
+        g = self._index[key]
+        i = self._find(g, os.fspath(x[1]))
+        if i < 0:
+            raise ValueError("invalid tuple: value wrong")
+        # the last file of the group takes the place of the discarded one
+        last = self._start[g] + self._count[g] - 1
+        self._names[i], self._parents[i] = self._names[last], self._parents[last]
+        self._count[g] -= 1
+        self._len -= 1
+        self._garbage += 1
+        if self._count[g] == 0:
+            del self._index[key]
+        self._compact_if_unused()
+
+    def __str__(self) -> str:
+        return(str(self._as_dict()))
+
+    def lor(self, other: LuTable[K, Path]) -> None:
+        for k, v in iter(other):
+            if k in self._index:
+                self.add((k, v))
+
+    def keys(self) -> tp.KeysView[K]:
+        return self._index.keys()
+
+    def values(self) -> tp.ValuesView[set[Path]]:
+        return self._as_dict().values()
+
+    def chain_values(self) -> tp.Iterable[Path]:
+        return (file for _, file in self)
+
+    def lextend(self, other: LuTable[K, Path], key: K) -> None:
+        for v in other[key]:
+            self.add((key, v))
+
+    def __getitem__(self, key: K) -> set[Path]:
+        return {Path(file) for file in self._group(key)}
+
+    def __setitem__(self, key: K, value: tp.Iterable[Path]) -> None:
+        assert type(key) == self._ktype, "setting inconsistent key type"
+        value = list(value)
+        for v in value:
+            assert type(v) == self._vtype, "setting inconsistent value type"
+        if key in self._index:
+            del self[key]
+        for v in value:
+            self.add((key, v))
+
+    def __delitem__(self, key: K) -> None:
+        g = self._index.pop(key)
+        self._len -= self._count[g]
+        self._garbage += self._count[g]
+        self._compact_if_unused()
+
+    def as_dict_of_sets(self) -> tp.Dict[str, set[tp.Any]]:
+        return {key_str(key): files for key, files in self._as_dict().items()}
+
+    def as_dict_of_strsets(self) -> tp.Dict[str, set[str]]:
+        return {key_str(key): set(self._group(key)) for key in self._index}
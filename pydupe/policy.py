@@ -0,0 +1,85 @@
+import re
+import typing as tp
+from pathlib import Path as p
+
+# names given by cameras or by exiftool, starting with a date and a time like 20220131_235959 or 2022-01-31 23.59.59
+EXIF_NAME = r"^(IMG|DSC|PXL|VID)?[_-]?\d{4}[-_:]?\d{2}[-_:]?\d{2}[ _T-]?\d{2}[-_:.]?\d{2}[-_:.]?\d{2}"
+
+RULES = {
+    'oldest': "keep the file with the oldest mtime",
+    'newest': "keep the file with the newest mtime",
+    'shortest': "keep the file with the shortest path",
+    'longest': "keep the file with the longest path",
+    'root:DIR': "keep a file below DIR",
+    'pattern:REGEX': "keep a file whose name matches REGEX",
+    'exif': "keep a file named by date and time like a camera or exiftool does",
+}
+
+
+class KeepPolicy:
+    """
+    ranks the files of a hash group by a list of rules, the first file is kept. Later rules decide only if the
+    earlier ones tie, the path order decides last. The rules use the stats of the database, not the filesystem.
+    The same ranking is given as sort key for python and as ORDER BY terms for sqlite.
+    """
+
+    def __init__(self, rules: tp.Sequence[str]) -> None:
+        self.rules: tp.List[tp.Tuple[str, str]] = []
+        for rule in rules:
+            name, _, arg = rule.partition(':')
+            if name == 'exif' and not arg:
+                name, arg = 'pattern', EXIF_NAME
+            if name in ('oldest', 'newest', 'shortest', 'longest') and not arg:
+                self.rules.append((name, ''))
+            elif name == 'root' and arg:
+                # like deldir, DIR is compared with the absolute paths of the database
+                self.rules.append((name, str(p(arg).resolve()).rstrip('/') + '/'))
+            elif name == 'pattern' and arg:
+                re.compile(arg)
+                self.rules.append((name, arg))
+            else:
+                raise ValueError(f"unknown keep policy rule '{rule}', known are: {', '.join(RULES)}")
+
+    @classmethod
+    def parse(cls, spec: str) -> 'KeepPolicy':
+        """ rules separated by comma like 'root:/photos,oldest' """
+        return cls([rule.strip() for rule in spec.split(',') if rule.strip()])
+
+    def key(self, filename: str, mtime: tp.Optional[float]) -> tp.Tuple[tp.Any, ...]:
+        # the file with the smallest key is kept
+        keys: tp.List[tp.Any] = []
+        for name, arg in self.rules:
+            if name in ('oldest', 'newest'):
+                keys += [mtime is None, 0 if mtime is None else mtime if name == 'oldest' else -mtime]
+            elif name in ('shortest', 'longest'):
+                keys.append(len(filename) if name == 'shortest' else -len(filename))
+            elif name == 'root':
+                keys.append(not filename.startswith(arg))
+            else:
+                keys.append(re.search(arg, p(filename).name) is None)
+        # '/' sorts first like in the path order
+        keys.append(filename.replace('/', '\x01'))
+        return tuple(keys)
+
+    def choose(self, files: tp.Iterable[p], mtime: tp.Callable[[str], tp.Optional[float]]) -> p:
+        """ the file to keep of files, mtime returns the mtime of a filename in the database """
+        return min(files, key=lambda f: self.key(str(f), mtime(str(f))))
+
+    def order_by(self, first: int) -> tp.Tuple[str, tp.List[str]]:
+        """ ORDER BY terms over the columns filename, basename and mtime with parameters numbered from first """
+        terms: tp.List[str] = []
+        parms: tp.List[str] = []
+        for name, arg in self.rules:
+            if name in ('oldest', 'newest'):
+                terms += ["mtime IS NULL", "mtime" if name == 'oldest' else "mtime DESC"]
+            elif name in ('shortest', 'longest'):
+                terms.append("length(filename)" if name == 'shortest' else "length(filename) DESC")
+            elif name == 'root':
+                # the files below the root are >= 'root/' and < 'root0'
+                terms.append(f"NOT (filename >= ?{first + len(parms)} AND filename < ?{first + len(parms) + 1})")
+                parms += [arg, arg[:-1] + '0']
+            else:
+                terms.append(f"NOT (basename REGEXP ?{first + len(parms)})")
+                parms.append(arg)
+        terms.append("replace(filename, '/', char(1))")
+        return ", ".join(terms), parms
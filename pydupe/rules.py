@@ -0,0 +1,52 @@
+import sys
+import typing as tp
+from dataclasses import dataclass, fields
+from pathlib import Path as p
+
+if sys.version_info >= (3, 11):
+    import tomllib
+else:  # a dependency before python 3.11
+    import tomli as tomllib
+
+
+@dataclass(frozen=True, slots=True)
+class DedupeRule:
+    """ the arguments of one pydupe dd call, keep_policy is given as for --keep-policy """
+    deldir: p
+    pattern: str = "."
+    match_deletions: bool = True
+    dupes_global: bool = True
+    autoselect: bool = False
+    keep_policy: tp.Optional[str] = None
+
+
+def load_rules(rulesfile: p) -> tp.List[DedupeRule]:
+    """
+    reads the rules of a TOML file in their order of priority, a rule is a table [[rule]]:
+
+        [[rule]]
+        deldir = "/nas/export1"
+        pattern = "_copy"
+        match_deletions = true
+        dupes_global = true
+        autoselect = false
+        keep_policy = "oldest"
+
+    Only deldir is required, the defaults are those of pydupe dd. A relative deldir is relative to the rules file.
+    """
+    with open(rulesfile, 'rb') as f:
+        content = tomllib.load(f)
+    known = {field.name for field in fields(DedupeRule)}
+    rules: tp.List[DedupeRule] = []
+    for n, entry in enumerate(content.get('rule', []), 1):
+        if unknown := set(entry) - known:
+            raise ValueError(f"rule {n}: unknown keys {', '.join(sorted(unknown))}")
+        if 'deldir' not in entry:
+            raise ValueError(f"rule {n}: deldir is missing")
+        deldir = (p(rulesfile).parent / p(entry['deldir']).expanduser()).resolve()
+        if not deldir.is_dir():
+            raise ValueError(f"rule {n}: {deldir} is no directory")
+        rules.append(DedupeRule(**dict(entry, deldir=deldir)))
+    if not rules:
+        raise ValueError(f"no [[rule]] in {rulesfile}")
+    return rules
@@ -0,0 +1,11 @@
+import typing as tp
+
+import pytest
+from pydupe.db import close_connections
+
+
+@pytest.fixture(autouse=True)
+def fresh_connections() -> tp.Iterator[None]:
+    """ every test opens its databases anew, like a separate run of pydupe """
+    yield
+    close_connections()
@@ -1,11 +1,13 @@
 import os
 from pathlib import Path as p
+import sqlite3
 import tempfile
 import typing as tp
 
 import pydupe.dupetable as dupetable
+from pydupe.lutable import LuTable
 import pytest
-from pydupe.db import PydupeDB
+from pydupe.db import PydupeDB, close_connections
 from pydupe.data import fparms
 
 cwd = str(p.cwd())
@@ -115,3 +117,122 @@ class TestDupetable:
 
         with pytest.raises(dupetable.DupeNotValidated) as execinfo:   
             Dp.validate()    
+
+    def test_read_only_database(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        dbname = p.cwd() / '.dbtest.sqlite'
+        connect = sqlite3.connect
+        close_connections()
+        monkeypatch.setattr(sqlite3, 'connect', lambda name, **kwargs: connect(f"file:{name}?mode=ro", uri=True, **kwargs))
+        # readers do not fail, the groups of the files inserted above are not refreshed
+        assert dupetable.Dupes(dbname=dbname).dupes.as_dict_of_strsets() == {}
+        assert dupetable.Dupetable(dbname=dbname, deldir=p("/tests"), pattern=".", dedupe=True, sql=True).get_deltable().as_dict_of_strsets() == {}
+
+        close_connections()
+        monkeypatch.undo()
+        assert len(dupetable.Dupes(dbname=dbname).dupes) == 4
+        with PydupeDB(dbname) as db:
+            assert db.execute("SELECT count(*) FROM dupe_groups_stale").fetchone()[0] == 0
+
+
+class TestHardlinks:
+
+    def test_hardlinks_are_one_copy(self, tmp_path: p) -> None:
+        dbname = tmp_path / ".dbtest.sqlite"
+        hsh_links = 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6'
+        hsh_dupe = '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0'
+        data = [
+            # hardlinks only, no dupe
+            fparms(filename='/tests/links/a', hash=hsh_links, size=10, inode=1, mtime=0, ctime=0, dev=1),
+            fparms(filename='/tests/links/b', hash=hsh_links, size=10, inode=1, mtime=0, ctime=0, dev=1),
+            # a dupe with two hardlinks
+            fparms(filename='/tests/dupes/a', hash=hsh_dupe, size=100, inode=2, mtime=0, ctime=0, dev=1),
+            fparms(filename='/tests/dupes/b', hash=hsh_dupe, size=100, inode=2, mtime=0, ctime=0, dev=1),
+            fparms(filename='/tests/other/c', hash=hsh_dupe, size=100, inode=3, mtime=0, ctime=0, dev=1)]
+        with PydupeDB(dbname) as db:
+            db.parms_insert(data)
+            db.commit()
+
+        Dp = dupetable.Dupes(dbname=dbname)
+        assert Dp.dupes.as_dict_of_strsets() == {hsh_dupe: {'/tests/dupes/a', '/tests/dupes/b', '/tests/other/c'}}
+        assert Dp.get_dir_counter() == {'/tests/dupes': 1, '/tests/other': 1}
+
+        # deleting one of two hardlinks frees nothing
+        Dt = dupetable.Dupetable(dbname=dbname, deldir=p("/tests/dupes"), pattern="a", dupes_global=True, dedupe=True)
+        assert Dt.get_deltable().as_dict_of_strsets() == {hsh_dupe: {'/tests/dupes/a'}}
+        assert Dt.get_reclaimable() == 0
+        Dt = dupetable.Dupetable(dbname=dbname, deldir=p("/tests/dupes"), pattern=".", dupes_global=True, dedupe=True)
+        assert Dt.get_reclaimable() == 100
+
+        # sqlite selects without loading the dupes, it reads the copies of the groups below deldir only
+        for dupes_global in (True, False):
+            Dt = dupetable.Dupetable(dbname=dbname, deldir=p("/tests/other"), pattern=".", dupes_global=dupes_global, autoselect=True, dedupe=True, sql=True)
+            assert len(Dt.dupes) == 0
+            # dupes_local: a single match without any file kept is no dupe
+            assert set(Dt.copies) == ({'/tests/dupes/a', '/tests/dupes/b', '/tests/other/c'} if dupes_global else set())
+            assert Dt.get_reclaimable() == (100 if dupes_global else 0)
+        Dt = dupetable.Dupetable(dbname=dbname, deldir=p("/tests/dupes"), pattern="a", dupes_global=False, dedupe=True, sql=True)
+        assert Dt.get_deltable().as_dict_of_strsets() == {hsh_dupe: {'/tests/dupes/a'}}
+        assert Dt.get_reclaimable() == 0
+
+
+class TestIterDupeGroups:
+
+    def test_only_groups_touching_deldir_are_read(self, tmp_path: p) -> None:
+        dbname = tmp_path / ".dbtest.sqlite"
+        hsh_inside = 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6'
+        hsh_outside = '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0'
+        data = [
+            fparms(filename='/tests/deldir/a', hash=hsh_inside, size=10, inode=1, mtime=0, ctime=0),
+            fparms(filename='/tests/other/a', hash=hsh_inside, size=10, inode=2, mtime=0, ctime=0),
+            fparms(filename='/tests/deldir2/b', hash=hsh_outside, size=10, inode=3, mtime=0, ctime=0),
+            fparms(filename='/tests/other/b', hash=hsh_outside, size=10, inode=4, mtime=0, ctime=0)]
+        with PydupeDB(dbname) as db:
+            db.parms_insert(data)
+            db.commit()
+
+        groups = list(dupetable.iter_dupe_groups(dbname, deldir=p("/tests/deldir")))
+        assert [(hsh.hex(), sorted(map(str, files))) for hsh, files in groups] == [(hsh_inside, ['/tests/deldir/a', '/tests/other/a'])]
+        assert len(list(dupetable.iter_dupe_groups(dbname))) == 2
+
+        Dt = dupetable.Dupetable(dbname=dbname, deldir=p("/tests/deldir"), pattern=".", dupes_global=True, dedupe=True)
+        assert Dt.dupes.as_dict_of_strsets() == {hsh_inside: {'/tests/deldir/a', '/tests/other/a'}}
+        assert Dt.get_deltable().as_dict_of_strsets() == {hsh_inside: {'/tests/deldir/a'}}
+        # a wider deldir reads the dupes again
+        Dt._deldir = p("/tests")
+        Dt._pattern = "b"
+        Dt.dedupe()
+        assert Dt.dupes.as_dict_of_strsets()[hsh_outside] == {'/tests/deldir2/b', '/tests/other/b'}
+        assert Dt.get_keeptable().as_dict_of_strsets()[hsh_outside] == {'/tests/deldir2/b', '/tests/other/b'}
+
+
+class TestCompactDupes:
+
+    def test_compact_dupes(self, tmp_path: p) -> None:
+        dbname = tmp_path / ".dbtest.sqlite"
+        hsh = 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6'
+        data = [fparms(filename=f'/tests/dir{i % 2}/file{i}', hash=hsh, size=10, inode=i, mtime=0, ctime=0, dev=1) for i in range(5)]
+        with PydupeDB(dbname) as db:
+            db.parms_insert(data)
+            db.commit()
+
+        Dp = dupetable.Dupes(dbname=dbname)
+        Dp_compact = dupetable.Dupes(dbname=dbname, compact=True)
+        assert Dp_compact.dupes == Dp.dupes
+        assert Dp_compact.get_dir_counter() == Dp.get_dir_counter() == {'/tests/dir0': 3, '/tests/dir1': 2}
+        Dt = dupetable.Dupetable(dbname=dbname, deldir=p("/tests/dir1"), pattern=".", dupes_global=True, dedupe=True, compact=True)
+        assert Dt.get_deltable().as_dict_of_strsets() == {hsh: {'/tests/dir1/file1', '/tests/dir1/file3'}}
+        assert Dt.get_reclaimable() == 20
+
+
+class TestCheckAndAutoselect:
+
+    def test_check_and_autoselect(self) -> None:
+        hsh_1, hsh_2, hsh_3 = b'\x01', b'\x02', b'\x03'
+        deltable = LuTable([(hsh_1, p('/a/x')), (hsh_1, p('/a-b/x')), (hsh_1, p('/a/b/y')), (hsh_2, p('/a/z')), (hsh_3, p('/c/w'))])
+        keeptable = LuTable([(hsh_2, p('/b/z'))])
+        deltable_before = deltable
+        d, k = dupetable.check_and_autoselect(deltable=deltable, keeptable=keeptable, autoselect_pattern="x")
+        # the tables are changed in place, the first match in path order is deleted
+        assert d is deltable_before
+        assert d.as_dict_of_strsets() == {'01': {'/a/x'}, '02': {'/a/z'}}
+        assert k.as_dict_of_strsets() == {'01': {'/a-b/x', '/a/b/y'}, '02': {'/b/z'}, '03': {'/c/w'}}
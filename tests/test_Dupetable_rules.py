@@ -0,0 +1,68 @@
+from pathlib import Path as p
+
+import pydupe.dupetable as dupetable
+import pytest
+from pydupe.rules import DedupeRule, load_rules
+
+from tests.test_Dupetable_dedupe_within import setup_database
+
+hsh_1 = 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6'
+hsh_2 = '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0'
+
+
+@pytest.mark.usefixtures("setup_database")
+class TestRulesDupetable:
+
+    def test_rules_in_one_pass(self) -> None:
+        dbname = p.cwd() / ".dbtest.sqlite"
+        rules = [DedupeRule(deldir=p('/tests/tdata/somedir/somedir2')),
+                 DedupeRule(deldir=p('/tests/tdata'), keep_policy='root:/tests/tdata/somedir/somedir2')]
+        Dt = dupetable.RulesDupetable(rules, dbname=dbname, dedupe=True)
+        # the second rule would keep file_is_dupe2, which the first one deleted: it may not delete the other copies
+        assert Dt.get_deltable().as_dict_of_strsets() == {
+            hsh_1: {'/tests/tdata/somedir/somedir2/file_is_dupe2'},
+            hsh_2: {'/tests/tdata/somedir/dupe_in_dir'}}
+        assert Dt.get_keeptable().as_dict_of_strsets() == {
+            hsh_1: {'/tests/tdata/file_exists', '/tests/tdata/somedir/file_is_dupe'},
+            hsh_2: {'/tests/tdata/somedir/dupe2_in_dir'}}
+
+        # a single rule is a Dupetable
+        Dp = dupetable.Dupetable(deldir=p('/tests/tdata/somedir/somedir2'), pattern='.', dupes_global=True, dbname=dbname, dedupe=True)
+        Dt = dupetable.RulesDupetable(rules[:1], dbname=dbname, dedupe=True)
+        assert Dt.get_deltable() == Dp.get_deltable()
+
+    def test_rules_keep_below_deldir(self) -> None:
+        dbname = p.cwd() / ".dbtest.sqlite"
+        # the first rule keeps the files below somedir matching dupe2, the second one would delete them
+        rules = [DedupeRule(deldir=p('/tests/tdata/somedir'), pattern='dupe2', match_deletions=False, dupes_global=False),
+                 DedupeRule(deldir=p('/tests/tdata'), keep_policy='shortest')]
+        Dt = dupetable.RulesDupetable(rules, dbname=dbname, dedupe=True)
+        assert Dt.get_deltable().as_dict_of_strsets() == {
+            hsh_1: {'/tests/tdata/somedir/file_is_dupe'},
+            hsh_2: {'/tests/tdata/somedir/dupe_in_dir'}}
+        assert Dt.get_keeptable().as_dict_of_strsets() == {
+            hsh_1: {'/tests/tdata/file_exists', '/tests/tdata/somedir/somedir2/file_is_dupe2'},
+            hsh_2: {'/tests/tdata/somedir/dupe2_in_dir'}}
+
+    def test_load_rules(self, tmp_path: p) -> None:
+        (tmp_path / 'export1').mkdir()
+        rulesfile = tmp_path / 'rules.toml'
+        rulesfile.write_text("""
+[[rule]]
+deldir = "export1"
+pattern = "_copy"
+
+[[rule]]
+deldir = "%s"
+match_deletions = false
+dupes_global = false
+keep_policy = "oldest"
+""" % tmp_path)
+        assert load_rules(rulesfile) == [
+            DedupeRule(deldir=tmp_path / 'export1', pattern='_copy'),
+            DedupeRule(deldir=tmp_path, match_deletions=False, dupes_global=False, keep_policy='oldest')]
+
+        for content in ['', '[[rule]]\npattern = "a"', '[[rule]]\ndeldir = "missing"', '[[rule]]\ndeldir = "export1"\nunknown = 1', '[[rule]\n']:
+            rulesfile.write_text(content)
+            with pytest.raises(ValueError):
+                load_rules(rulesfile)
@@ -1,3 +1,9 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
 from pathlib import Path as p
 import tempfile
 import typing as tp
@@ -67,7 +73,6 @@ class TestHasher:
         pydupe.hasher.clean(dbname)
         pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path)
         with PydupeDB(dbname) as db:
-            db.copy_dir_to_table_permanent(path_2)
             db.delete_dir(path_2)
             db.commit()
 
@@ -89,36 +94,464 @@ class TestHasher:
         assert data_get_lookup.sort() == data_should_lookup.sort()
         assert data_get_permanent.sort() == data_should_permanent.sort()
 
-    def test_copy_dbcontent_for_dir_to_permanent(self, setup_tmp_path: str) -> None:
+    def test_scan_files_on_disk(self, setup_tmp_path: str) -> None:
         tmpdirname = setup_tmp_path
         dbname = p(tmpdirname + "/.test_Hasher.sqlite")
         path = p(tmpdirname + "/somedir")
-        path_2 = p(tmpdirname + "/somedir/somedir2")
-        path_1 = p(tmpdirname + "/somedir/somefile.txt")
-        pydupe.hasher.clean(dbname)
+        hidden = path / '.hidden'
+        hidden.mkdir()
+        (hidden / 'file_in_hidden_dir').write_text('hidden')
+        (path / 'somedir2' / '.hidden_file').write_text('hidden')
+        (path / 'somedir2' / 'symlink').symlink_to(path / 'somefile.txt')
+        (path / 'dirlink').symlink_to(path / 'somedir2')
+        deep = path / 'a' / 'b' / 'c'
+        deep.mkdir(parents=True)
+        (deep / 'deepfile').write_text('deep')
+
+        number_scanned = pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path)
+
+        data_should = sorted(from_path(item) for item in path.rglob("*")
+                             if item.is_file() and not item.is_symlink() and "/." not in str(item.relative_to(tmpdirname)))
+        with PydupeDB(dbname) as db:
+            data_get = sorted(from_row(d) for d in db.execute("SELECT * FROM lookup"))
+
+        assert number_scanned == 8
+        assert data_get == data_should
+        assert len(data_get) == 8
+
+    def test_scan_incremental(self, setup_tmp_path: str) -> None:
+        tmpdirname = setup_tmp_path
+        dbname = p(tmpdirname + "/.test_Hasher.sqlite")
+        path = p(tmpdirname + "/somedir")
+        path_2 = path / 'somedir2'
+        path_3 = path / 'somedir3'
+        path_3.mkdir()
+        (path_3 / 'file7').write_text('some content 7')
+        for d in (path, path_2, path_3):
+            os.utime(d, ns=(1_000_000_000, 1_000_000_000))  # distinct from any later change
+
+        assert pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path, incremental=True) == 8
+        pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname)
+        with PydupeDB(dbname) as db:
+            data_before = sorted(tuple(row) for row in db.execute("SELECT * FROM lookup"))
+
+        # nothing changed: no directory is listed, nothing is rewritten
+        assert pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path, incremental=True) == 0
+        with PydupeDB(dbname) as db:
+            assert sorted(tuple(row) for row in db.execute("SELECT * FROM lookup")) == data_before
+
+        # new file in somedir2, somedir3 removed: only somedir2 and somedir are listed
+        (path_2 / 'file8').write_text('some content 8')
+        shutil.rmtree(path_3)
+        assert pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path, incremental=True) == 8
+
+        with PydupeDB(dbname) as db:
+            files = sorted(p(row['filename']).relative_to(path).as_posix() for row in db.get())
+            hashes = {row['filename']: row['hash'] for row in db.get_file_hash()}
+        assert files == ['somedir2/file1', 'somedir2/file2', 'somedir2/file3', 'somedir2/file4',
+                         'somedir2/file5', 'somedir2/file6', 'somedir2/file8', 'somefile.txt']
+        assert hashes[str(path_2 / 'file1')] == pydupe.hasher.hash_file(str(path_2 / 'file1')).hex()
+        assert hashes[str(path_2 / 'file8')] is None
+
+        # a full scan lists everything again
+        assert pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path) == 8
+
+    def test_full_rescan_does_not_rewrite_rows(self, setup_tmp_path: str) -> None:
+        tmpdirname = setup_tmp_path
+        dbname = p(tmpdirname + "/.test_Hasher.sqlite")
+        path = p(tmpdirname + "/somedir")
+        counts: tp.Dict[str, int] = {}
+        assert pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path, counts=counts) == 7
+        assert counts == {'inserted': 7, 'updated': 0, 'unchanged': 0}
+        pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname)
+        with PydupeDB(dbname) as db:
+            hashes_before = {row['filename']: row['hash'] for row in db.get_file_hash()}
+
+        (path / 'somedir2' / 'file1').write_text('some content X')
+        counts = {}
+        assert pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path, counts=counts) == 7
+        assert counts == {'inserted': 0, 'updated': 1, 'unchanged': 6}
+        with PydupeDB(dbname) as db:
+            hashes_after = {row['filename']: row['hash'] for row in db.get_file_hash()}
+        assert hashes_after == dict(hashes_before, **{str(path / 'somedir2' / 'file1'): None})
+
+    def test_full_scan_of_migrated_database(self, setup_tmp_path: str) -> None:
+        tmpdirname = setup_tmp_path
+        dbname = p(tmpdirname + "/.test_Hasher.sqlite")
+        path = p(tmpdirname + "/somedir")
+        path_2 = path / 'somedir2'
+        # a database of the baseline schema with the files of path
+        connection = sqlite3.connect(dbname)
+        for table in ('lookup', 'permanent'):
+            connection.execute(
+                f"CREATE TABLE {table} (filename TEXT PRIMARY KEY, hash TEXT, size INTEGER, inode INTEGER, mtime INTEGER, ctime INTEGER)")
+        for item in path.rglob("*"):
+            if item.is_file():
+                fp = from_path(item)
+                connection.execute("INSERT INTO lookup VALUES (?, ?, ?, ?, ?, ?)", (fp.filename, hashlib.sha256(item.read_bytes()).hexdigest(), fp.size, fp.inode, fp.mtime, fp.ctime))
+        connection.commit()
+        connection.close()
+
+        shutil.rmtree(path_2)
+        assert pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path) == 1
+        with PydupeDB(dbname) as db:
+            assert [row['filename'] for row in db.get()] == [str(path / 'somefile.txt')]
+            assert len(db.get_files_in_permanent().fetchall()) == 7
+
+    def test_purge_missing(self, setup_tmp_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+        tmpdirname = setup_tmp_path
+        dbname = p(tmpdirname + "/.test_Hasher.sqlite")
+        path = p(tmpdirname + "/somedir")
+        gone = path / 'gone' / 'sub'
+        gone.mkdir(parents=True)
+        (gone / 'x').write_text('some content x')
+        (gone / 'y').write_text('some content y')
         pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path)
+        assert pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname) == 8
+
+        shutil.rmtree(path / 'gone')
+        (path / 'somedir2' / 'file1').unlink()
+        checked: tp.List[tp.Tuple[str, bool]] = []
+        is_missing = pydupe.hasher._is_missing
+        monkeypatch.setattr(pydupe.hasher, '_is_missing', lambda path, isdir: checked.append((path, isdir)) or is_missing(path, isdir))
         with PydupeDB(dbname) as db:
-            db.copy_dir_to_table_permanent(path)
+            db.clean_lookup()
+            assert pydupe.hasher.purge_missing(db, 'permanent') == 3
             db.commit()
+            data_get = sorted(p(row['filename']).relative_to(path).as_posix() for row in db.get_files_in_permanent())
 
-        data_should_permanent: tp.List[tp.Optional[fparms]] = []
-        for item in path_2.rglob("*"):
-            data_should_permanent.append(from_path(item))
+        assert data_get == ['somedir2/file2', 'somedir2/file3', 'somedir2/file4', 'somedir2/file5', 'somedir2/file6']
+        # the files of a missing directory are not checked one by one
+        assert (str(gone), True) in checked
+        assert [f for f, isdir in checked if not isdir and 'gone' in f] == []
 
-        data_should_lookup: tp.List[tp.Optional[fparms]] = []
-        data_should_lookup.append(from_path(path_1)) 
+    def test_dupe_groups_are_maintained(self, setup_tmp_path: str) -> None:
+        tmpdirname = setup_tmp_path
+        dbname = p(tmpdirname + "/.test_Hasher.sqlite")
+        path = p(tmpdirname + "/somedir")
+        path_2 = path / 'somedir2'
+        (path_2 / 'file7').write_text('some content 1')
+        (path_2 / 'file8').write_text('some content 1')
+        (path_2 / 'file9').write_text('some content 2')
+        os.link(path_2 / 'file3', path_2 / 'hardlink3')
 
-        sql_execute_permanent = "SELECT * FROM permanent"
-        sql_execute_lookup = "SELECT * FROM lookup"
+        def groups() -> tp.List[tp.Tuple[tp.Any, ...]]:
+            with PydupeDB(dbname) as db:
+                return sorted(tuple(row) for row in db.execute("SELECT * FROM dupe_groups"))
 
-        data_get_permanent = [from_row(d) for d in PydupeDB(
-            dbname).execute(sql_execute_permanent).fetchall()]
-        data_get_lookup = [from_row(d) for d in PydupeDB(
-            dbname).execute(sql_execute_lookup).fetchall()]
+        pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path)
+        pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname)
+        maintained = groups()
+        with PydupeDB(dbname) as db:
+            db.rebuild_dupe_groups()
+            db.commit()
+            stats = db.get_dupe_stats()
+        assert maintained == groups()
+        # hardlinks are no dupes
+        assert (stats['groups'], stats['copies'], stats['wasted']) == (2, 5, 3 * 14)
 
-        assert data_get_lookup.sort() == data_should_lookup.sort()
-        assert data_get_permanent.sort() == data_should_permanent.sort()
+        (path_2 / 'file8').unlink()
+        (path_2 / 'file9').unlink()
+        pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path)
+        pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname)
+        maintained = groups()
+        with PydupeDB(dbname) as db:
+            assert db.execute("SELECT count(*) FROM dupe_groups_stale").fetchone()[0] == 0
+            db.rebuild_dupe_groups()
+            db.commit()
+        assert maintained == groups()
+        assert [(row[2], row[4]) for row in maintained] == [(2, 14)]
+
+    def test_scan_incremental_changed_file(self, setup_tmp_path: str) -> None:
+        tmpdirname = setup_tmp_path
+        dbname = p(tmpdirname + "/.test_Hasher.sqlite")
+        path = p(tmpdirname + "/somedir")
+        path_2 = path / 'somedir2'
+        os.utime(path_2, ns=(1_000_000_000, 1_000_000_000))
+        pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path, incremental=True)
+        pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname)
+
+        # replace file1 the way most programs save a file: the directory changes
+        (path_2 / 'file1.tmp').write_text('some other content')
+        (path_2 / 'file1.tmp').replace(path_2 / 'file1')
+        pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path, incremental=True)
+
+        with PydupeDB(dbname) as db:
+            hashes = {row['filename']: row['hash'] for row in db.get_file_hash()}
+        assert hashes[str(path_2 / 'file1')] is None
+        assert hashes[str(path_2 / 'file2')] == pydupe.hasher.hash_file(str(path_2 / 'file2')).hex()
+
+    def test_hash_cache_follows_moved_files(self, setup_tmp_path: str) -> None:
+        tmpdirname = setup_tmp_path
+        dbname = p(tmpdirname + "/.test_Hasher.sqlite")
+        path = p(tmpdirname + "/somedir")
+        path_2 = path / 'somedir2'
+        pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path)
+        assert pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname) == 6
+        with PydupeDB(dbname) as db:
+            hashes_before = {p(row['filename']).name: row['hash'] for row in db.get_file_hash()}
+
+        # rename a directory and a file, change content of another file keeping its size
+        moved = path / 'moved'
+        path_2.rename(moved)
+        (moved / 'file1').rename(moved / 'file1_renamed')
+        (moved / 'file2').write_text('some content X')
+        os.chmod(moved / 'file3', 0o600)
+
+        pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path)
+        with PydupeDB(dbname) as db:
+            db.copy_hash_of_moved_files()
+            db.commit()
+            hashes_after = {p(row['filename']).name: row['hash'] for row in db.get_file_hash()}
+
+        assert hashes_after['file1_renamed'] == hashes_before['file1']
+        assert hashes_after['file2'] is None
+        for f in ('file3', 'file4', 'file5', 'file6'):
+            assert hashes_after[f] == hashes_before[f]
+        assert pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname) == 1
+
+    def test_hash_file_backends_agree(self, setup_tmp_path: str) -> None:
+        path = p(setup_tmp_path + "/somedir")
+        bigfile = path / 'bigfile'
+        bigfile.write_bytes(bytes(range(256)) * 5000)
+        emptyfile = path / 'emptyfile'
+        emptyfile.write_bytes(b'')
+
+        old_bufsize = cnf['HASHBUFSIZE']
+        cnf['HASHBUFSIZE'] = 4096  # force several reads for bigfile
+        try:
+            for item in path.rglob("*"):
+                if item.is_file():
+                    assert pydupe.hasher.hash_file_hashlib(str(item)) == pydupe.hasher.hash_file_subprocess(str(item))
+        finally:
+            cnf['HASHBUFSIZE'] = old_bufsize
+
+        assert pydupe.hasher.hash_file(str(path / 'somefile.txt')) == bytes.fromhex('5fb2054478353fd8d514056d1745b3a9eef066deadda4b90967af7ca65ce6505')
+
+    def test_hash_file_backend_selection(self, setup_tmp_path: str) -> None:
+        somefile = setup_tmp_path + "/somedir/somefile.txt"
+        old_backend = cnf['HASHBACKEND']
+        try:
+            cnf['HASHBACKEND'] = 'subprocess'
+            hsh_subprocess = pydupe.hasher.hash_file(somefile)
+            cnf['HASHBACKEND'] = 'hashlib'
+            hsh_hashlib = pydupe.hasher.hash_file(somefile)
+            cnf['HASHBACKEND'] = 'unknown'
+            with pytest.raises(ValueError):
+                pydupe.hasher.hash_file(somefile)
+        finally:
+            cnf['HASHBACKEND'] = old_backend
+        assert hsh_subprocess == hsh_hashlib
+
+    def test_hash_file_unreadable(self, setup_tmp_path: str) -> None:
+        # an unreadable file is logged and skipped, it gets no hash
+        missing = setup_tmp_path + "/somedir/missing"
+        for file in (missing, setup_tmp_path + "/somedir/somedir2"):
+            assert pydupe.hasher.hash_file(file) is None
+            assert pydupe.hasher.hash_file_head(file) is None
+            assert pydupe.hasher.hash_file_tail(file) is None
+        old_backend = cnf['HASHBACKEND']
+        cnf['HASHBACKEND'] = 'subprocess'
+        try:
+            assert pydupe.hasher.hash_file(missing) is None
+        finally:
+            cnf['HASHBACKEND'] = old_backend
+
+    def test_hash_pipeline(self, setup_tmp_path: str) -> None:
+        path = p(setup_tmp_path + "/somedir/somedir2")
+        files = (str(f) for f in sorted(path.iterdir()))
+        batches: tp.List[tp.List[tp.Tuple[tp.Optional[str], str]]] = []
+
+        old = cnf['HASHQUEUESIZE'], cnf['HASHBATCHSIZE']
+        cnf['HASHQUEUESIZE'], cnf['HASHBATCHSIZE'] = 2, 4
+        try:
+            number_hashed = pydupe.hasher.hash_pipeline(files, lambda batch: batches.append(list(batch)))
+        finally:
+            cnf['HASHQUEUESIZE'], cnf['HASHBATCHSIZE'] = old
+
+        assert number_hashed == 6
+        assert [len(b) for b in batches] == [4, 2]
+        result = dict((f, h) for b in batches for h, f in b)
+        assert result == {str(f): pydupe.hasher.hash_file(str(f)) for f in path.iterdir()}
+
+    def test_hash_pipeline_skips_errors(self, setup_tmp_path: str) -> None:
+        path = p(setup_tmp_path + "/somedir/somedir2")
+        files = sorted(str(f) for f in path.iterdir())
+
+        def hashfunc(file: str) -> tp.Optional[bytes]:
+            if file == files[0]:
+                raise PermissionError("no access")
+            return pydupe.hasher.hash_file(file)
+
+        batches: tp.List[tp.Tuple[tp.Optional[bytes], str]] = []
+        number_hashed = pydupe.hasher.hash_pipeline(files + [str(path / 'missing')], batches.extend, hashfunc=hashfunc)
+        assert number_hashed == 5
+        assert dict((f, h) for h, f in batches) == {f: pydupe.hasher.hash_file(f) for f in files[1:]}
+
+    def test_hash_pipeline_per_device(self, setup_tmp_path: str) -> None:
+        path = p(setup_tmp_path + "/somedir/somedir2")
+        files = sorted(str(f) for f in path.iterdir())
+        lock = threading.Lock()
+        running: tp.Counter[int] = tp.Counter()
+        most_running: tp.Counter[int] = tp.Counter()
+
+        def hashfunc(file: str) -> str:
+            device = 1 if file in files[:4] else 2
+            with lock:
+                running[device] += 1
+                most_running[device] = max(most_running[device], running[device])
+            time.sleep(0.01)
+            with lock:
+                running[device] -= 1
+            return pydupe.hasher.hash_file(file)
+
+        batches: tp.List[tp.Tuple[tp.Optional[str], str]] = []
+        elapsed: tp.Dict[tp.Optional[int], float] = {}
+        number_hashed = pydupe.hasher.hash_pipeline({1: files[:4], 2: files[4:]}, batches.extend, hashfunc=hashfunc,
+                                                    workers={1: 1, 2: 2}, elapsed=elapsed)
+        assert number_hashed == 6
+        assert dict((f, h) for h, f in batches) == {f: pydupe.hasher.hash_file(f) for f in files}
+        assert most_running[1] == 1
+        assert most_running[2] <= 2
+        assert set(elapsed) == {1, 2}
+
+    def test_device_workers(self, setup_tmp_path: str) -> None:
+        dev = os.stat(setup_tmp_path).st_dev
+        old = cnf['DEVICEWORKERS']
+        cnf['DEVICEWORKERS'] = {setup_tmp_path: 3}
+        try:
+            assert pydupe.hasher.device_workers(dev) == 3
+        finally:
+            cnf['DEVICEWORKERS'] = old
+        assert pydupe.hasher.device_workers(dev) >= 1
+        assert pydupe.hasher.device_workers(None) >= 1
+
+    def test_rehash_dupes_where_hash_is_NULL(self, setup_tmp_path: str) -> None:
+        tmpdirname = setup_tmp_path
+        dbname = p(tmpdirname + "/.test_Hasher.sqlite")
+        path = p(tmpdirname + "/somedir")
+        pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path)
+
+        old = cnf['HASHBATCHSIZE']
+        cnf['HASHBATCHSIZE'] = 4
+        try:
+            number_hashed = pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname)
+        finally:
+            cnf['HASHBATCHSIZE'] = old
 
+        assert number_hashed == 6
+        with PydupeDB(dbname) as db:
+            data_get = {row['filename']: row['hash'] for row in db.get_file_hash()}
+        assert data_get[str(path / 'somefile.txt')] is None
+        for f in (path / 'somedir2').iterdir():
+            assert data_get[str(f)] == pydupe.hasher.hash_file(str(f)).hex()
+
+    def test_rehash_file_deleted_after_scan(self, setup_tmp_path: str) -> None:
+        tmpdirname = setup_tmp_path
+        dbname = p(tmpdirname + "/.test_Hasher.sqlite")
+        path = p(tmpdirname + "/somedir/somedir2")
+        pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path)
+        (path / 'file1').unlink()
+
+        assert pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname) == 5
+        with PydupeDB(dbname) as db:
+            data_get = {row['filename']: row['hash'] for row in db.get_file_hash()}
+        assert data_get[str(path / 'file1')] is None
+        for f in path.iterdir():
+            assert data_get[str(f)] == pydupe.hasher.hash_file(str(f)).hex()
+
+    def test_rehash_hardlinks_once(self, setup_tmp_path: str) -> None:
+        tmpdirname = setup_tmp_path
+        dbname = p(tmpdirname + "/.test_Hasher.sqlite")
+        path = p(tmpdirname + "/somedir")
+        path_2 = path / 'somedir2'
+        for i in range(3):
+            os.link(path_2 / 'file1', path_2 / f'file1_link{i}')
+        # hardlinks of a file with a unique size are no dupes and need no hash
+        os.link(path / 'somefile.txt', path / 'somefile_link.txt')
+        pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path)
+
+        assert pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname) == 6
+        with PydupeDB(dbname) as db:
+            data_get = {p(row['filename']).name: row['hash'] for row in db.get_file_hash()}
+            dupes = {p(row['filename']).name for row in db.get_dupes()}
+        for i in range(3):
+            assert data_get[f'file1_link{i}'] == data_get['file1'] == pydupe.hasher.hash_file(str(path_2 / 'file1')).hex()
+        assert data_get['somefile.txt'] is None
+        assert data_get['somefile_link.txt'] is None
+        assert dupes == set()
+
+    def test_prefilter_partial_hashes(self, setup_tmp_path: str) -> None:
+        tmpdirname = setup_tmp_path
+        dbname = p(tmpdirname + "/.test_Hasher.sqlite")
+        path = p(tmpdirname + "/bigfiles")
+        path.mkdir()
+        block = b'x' * 1000
+        (path / 'head_a').write_bytes(b'a' + block * 4)
+        (path / 'head_b').write_bytes(b'b' + block * 4)
+        (path / 'tail_c').write_bytes(block * 4 + b'c')
+        (path / 'tail_d').write_bytes(block * 4 + b'd')
+        (path / 'dupe_e').write_bytes(block * 5)
+        (path / 'dupe_f').write_bytes(block * 5)
+        (path / 'small_g').write_bytes(b'g' * 100)
+        (path / 'small_h').write_bytes(b'h' * 100)
+
+        old = cnf['PARTIALHASHBLOCK'], cnf['PARTIALHASHMINSIZE']
+        cnf['PARTIALHASHBLOCK'], cnf['PARTIALHASHMINSIZE'] = 1000, 1000
+        try:
+            pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path)
+            avoided = pydupe.hasher.prefilter_partial_hashes(dbname)
+            number_hashed = pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname)
+        finally:
+            cnf['PARTIALHASHBLOCK'], cnf['PARTIALHASHMINSIZE'] = old
+
+        assert avoided == {'head': 4001 * 2, 'tail': 4001 * 2}
+        assert number_hashed == 4
+
+        with PydupeDB(dbname) as db:
+            rows = {p(row['filename']).name: row for row in db.execute("SELECT filename, hash, head, tail FROM lookup")}
+        assert rows['head_a']['head'] != rows['head_b']['head']
+        assert rows['head_a']['tail'] is None and rows['head_a']['hash'] is None
+        assert rows['tail_c']['head'] == rows['tail_d']['head']
+        assert rows['tail_c']['tail'] != rows['tail_d']['tail']
+        assert rows['tail_c']['hash'] is None
+        assert rows['dupe_e']['hash'] == rows['dupe_f']['hash'] == pydupe.hasher.hash_file(str(path / 'dupe_e')).hex()
+        assert rows['small_g']['head'] is None
+        assert rows['small_g']['hash'] == pydupe.hasher.hash_file(str(path / 'small_g')).hex()
+
+    def test_hash_algorithms(self, setup_tmp_path: str) -> None:
+        somefile = setup_tmp_path + "/somedir/somefile.txt"
+        # xxh128 is opt-in even if xxhash is installed, the default must not rehash a sha256 database
+        assert cnf['HASHALGORITHM'] == 'sha256'
+        assert pydupe.hasher.hash_file(somefile) == hashlib.sha256(b'sometext').digest()
+        assert pydupe.hasher.hash_file(somefile, 'sha256') == hashlib.sha256(b'sometext').digest()
+        assert pydupe.hasher.hash_file(somefile, 'blake2b-256') == hashlib.blake2b(b'sometext', digest_size=32).digest()
+        assert pydupe.hasher.hash_file(somefile, 'md5') == hashlib.md5(b'sometext').digest()
+        with pytest.raises(ValueError):
+            pydupe.hasher.hash_file(somefile, 'unknown')
+
+    def test_rehash_other_algorithm(self, setup_tmp_path: str) -> None:
+        tmpdirname = setup_tmp_path
+        dbname = p(tmpdirname + "/.test_Hasher.sqlite")
+        path = p(tmpdirname + "/somedir")
+        (path / 'somedir2' / 'file1_cpy').write_text('some content 1')
+        pydupe.hasher.scan_files_on_disk_and_insert_stats_in_db(dbname, path)
+        assert pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname, 'sha256') == 7
+        assert pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname, 'sha256') == 0
+
+        # a file hashed with another algorithm must not hide the dupe
+        with PydupeDB(dbname) as db:
+            db.update_hash([(pydupe.hasher.hash_file(str(path / 'somedir2' / 'file1'), 'md5'), str(path / 'somedir2' / 'file1'))], algo='md5')
+            db.commit()
+        assert pydupe.hasher.rehash_dupes_where_hash_is_NULL(dbname, 'blake2b-256') == 7
+
+        with PydupeDB(dbname) as db:
+            data_get = [dict(row) for row in db.execute("SELECT filename, hash, algo FROM lookup WHERE hash is not NULL")]
+            dupes = [row['filename'] for row in db.get_dupes()]
+        assert {row['algo'] for row in data_get} == {'blake2b-256'}
+        for row in data_get:
+            assert row['hash'] == pydupe.hasher.hash_file(row['filename'], 'blake2b-256').hex()
+        assert sorted(dupes) == [str(path / 'somedir2' / 'file1'), str(path / 'somedir2' / 'file1_cpy')]
 
     def notest_rehash_rows_where_hash_is_NULL(self, setup_tmp_path: str) -> None:
         tmpdirname = setup_tmp_path
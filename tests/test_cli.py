@@ -81,6 +81,42 @@ class TestCLI:
         assert result == {'file1', 'file2',
                           'file3', 'file4', 'file5', 'file6', }
 
+    def test_dd_keep_policy(self, setup_tmp_path: p) -> None:
+        tmpdirname = setup_tmp_path
+        trash = tmpdirname / '.pydupeTrash'
+        runner = CliRunner()
+        result = runner.invoke(cli, ['--dbname', str(tmpdirname / '.testdb.sqlite'),
+                      'dd', '-tr', str(trash), '--do_move', '--keep-policy', 'longest', str(tmpdirname / 'somedir')])
+        assert result.exit_code == 0
+
+        moved = {child.name for child in trash.rglob('*') if child.is_file()}
+        assert moved == {'file1_cpy', 'file2_cpy', 'file3_cpy', 'file4_cpy', 'file5_cpy', 'file6_cpy'}
+
+        result = runner.invoke(cli, ['--dbname', str(tmpdirname / '.testdb.sqlite'),
+                      'dd', '--keep-policy', 'bogus', str(tmpdirname / 'somedir')])
+        assert result.exit_code == 2
+        assert 'unknown keep policy rule' in result.output
+
+    def test_ddrules(self, setup_tmp_path: p) -> None:
+        tmpdirname = setup_tmp_path
+        trash = tmpdirname / '.pydupeTrash'
+        rulesfile = tmpdirname / 'rules.toml'
+        rulesfile.write_text('[[rule]]\ndeldir = "somedir/somedir2"\npattern = "file[12]"\n\n'
+                             '[[rule]]\ndeldir = "somedir"\npattern = "file[1-4]"\nautoselect = true\n')
+        runner = CliRunner()
+        result = runner.invoke(cli, ['--dbname', str(tmpdirname / '.testdb.sqlite'),
+                      'ddrules', '-tr', str(trash), '--do_move', str(rulesfile)])
+        assert result.exit_code == 0
+
+        # file1 and file2 go by the first rule, the second rule must keep their copies
+        moved = {child.name for child in trash.rglob('*') if child.is_file()}
+        assert moved == {'file1', 'file2', 'file3_cpy', 'file4_cpy'}
+
+        rulesfile.write_text('[[rule]]\ndeldir = "somedir"\nkeep_policy = "bogus"\n')
+        result = runner.invoke(cli, ['--dbname', str(tmpdirname / '.testdb.sqlite'), 'ddrules', str(rulesfile)])
+        assert result.exit_code == 2
+        assert 'unknown keep policy rule' in result.output
+
     def test_do_move_with_rename_file_1(self, setup_tmp_path: p) -> None:
         tmpdirname = setup_tmp_path
         trash = tmpdirname / '.pydupeTrash'
@@ -152,6 +188,18 @@ class TestCLI:
         assert result == {'file1', 'file2',
                           'file3', 'file4', 'file5', 'file6', }
 
+    def test_hash_algorithm(self, setup_tmp_path: p) -> None:
+        tmpdirname = setup_tmp_path
+        dbname = tmpdirname / '.testdb.sqlite'
+
+        runner.invoke(cli, ['--dbname', str(dbname), 'hash', '--algorithm', 'blake2b-256', str(tmpdirname)])
+
+        with PydupeDB(dbname) as db:
+            algos = {row['algo'] for row in db.execute("SELECT algo FROM lookup WHERE hash is not NULL")}
+            hashes = {row['hash'] for row in db.get_dupes()}
+        assert algos == {'blake2b-256'}
+        assert len(hashes) == 6
+
     def test_purge(self, setup_tmp_path: p) -> None:
         tmpdirname = setup_tmp_path
         dbname = tmpdirname / '.testdb.sqlite'
@@ -165,7 +213,6 @@ class TestCLI:
         added_file.unlink()
 
         with PydupeDB(dbname) as db:
-            db.copy_lookup_to_permanent()
             filelist_in_permanent = [x['filename']
                                      for x in db.get_files_in_permanent()]
         assert str(added_file) in filelist_in_permanent
@@ -1,8 +1,12 @@
+import functools
 import os
+import sqlite3
 import tempfile
+import threading
+import time
 import pytest
 from pydupe.data import fparms
-from pydupe.db import PydupeDB
+from pydupe.db import DBWriter, PydupeDB
 from pathlib import Path as p
 import typing as tp
 
@@ -233,7 +237,7 @@ class TestDatabase:
 
         with PydupeDB(dbname) as db:
             db.execute(
-                "DELETE from lookup WHERE hash = 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6'")
+                "DELETE from files WHERE hash = X'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6'")
             db.parms_insert(data)
             db.commit()
             data_get = db.get_list_of_equal_sized_files_where_hash_is_NULL()
@@ -287,6 +291,51 @@ class TestDatabase:
              'mtime': 1629356592,
              'ctime': 1630424506}]
 
+    def test_delete_dir_keeps_sibling_with_same_prefix(self) -> None:
+        
+        dbname = p.cwd() / ".dbtest.sqlite"
+        with PydupeDB(dbname) as db:
+            db.parms_insert([fparms(filename='/tests/tdata/somedir_2/file', size=1)])
+            db.delete_dir(p('/tests/tdata/somedir'))
+            data_get = [row['filename'] for row in db.get()]
+        
+        assert data_get == ['/tests/tdata/file_exists', '/tests/tdata/somedir_2/file']
+
+    def test_prefix_operations_keep_sibling_with_same_prefix(self) -> None:
+        
+        dbname = p.cwd() / ".dbtest.sqlite"
+        with PydupeDB(dbname) as db:
+            db.parms_insert([fparms(filename='/tests/tdata/somedir_2/file', hash='be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6', size=1)])
+            data_get = db.get_list_of_files_in_dir('/tests/tdata/somedir')
+            db.delete_dir(p('/tests/tdata/somedir'))
+            data_get_lookup = [row['filename'] for row in db.get()]
+
+        assert data_get == ['/tests/tdata/somedir/dupe2_in_dir',
+                            '/tests/tdata/somedir/dupe_in_dir',
+                            '/tests/tdata/somedir/file_is_dupe']
+        assert data_get_lookup == ['/tests/tdata/file_exists', '/tests/tdata/somedir_2/file']
+
+    def test_dirs_of_permanent_survive_clean(self) -> None:
+        
+        dbname = p.cwd() / ".dbtest.sqlite"
+        with PydupeDB(dbname) as db:
+            db.clean_lookup()
+            db.delete_unused_dirs()
+            db.commit()
+            paths = {row['path'] for row in db.execute("SELECT path FROM dirs")}
+            data_get = sorted(row['filename'] for row in db.get_files_in_permanent())
+
+            assert paths == {'', '/tests', '/tests/tdata', '/tests/tdata/somedir'}
+            assert data_get == ['/tests/tdata/file_exists',
+                                '/tests/tdata/somedir/dupe2_in_dir',
+                                '/tests/tdata/somedir/dupe_in_dir',
+                                '/tests/tdata/somedir/file_is_dupe']
+
+            for f in data_get:
+                db.delete_file_permanent(p(f))
+            db.delete_unused_dirs()
+            assert db.execute("SELECT count(*) FROM dirs").fetchone()[0] == 0
+
     def test_delete_file(self) -> None:
         
         dbname = p.cwd() / ".dbtest.sqlite"
@@ -305,172 +354,213 @@ class TestDatabase:
              'hash': '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0'}
         ]
 
-    def test_copy_dir_to_table_permanent(self) -> None:
-        """check data inserted in fixture 'setup_database' works."""
+    def test_hashed_files_stay_permanent(self) -> None:
         
         dbname = p.cwd() / ".dbtest.sqlite"
         with PydupeDB(dbname) as db:
-            db.copy_dir_to_table_permanent(
-                p('/tests/tdata/somedir'))
-            db.commit()
-            data_get_lookup = db.execute('SELECT * FROM lookup').fetchall()
-            data_get_permanent = db.execute('SELECT * FROM permanent').fetchall()
-        data_dict_lookup = [dict(row) for row in data_get_lookup]
-        data_dict_permanent = [dict(row) for row in data_get_permanent]
-        assert data_dict_lookup == [
-            {'filename': '/tests/tdata/file_exists',
-             'hash': 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/file_is_dupe',
-             'hash': 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/dupe_in_dir',
-             'hash': '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/dupe2_in_dir',
-             'hash': '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506}]
-        assert data_dict_permanent == [
-            {'filename': '/tests/tdata/somedir/file_is_dupe',
-             'hash': 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/dupe_in_dir',
-             'hash': '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/dupe2_in_dir',
-             'hash': '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506}]
-    
-    def test_copy_hash_to_table_lookup_and_clear_permanent(self) -> None:
-        """check data inserted in fixture 'setup_database' works."""
+            db.parms_insert([fparms(filename='/tests/tdata/somedir/not_hashed', size=1)])
+            db.delete_dir(p('/tests/tdata/somedir'))
+            data_get_lookup = [row['filename'] for row in db.get()]
+            data_get_permanent = sorted(row['filename'] for row in db.get_files_in_permanent())
+            assert data_get_lookup == ['/tests/tdata/file_exists']
+            assert data_get_permanent == ['/tests/tdata/file_exists',
+                                          '/tests/tdata/somedir/dupe2_in_dir',
+                                          '/tests/tdata/somedir/dupe_in_dir',
+                                          '/tests/tdata/somedir/file_is_dupe']
+            # files without hash are deleted, not kept
+            assert db.execute("SELECT count(*) FROM files").fetchone()[0] == 4
+
+            # seen again with unchanged stats: back in lookup with its hash
+            db.parms_insert([fparms(filename='/tests/tdata/somedir/file_is_dupe', size=1, inode=25303464, mtime=1629356592, ctime=1630424506),
+                             fparms(filename='/tests/tdata/somedir/dupe_in_dir', size=2, inode=25303464, mtime=1629356592, ctime=1630424506)])
+            data_get = {row['filename']: row['hash'] for row in db.get_file_hash()}
+            assert data_get == {'/tests/tdata/file_exists': 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6',
+                                '/tests/tdata/somedir/file_is_dupe': 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6',
+                                '/tests/tdata/somedir/dupe_in_dir': None}
+
+            db.clean_lookup()
+            assert db.get().fetchall() == []
+            assert len(db.get_files_in_permanent().fetchall()) == 3
+
+    def test_upsert_counts(self) -> None:
         
         dbname = p.cwd() / ".dbtest.sqlite"
+        stats = dict(size=1, inode=25303464, mtime=1629356592, ctime=1630424506)
         with PydupeDB(dbname) as db:
-            db.execute("INSERT INTO permanent SELECT * FROM lookup WHERE filename like '/tests/tdata/somedir%'")
-            db.update_hash([(None, '/tests/tdata/file_exists')])
-            db.update_hash([(None, '/tests/tdata/somedir/file_is_dupe')])
-            db.commit()
-            data_get_lookup = db.execute('SELECT * FROM lookup').fetchall()
-            data_get_permanent = db.execute('SELECT * FROM permanent').fetchall()
-        data_dict_lookup = [dict(row) for row in data_get_lookup]
-        data_dict_permanent = [dict(row) for row in data_get_permanent]
+            assert db.parms_insert([fparms(filename='/tests/tdata/file_exists', **stats),
+                                    fparms(filename='/tests/tdata/new', **stats)]) == {'inserted': 1, 'updated': 0, 'unchanged': 1}
+            # a new ctime keeps the hash, a new size does not
+            assert db.parms_insert([fparms(filename='/tests/tdata/file_exists', **dict(stats, ctime=1)),
+                                    fparms(filename='/tests/tdata/somedir/file_is_dupe', **dict(stats, size=2)),
+                                    fparms(filename='/tests/tdata/new', **stats)]) == {'inserted': 0, 'updated': 2, 'unchanged': 1}
+            data_get = {row['filename']: row['hash'] for row in db.get_file_hash()}
+
+        assert data_get['/tests/tdata/file_exists'] == 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6'
+        assert data_get['/tests/tdata/somedir/file_is_dupe'] is None
+
+    def test_copy_hash_of_moved_files(self) -> None:
         
-        assert data_dict_lookup == [
-            {'filename': '/tests/tdata/file_exists',
-             'hash': None,
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/file_is_dupe',
-             'hash': None,
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/dupe_in_dir',
-             'hash': '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/dupe2_in_dir',
-             'hash': '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506}]
-        assert data_dict_permanent == [
-            {'filename': '/tests/tdata/somedir/file_is_dupe',
-             'hash': 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/dupe_in_dir',
-             'hash': '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/dupe2_in_dir',
-             'hash': '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506}]
+        dbname = p.cwd() / ".dbtest.sqlite"
+        hsh = '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0'
+        with PydupeDB(dbname) as db:
+            db.parms_insert([fparms(filename='/moved/old', hash=hsh, size=1, inode=7, mtime=1, ctime=1, dev=1, mtime_ns=1),
+                             fparms(filename='/moved/written', hash=hsh, size=1, inode=8, mtime=1, ctime=1, dev=1, mtime_ns=1)])
+            db.delete_files_lookup(['/moved/old', '/moved/written'])
+            db.parms_insert([fparms(filename='/moved/new', size=1, inode=7, mtime=1, ctime=2, dev=1, mtime_ns=1),
+                             fparms(filename='/moved/rewritten', size=1, inode=8, mtime=2, ctime=2, dev=1, mtime_ns=2)])
+            db.copy_hash_of_moved_files()
+            data_get = {row['filename']: row['hash'] for row in db.get_file_hash() if row['filename'].startswith('/moved/')}
 
+        assert data_get == {'/moved/new': hsh, '/moved/rewritten': None}
+
+
+class TestMigration:
+
+    def test_migrate_old_schema(self) -> None:
+        with tempfile.TemporaryDirectory() as newpath:
+            dbname = p(newpath) / ".dbtest.sqlite"
+            connection = sqlite3.connect(dbname)
+            for table in ('lookup', 'permanent'):
+                connection.execute(
+                    f"CREATE TABLE {table} (filename TEXT PRIMARY KEY, hash TEXT, size INTEGER, inode INTEGER, mtime INTEGER, ctime INTEGER)")
+            connection.execute("INSERT INTO lookup VALUES ('/tests/tdata/file_exists', NULL, 1, 25303464, 1629356592, 1630424506)")
+            connection.execute("INSERT INTO lookup VALUES ('/tests/tdata/somedir/file_is_dupe', 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6', 1, 25303464, 1629356592, 1630424506)")
+            connection.execute("INSERT INTO permanent VALUES ('/file_in_root', '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0', 1, 25303465, 1629356592, 1630424506)")
+            connection.commit()
+            connection.close()
+
+            with PydupeDB(dbname) as db:
+                assert db.execute("PRAGMA user_version").fetchone()[0] == 1
+                tables = {row['name'] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                assert {'dirs', 'files'} <= tables and not {'lookup', 'permanent'} & tables
+                for table in ('lookup', 'permanent'):
+                    columns = [row['name'] for row in db.execute(f"PRAGMA table_info({table})")]
+                    assert {'head', 'tail', 'algo'} <= set(columns)
+                indexes = {row['name'] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+                assert {'files_size', 'files_hash'} <= indexes
+                data_get = [dict(row) for row in db.execute("SELECT filename, head, tail, algo FROM lookup")]
+                types = [tuple(row) for row in db.execute("SELECT basename, typeof(hash), epoch is not NULL FROM files ORDER BY basename")]
+                permanent = sorted(row['filename'] for row in db.get_files_in_permanent())
+            assert data_get == [
+                {'filename': '/tests/tdata/file_exists', 'head': None, 'tail': None, 'algo': None},
+                {'filename': '/tests/tdata/somedir/file_is_dupe', 'head': None, 'tail': None, 'algo': 'sha256'}]
+            assert types == [('file_exists', 'null', 1), ('file_in_root', 'blob', 0), ('file_is_dupe', 'blob', 1)]
+            assert permanent == ['/file_in_root', '/tests/tdata/somedir/file_is_dupe']
+
+
+class TestConnection:
+
+    def test_connection_is_shared(self, tmp_path: p, monkeypatch: pytest.MonkeyPatch) -> None:
+        dbname = tmp_path / ".dbtest.sqlite"
+        migrations: tp.List[None] = []
+        migrate = PydupeDB.migrate
+        monkeypatch.setattr(PydupeDB, 'migrate', lambda self: migrations.append(migrate(self)))
+        with PydupeDB(dbname) as db:
+            connection = db.connection
+            assert db.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+            assert db.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+        with PydupeDB(dbname) as db:
+            assert db.connection is connection
+        assert len(migrations) == 1
+
+        # a replaced database file gets a new connection and schema
+        os.remove(dbname)
+        with PydupeDB(dbname) as db:
+            assert db.connection is not connection
+            assert db.execute("SELECT count(*) FROM lookup").fetchone()[0] == 0
+        assert len(migrations) == 2
+
+    def test_nested_instances(self, tmp_path: p) -> None:
+        dbname = tmp_path / ".dbtest.sqlite"
+        other = tmp_path / ".other.sqlite"
         with PydupeDB(dbname) as db:
-            db.copy_hash_to_table_lookup()
+            db.parms_insert([fparms(filename='/tests/outer', size=1)])
+            with PydupeDB(dbname) as inner:
+                assert inner.connection is db.connection
+                assert inner.execute("SELECT count(*) FROM lookup").fetchone()[0] == 1
+            # leaving the inner context keeps the writes of the outer one
+            assert db.execute("SELECT count(*) FROM lookup").fetchone()[0] == 1
+            with PydupeDB(other) as db_other:
+                # close() only closes the connection of its own database, and not while it is in use
+                PydupeDB(dbname).close()
+                db_other.close()
+                with pytest.raises(sqlite3.ProgrammingError):
+                    db_other.connection.execute("SELECT 1")
             db.commit()
-            data_get_lookup = db.execute('SELECT * FROM lookup').fetchall()
-            data_get_permanent = db.execute('SELECT * FROM permanent').fetchall()
+        with PydupeDB(dbname) as db:
+            assert [row['filename'] for row in db.get()] == ['/tests/outer']
 
-        data_dict_lookup = [dict(row) for row in data_get_lookup]
-        data_dict_permanent = [dict(row) for row in data_get_permanent]
+        # the outermost context rolls back by default
+        with PydupeDB(dbname) as db:
+            with PydupeDB(dbname) as inner:
+                inner.parms_insert([fparms(filename='/tests/rolled_back', size=1)])
+        with PydupeDB(dbname) as db:
+            assert [row['filename'] for row in db.get()] == ['/tests/outer']
+            connection = db.connection
+        db.close()
+        with PydupeDB(dbname) as db:
+            assert db.connection is not connection
 
-        assert data_dict_lookup == [
-            {'filename': '/tests/tdata/file_exists',
-             'hash': None,
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/file_is_dupe',
-             'hash': 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/dupe_in_dir',
-             'hash': '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/dupe2_in_dir',
-             'hash': '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506}]
-        assert data_dict_permanent == [
-            {'filename': '/tests/tdata/somedir/file_is_dupe',
-             'hash': 'be1c1a22b4055523a0d736f4174ef1d6be1c1a22b4055523a0d736f4174ef1d6',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/dupe_in_dir',
-             'hash': '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506},
-            {'filename': '/tests/tdata/somedir/dupe2_in_dir',
-             'hash': '3aa2ed13ee40ba651e87a0fd60b753d03aa2ed13ee40ba651e87a0fd60b753d0',
-             'size': 1,
-             'inode': 25303464,
-             'mtime': 1629356592,
-             'ctime': 1630424506}]
+    def test_reader_while_writing(self, tmp_path: p) -> None:
+        dbname = tmp_path / ".dbtest.sqlite"
+        result: tp.List[int] = []
+        with PydupeDB(dbname) as db:
+            db.parms_insert([fparms(filename='/tests/committed', size=1)])
+            db.commit()
+            db.parms_insert([fparms(filename='/tests/uncommitted', size=1)])
+
+            def read() -> None:
+                with PydupeDB(dbname) as reader:
+                    result.append(reader.execute("SELECT count(*) FROM lookup").fetchone()[0])
+
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join()
+        assert result == [1]
+
+
+class TestDBWriter:
+
+    @staticmethod
+    def count(dbname: p) -> int:
+        with PydupeDB(dbname) as db:
+            return int(db.execute("SELECT count(*) FROM lookup").fetchone()[0])
+
+    def test_commits_by_time_flush_and_exit(self, tmp_path: p) -> None:
+        dbname = tmp_path / ".dbtest.sqlite"
+        with DBWriter(dbname, commitsize=1000, commitseconds=0.05) as writer:
+            writer.submit(functools.partial(PydupeDB.parms_insert, item=[fparms(filename='/tests/a', size=1)])).result()
+            time.sleep(0.5)
+            assert self.count(dbname) == 1
+        with DBWriter(dbname, commitsize=1000, commitseconds=60) as writer:
+            writer.submit(functools.partial(PydupeDB.parms_insert, item=[fparms(filename='/tests/b', size=1)]))
+            writer.flush()
+            assert self.count(dbname) == 2
+            writer.submit(functools.partial(PydupeDB.parms_insert, item=[fparms(filename='/tests/c', size=1)]))
+        assert self.count(dbname) == 3
+
+    def test_producers_in_threads(self, tmp_path: p) -> None:
+        dbname = tmp_path / ".dbtest.sqlite"
+        with DBWriter(dbname, commitsize=7) as writer:
+            def produce(n: int) -> None:
+                for i in range(50):
+                    writer.submit(functools.partial(PydupeDB.parms_insert, item=[fparms(filename=f'/tests/{n}/{i}', size=1)]))
+
+            threads = [threading.Thread(target=produce, args=(n,)) for n in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert self.count(dbname) == 200
+
+    def test_failing_mutation_stops_writer(self, tmp_path: p) -> None:
+        dbname = tmp_path / ".dbtest.sqlite"
+        with pytest.raises(sqlite3.OperationalError):
+            with DBWriter(dbname, commitsize=1000, commitseconds=60) as writer:
+                writer.submit(functools.partial(PydupeDB.parms_insert, item=[fparms(filename='/tests/a', size=1)]))
+                future = writer.submit(lambda db: db.execute("SELECT * FROM no_such_table"))
+                assert isinstance(future.exception(), sqlite3.OperationalError)
+                with pytest.raises(sqlite3.OperationalError):
+                    writer.submit(functools.partial(PydupeDB.parms_insert, item=[fparms(filename='/tests/b', size=1)]))
+        # the open transaction is rolled back
+        assert self.count(dbname) == 0
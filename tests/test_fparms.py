@@ -17,6 +17,17 @@ class TestFparms:
         with pytest.raises(ValueError):
             checkHash(fparms(hash="123456789012345678901234567890123456789012345678901234567890123"))
     
+    def test_checkHash_algorithms(self) -> None:
+        checkHash(fparms(hash="1234567890123456789012345678901234567890123456789012345678901234"), 'blake2b-256')
+        checkHash(fparms(hash="12345678901234567890123456789012"), 'md5')
+        checkHash(fparms(hash="12345678901234567890123456789012"), 'xxh128')
+        with pytest.raises(ValueError):
+            checkHash(fparms(hash="1234567890123456789012345678901234567890123456789012345678901234"), 'xxh128')
+        with pytest.raises(ValueError):
+            checkHash(fparms(hash="12345678901234567890123456789012"), 'sha256')
+        with pytest.raises(ValueError):
+            checkHash(fparms(hash="12345678901234567890123456789012"), 'unknown')
+    
     def test_from_path(self) -> None:
         with tempfile.TemporaryDirectory() as tmpdirname:
             somefile = p(tmpdirname) / 'somefile.txt'
@@ -30,3 +41,5 @@ class TestFparms:
             assert fp.inode == stat.st_ino
             assert fp.mtime == stat.st_mtime
             assert fp.ctime == stat.st_ctime
+            assert fp.dev == stat.st_dev
+            assert fp.mtime_ns == stat.st_mtime_ns
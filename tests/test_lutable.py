@@ -1,6 +1,7 @@
 import pytest
-from pydupe.lutable import LuTable
+from pydupe.lutable import CompactLuTable, LuTable
 import pathlib as pl
+import random
 
 class TestLuTable:
     value = pl.Path("/tmp")
@@ -157,3 +158,106 @@ class TestLuTable:
             '3': {4},
             '7': {8,9}
             }
+
+    @pytest.mark.parametrize('table', [LuTable, CompactLuTable])
+    def test_bulk(self, table: type[LuTable[str, pl.Path]]) -> None:
+        rows = [('1', self.two), ('3', self.four), ('3', self.five), ('3', self.five)]
+        expected = LuTable([('1', self.two), ('3', self.four), ('3', self.five)])
+        a = table.from_sorted_rows(rows)
+        assert isinstance(a, table)
+        assert a == expected
+        assert len(a) == 3
+        b = table.from_groups([('1', [self.two]), ('3', (self.four, self.five))])
+        assert b == expected
+        b.update_many([('3', self.six), ('4', self.seven), ('3', self.six)])
+        assert b == LuTable([('1', self.two), ('3', self.four), ('3', self.five), ('3', self.six), ('4', self.seven)])
+        assert len(b) == 5
+        with pytest.raises(AssertionError):
+            b.update_many([(4, self.eight)]) # type: ignore
+        with pytest.raises(AssertionError):
+            b.update_many([('2', '/tmp/no_path')]) # type: ignore
+
+    def test_len_is_counted(self) -> None:
+        a = LuTable([('1', self.two), ('3', self.four)])
+        a.add(('3', self.four))
+        a.lor(LuTable([('3', self.five), ('4', self.six)]))
+        a.lextend(LuTable([('5', self.six), ('5', self.seven)]), '5')
+        a['6'] = [self.eight]
+        a['6'] = [self.eight, self.two]
+        a.discard(('1', self.two))
+        del a['3']
+        assert len(a) == sum(len(v) for v in a.values()) == 4
+
+
+class TestCompactLuTable:
+    files = [pl.Path(f"/tmp/dir{i % 3}/file{i}") for i in range(20)]
+
+    def test_same_as_lutable(self) -> None:
+        rnd = random.Random(0)
+        a: LuTable[bytes, pl.Path] = LuTable()
+        b: LuTable[bytes, pl.Path] = CompactLuTable()
+        for _ in range(2000):
+            key = bytes([rnd.randrange(6)])
+            f = rnd.choice(self.files)
+            op = rnd.randrange(10)
+            if op < 6:
+                a.add((key, f))
+                b.add((key, f))
+            elif op < 8 and (key, f) in a:
+                a.discard((key, f))
+                b.discard((key, f))
+            elif op == 8 and key in a.keys():
+                a.ldel([key])
+                b.ldel([key])
+            elif key in a.keys():
+                assert a[key] == b[key]
+            assert len(a) == len(b)
+            assert ((key, f) in a) == ((key, f) in b)
+        assert a == b
+        assert sorted(a) == sorted(b)
+        assert set(a.keys()) == set(b.keys())
+        assert sorted(a.chain_values()) == sorted(b.chain_values())
+        assert a.as_dict_of_strsets() == b.as_dict_of_strsets()
+
+    def test_size_bounded_after_churn(self) -> None:
+        a: LuTable[bytes, pl.Path] = LuTable()
+        b: CompactLuTable[bytes] = CompactLuTable()
+        for i in range(5000):
+            # groups are deleted and added again, files are discarded and their directories are not used again
+            key = bytes([i % 50])
+            if i % 7 == 0 and key in b.keys():
+                del a[key]
+                del b[key]
+            elif i % 5 == 0 and key in b.keys():
+                f = next(iter(b[key]))
+                a.discard((key, f))
+                b.discard((key, f))
+            for f in (pl.Path(f"/tmp/dir{i}/file"), pl.Path(f"/tmp/dir{i % 3}/file{i % 11}")):
+                a.add((key, f))
+                b.add((key, f))
+            assert len(b._start) <= 2 * len(b.keys()) + 1
+            assert len(b._names) <= 2 * len(b) + 2
+            assert len(b._dirs) <= 2 * len(b) + 2
+        assert a == b
+        assert a.as_dict_of_strsets() == b.as_dict_of_strsets()
+
+    def test_api(self) -> None:
+        one, two, three = self.files[:3]
+        a = CompactLuTable([('1', one), ('3', two)])
+        assert isinstance(a, LuTable)
+        assert list(a) == [('1', one), ('3', two)]
+        with pytest.raises(ValueError):
+            a.discard(('1', two))
+        with pytest.raises(ValueError):
+            a.discard(('2', two))
+        a |= LuTable([('3', three), ('4', one)])
+        assert a == LuTable([('1', one), ('3', two), ('3', three), ('4', one)])
+        a.lor(LuTable([('1', three), ('5', one)]))
+        assert a['1'] == {one, three}
+        b = CompactLuTable(('7', one))
+        b.lextend(a, '3')
+        assert b.as_dict_of_sets() == {'7': {one}, '3': {two, three}}
+        b['7'] = [two]
+        assert b['7'] == {two}
+        with pytest.raises(AssertionError):
+            b.add(('8', 'no path')) # type: ignore
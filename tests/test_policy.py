@@ -0,0 +1,43 @@
+from pathlib import Path as p
+import re
+import typing as tp
+
+import pytest
+from pydupe.policy import KeepPolicy
+
+
+class TestKeepPolicy:
+    files = [p('/photos/2022/b.jpg'), p('/export/x/20220131_235959.jpg'), p('/export/a.jpg')]
+    mtimes: tp.Dict[str, tp.Optional[float]] = {'/photos/2022/b.jpg': 3.0, '/export/x/20220131_235959.jpg': None, '/export/a.jpg': 1.0}
+
+    @pytest.mark.parametrize('spec, kept', [
+        ('oldest', '/export/a.jpg'),
+        ('newest', '/photos/2022/b.jpg'),
+        ('shortest', '/export/a.jpg'),
+        ('longest', '/export/x/20220131_235959.jpg'),
+        ('root:/photos/', '/photos/2022/b.jpg'),
+        ('exif', '/export/x/20220131_235959.jpg'),
+        ('pattern:^b', '/photos/2022/b.jpg'),
+        # the next rule decides on a tie, the path order last
+        ('root:/export, newest', '/export/a.jpg'),
+        ('root:/export,pattern:nomatch', '/export/a.jpg'),
+    ])
+    def test_choose(self, spec: str, kept: str) -> None:
+        assert KeepPolicy.parse(spec).choose(self.files, mtime=self.mtimes.__getitem__) == p(kept)
+
+    def test_relative_root(self, tmp_path: p, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.chdir(tmp_path)
+        files = [tmp_path / 'export' / 'a.jpg', tmp_path / 'photos' / 'b.jpg']
+        assert KeepPolicy.parse('root:photos').choose(files, mtime=lambda f: None) == files[1]
+        assert KeepPolicy.parse('root:./photos/../photos/').rules == [('root', f'{tmp_path}/photos/')]
+
+    @pytest.mark.parametrize('spec, error', [
+        ('bogus', ValueError),
+        ('oldest:1', ValueError),
+        ('root', ValueError),
+        ('pattern:(', re.error),
+        ('shortest,root:', ValueError),
+    ])
+    def test_invalid_rules(self, spec: str, error: tp.Type[Exception]) -> None:
+        with pytest.raises(error):
+            KeepPolicy.parse(spec)